@@ -41,4 +41,4 @@ TWITTER_V1_ACCESS_TOKEN=$TWITTER_V1_ACCESS_TOKEN
 TWITTER_V1_SECRET=$TWITTER_V1_SECRET
 EOF
 
-python3 -m machi_bot -p
\ No newline at end of file
+exec python3 -m machi_bot ${MACHI_BOT_ARGS:--p}
\ No newline at end of file
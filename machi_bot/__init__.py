@@ -1,16 +1,25 @@
 """Initialization for twitter bot"""
 import sys
 import os
-import subprocess
-import shlex
 import json
-import requests
+import signal
 from pathlib import Path
 import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from loguru import logger
 from . import create_tweet
-from . import media_upload
 from . import database as machidb
+from . import benchmark
+from . import transcode_cache
+from . import pipeline
+from . import rate_limit
+from . import metrics
+from .watcher import MediaWatcher
+from .encoding import convert_to_mp4
+from .oauth import get_oauth1
+from .scheduler import Scheduler
+from .rate_limit import RateLimitError
+from .posting import create_post, process_outbox, drain_outbox, get_file, post_to_discord
 
 PROJECT_ROOT = Path(__file__).parent.parent
 CONFIG_FILE = os.path.join(PROJECT_ROOT, "config.json")
@@ -23,9 +32,11 @@ def main() -> None:
 
     parser = argparse.ArgumentParser(prog="machi-bot", description="Twitter bot for posting videos")
     parser.add_argument("-r", "--rebuild", action="store_true",
-        help="Rebuilds the media database")
+        help="Rebuilds the media database by checking every file")
     parser.add_argument("-s", "--scan", action="store_true",
         help="Scans the media library")
+    parser.add_argument("--full-scan", action="store_true",
+        help="Checks every file for changes instead of only changed folders")
     parser.add_argument("-p", "--post", action="store_true",
         help="Posts a tweet. If no text or media is given a random media is chosen")
     parser.add_argument("-t", "--text", type=str, nargs="?", action="store", default="",
@@ -36,18 +47,79 @@ def main() -> None:
         help="Prints number of previous posts")
     parser.add_argument("-g", "--get", action="store_true",
         help="Fetches a single tweet. For now only for auth testing.")
+    parser.add_argument("--profile", metavar="NAME", type=str,
+        help="Encoding profile to use. Defaults to encoding-profile from config")
+    parser.add_argument("--prepare", metavar="COUNT", type=int,
+        help="Reserves the next COUNT media and converts them ahead of posting")
+    parser.add_argument("--all-accounts", action="store_true",
+        help="Posts once from every account in config concurrently")
+    parser.add_argument("--daemon", action="store_true",
+        help="Keeps running and posts, scans and prepares media on the schedule from config")
+    parser.add_argument("--watch", action="store_true",
+        help="Keeps running and updates the media database when files change")
+    parser.add_argument("--reconcile", action="store_true",
+        help="Marks media whose file isn't on disk anymore as missing")
+    parser.add_argument("--drain-outbox", action="store_true",
+        help="Retry posts that failed or were interrupted")
+    parser.add_argument("--retry-post", metavar="OUTBOX_ID", type=int,
+        help="Posts the tweet of a post in review again on the next outbox drain")
+    parser.add_argument("--export-metrics", choices=["prometheus", "jsonl"],
+        help="Prints stored post metrics as Prometheus text or JSON lines")
+    parser.add_argument("--rate-limits", action="store_true",
+        help="Print the rate limit budgets seen by the last requests")
+    parser.add_argument("--benchmark", choices=["scan", "encode", "post"],
+        help="Runs a benchmark. 'scan' measures rebuild throughput on a synthetic library, "
+            "'encode' converts sample media with every encoding profile, "
+            "'post' runs the whole bot against a local fake twitter server")
+    parser.add_argument("--bench-files", metavar="COUNT", type=int, default=10000,
+        help="Number of files in the synthetic benchmark library")
+    parser.add_argument("--bench-samples", metavar="COUNT", type=int, default=3,
+        help="Number of media encoded per profile in the encode benchmark, or posts made in "
+            "the post benchmark")
+    parser.add_argument("--bench-latency", metavar="SECONDS", type=float, default=0.05,
+        help="Delay of every request to the fake twitter server in the post benchmark")
+    parser.add_argument("--bench-processing", metavar="SECONDS", type=float, default=2,
+        help="Time the fake twitter server takes to process each video in the post benchmark")
 
     args = parser.parse_args()
 
     if args.rebuild:
-        machidb.setup_tables(args.rebuild)
+        machidb.setup_tables(args.rebuild, args.full_scan)
     if args.scan:
         # Do media scan
-        machidb.setup_tables(args.rebuild)
+        machidb.setup_tables(args.rebuild, args.full_scan)
+    if args.prepare:
+        machidb.setup_tables(args.rebuild, args.full_scan)
+        prepare_media(args.prepare, args.profile)
     if args.post:
-        machidb.setup_tables(args.rebuild)
+        machidb.setup_tables(args.rebuild, args.full_scan)
         # Select media and text and do a post
-        create_post(text=args.text, media_path=args.media)
+        try:
+            create_post(text=args.text, media_path=args.media, profile=args.profile)
+        except RateLimitError as err:
+            logger.error(f"Post postponed, --drain-outbox continues it later: {err}")
+    if args.watch:
+        machidb.setup_tables(args.rebuild, args.full_scan)
+        watcher = MediaWatcher()
+        signal.signal(signal.SIGINT, watcher.stop)
+        signal.signal(signal.SIGTERM, watcher.stop)
+        watcher.start()
+        watcher.join()
+    if args.reconcile:
+        machidb.setup_tables(args.rebuild, args.full_scan)
+        machidb.reconcile()
+    if args.retry_post:
+        machidb.create_tables()
+        if machidb.retry_outbox(args.retry_post):
+            logger.info(f"Post {args.retry_post} will be tweeted on the next outbox drain")
+        else:
+            logger.error(f"Post {args.retry_post} isn't in review")
+    if args.drain_outbox:
+        machidb.setup_tables(args.rebuild, args.full_scan)
+        try:
+            drain_outbox(args.profile)
+        except RateLimitError as err:
+            logger.error(f"Outbox drain stopped: {err}")
     if args.previous:
         # Print previous posts
         posts = machidb.get_posts(args.previous)
@@ -55,110 +127,136 @@ def main() -> None:
         logger.info(f"{json_string}")
     if args.get:
         create_tweet.get_tweet()
+    if args.export_metrics:
+        machidb.create_tables()
+        if args.export_metrics == "prometheus":
+            sys.stdout.write(metrics.prometheus_text(machidb.get_metric_totals()))
+        else:
+            sys.stdout.write(metrics.json_lines(machidb.get_post_metrics()))
+    if args.rate_limits:
+        json_string = json.dumps(rate_limit.load_state(), indent=4)
+        logger.info(f"{json_string}")
+    if args.all_accounts:
+        machidb.setup_tables(args.rebuild, args.full_scan)
+        try:
+            drain_outbox(args.profile)
+            pipeline.post_all(args.text, args.profile)
+        except RateLimitError as err:
+            logger.error(f"Posting postponed, --drain-outbox continues it later: {err}")
+    if args.daemon:
+        run_daemon(args.text, args.profile)
+    if args.benchmark == "scan":
+        benchmark.benchmark_rebuild(args.bench_files)
+    if args.benchmark == "encode":
+        machidb.setup_tables(args.rebuild, args.full_scan)
+        benchmark.benchmark_encode(args.bench_samples, args.media)
+    if args.benchmark == "post":
+        benchmark.benchmark_post(
+            args.bench_files, args.bench_samples, args.bench_latency, args.bench_processing,
+            args.profile
+        )
+
 
+def run_daemon(text: str, profile: str = None) -> None:
+    """Runs the bot as a long running process
 
-def create_post(text: str, media_path: str) -> None:
-    """Main function for posting tweets
+    Posting, scanning and preparing media are scheduled from the schedule section of
+    config. With watch enabled the media folder is watched for changes instead of
+    scanned on an interval. Upload connections and the status poller stay alive
+    between posts. If accounts are configured every account posts on each run.
 
     Args:
-        text (str): Text to tweet
-        media_path (str): Media filepath
+        text (str): Text for every tweet. Media title is used if empty.
+        profile (str): Encoding profile name
     """
-    # Select file and convert it to mp4
-    media = get_file(media_path)
-    media_id = media[0]
-    file_path = media[1]
-    title = media[2]
+    schedule = CONFIG.get("schedule", {})
+    prepare_ahead = schedule.get("prepare-ahead", 0)
 
-    # Upload media
-    twitter_media_id = media_upload.upload_media(file_path)
+    machidb.setup_tables()
+    if prepare_ahead > 0:
+        prepare_media(prepare_ahead, profile)
 
-    # Create the tweet
-    if len(text) == 0: text = title
-    response = create_tweet.post_tweet(text, twitter_media_id)
-
-    if response.status_code == 201:
-        # Insert post to db
-        link = machidb.insert_post(response.json(), media_id)
-
-        if CONFIG.get("discord-webhook-url"):
-            post_to_discord(link)
+    def post() -> float:
+        # Postpone instead of failing when twitter's tweet budget is used up
+        client = rate_limit.get_client()
+        wait = max(
+            client.endpoint_wait(
+                "POST", create_tweet.TWEETS_ENDPOINT_URL, get_oauth1(account["token-file"])
+            )
+            for account in pipeline.get_accounts()
+        )
+        if wait > 0:
+            logger.info(f"Tweet rate limit reached, postponing post by {wait:.0f} seconds")
+            return wait
+        try:
+            if CONFIG.get("accounts"):
+                drain_outbox(profile)
+                pipeline.post_all(text, profile)
+            else:
+                create_post(text=text, media_path=None, profile=profile)
+        except RateLimitError as err:
+            logger.info(f"Rate limit reached, postponing post by {err.wait:.0f} seconds")
+            return err.wait
+        if prepare_ahead > 0:
+            prepare_media(prepare_ahead, profile)
+        return None
 
-def post_to_discord(content: str) -> None:
-    """Post message to discord webhook
+    scheduler = Scheduler()
+    if schedule.get("post-times"):
+        scheduler.daily("post", schedule["post-times"], post, schedule.get("post-jitter", 0))
+    else:
+        scheduler.every(
+            "post", schedule.get("post-interval", 3600), post, schedule.get("post-jitter", 0)
+        )
+    watcher = None
+    if schedule.get("watch"):
+        watcher = MediaWatcher()
+        watcher.start()
+    # The watcher keeps the library current, so only scan on an interval if asked to
+    if watcher is None or "scan-interval" in schedule:
+        scheduler.every("scan", schedule.get("scan-interval", 21600), machidb.scan)
+    if schedule.get("reconcile-interval"):
+        scheduler.every("reconcile", schedule["reconcile-interval"], machidb.reconcile)
 
-    Args:
-        content (str): message content
-    """
-    payload = {"content": content}
-    requests.request(
-        method="POST",
-        url=CONFIG.get("discord-webhook-url"),
-        data=payload,
-        timeout=10
-    )
+    signal.signal(signal.SIGINT, scheduler.stop)
+    signal.signal(signal.SIGTERM, scheduler.stop)
+    logger.info("Running as daemon")
+    scheduler.run()
+    if watcher is not None:
+        watcher.stop()
 
+def prepare_media(count: int, profile: str = None) -> None:
+    """Reserves the next media to post and converts them in a process pool
 
-def get_file(media_path: str) -> tuple[int, str, str]:
-    """Fetches media file from database and converts it to mp4
+    Conversions are stored in the transcode cache so posting only has to upload them.
 
     Args:
-        media_path (str): File path
-
-    Returns:
-        tuple[int, str, str]: Tuple with database media_id, mp4 file path and media title
+        count (int): Number of media to keep prepared
+        profile (str): Encoding profile name
     """
-    media = machidb.get_media(media_path)
-    media_id = media[0]
-    file_path = media[1]
-    title = media[2]
-    logger.info(f"Media fetched: {file_path}")
-    file_path_new = convert_to_mp4(file_path)
-    return (media_id, file_path_new, title)
+    if not transcode_cache.enabled():
+        logger.error("Preparing media requires transcode-cache to be enabled")
+        return
 
-def convert_to_mp4(file_path: str) -> str:
-    """Converts file from webm to mp4 using ffmpeg
-
-    Args:
-        file_path (str): path to file
+    reserved = machidb.reserve_media(count)
+    if len(reserved) == 0:
+        logger.info("Nothing to prepare")
+        return
+    logger.info(f"Preparing {len(reserved)} media")
 
-    Returns:
-        str: file path of the mp4
-    """
-    logger.info("Converting video to mp4")
-    new_filename = Path(file_path).stem + ".mp4"
-    temp_dir = PROJECT_ROOT.joinpath("video_tmp")
-    if not os.path.exists(temp_dir):
-        os.makedirs(temp_dir)
-    file_path_new = temp_dir.joinpath(new_filename).as_posix()
-
-    ffmpeg = CONFIG.get("ffmpeg-location")
-    args = "-movflags faststart -c:v libx264 -vf 'pad=ceil(iw/2)*2:ceil(ih/2)*2' -preset slow -crf 17 -c:a aac -b:a 160k"
-    command = f"{ffmpeg} -y -i \"{file_path}\" {args} \"{file_path_new}\""
-    logger.info("Running ffmpeg...")
-    try:
-        ffmpeg_output = CONFIG.get("ffmpeg-output")
-        if ffmpeg_output:
-            error_pipe = None
-        else:
-            error_pipe = subprocess.DEVNULL
-
-        subprocess.run(
-            shlex.split(command),
-            check=True,
-            stdout=subprocess.DEVNULL,
-            stderr=error_pipe
-        )
-    except subprocess.CalledProcessError:
-        logger.error("Error when running ffmpeg")
-        # Delete the created mp4
-        if os.path.isfile(file_path_new):
-            logger.info(f"Removing {file_path_new}")
-            os.remove(file_path_new)
-        raise
-
-    logger.success("Conversion successful!")
-    return file_path_new
+    workers = CONFIG.get("prepare-workers", 2)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(convert_to_mp4, media[1], profile): media for media in reserved}
+        for future in as_completed(futures):
+            media = futures[future]
+            try:
+                future.result()
+            except Exception as err:
+                logger.error(f"Preparing {media[1]} failed: {err}")
+                machidb.release_media(media[0])
+                continue
+            machidb.mark_prepared(media[0])
+            logger.success(f"Prepared {media[1]}")
 
 def configure_logger() -> None:
     """Configures the loguru logger
@@ -0,0 +1,343 @@
+"""Benchmarks for measuring the bot's slow paths"""
+
+import os
+import json
+import time
+import shlex
+import tempfile
+import subprocess
+import statistics
+from pathlib import Path
+from contextlib import contextmanager, ExitStack
+from loguru import logger
+from . import database as machidb
+from . import encoding
+from . import transcode_cache
+from . import media_upload
+from . import create_tweet
+from . import rate_limit
+from . import metrics
+from . import posting
+from .fake_twitter import FakeTwitter
+
+SCAN_BATCH_SIZES = [1, 100, 1000, 5000]
+SELECTION_SAMPLES = 200
+SAMPLE_SECONDS = 10
+# Synthetic clips like the webm files the bot is meant for
+SAMPLE_ARGS = (
+    "-f lavfi -i testsrc2=size=1280x720:rate=30:duration={seconds} "
+    "-f lavfi -i sine=frequency=440:duration={seconds} "
+    "-c:v libvpx -deadline realtime -cpu-used 8 -b:v 2M -c:a libvorbis"
+)
+API_KEYS = ["TWITTER_API_KEY", "TWITTER_API_SECRET"]
+
+def create_library(location: str, file_count: int, files_per_folder: int = 100) -> None:
+    """Creates a synthetic media library of empty webm files
+
+    Args:
+        location (str): Folder to create the library in
+        file_count (int): Number of files to create
+        files_per_folder (int): Number of files in each subfolder
+    """
+    for index in range(file_count):
+        folder = os.path.join(location, f"folder_{index // files_per_folder:05d}")
+        if index % files_per_folder == 0:
+            os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, f"video_{index:07d}.webm"), "wb"):
+            pass
+
+
+def create_samples(location: str, count: int, seconds: int = SAMPLE_SECONDS) -> list[str]:
+    """Creates synthetic webm clips with ffmpeg
+
+    Args:
+        location (str): Folder to create the clips in
+        count (int): Number of clips
+        seconds (int): Length of each clip
+
+    Returns:
+        list[str]: Clip paths
+    """
+    os.makedirs(location, exist_ok=True)
+    ffmpeg = encoding.CONFIG.get("ffmpeg-location")
+    args = SAMPLE_ARGS.format(seconds=seconds)
+    samples = []
+    for index in range(count):
+        sample = Path(location).joinpath(f"sample_{index:04d}.webm").as_posix()
+        subprocess.run(
+            shlex.split(f"{ffmpeg} -y {args} \"{sample}\""),
+            check=True,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
+        )
+        samples.append(sample)
+    return samples
+
+
+@contextmanager
+def replaced(target, name: str, value):
+    """Replaces a module attribute for the duration of the block"""
+    original = getattr(target, name)
+    setattr(target, name, value)
+    try:
+        yield
+    finally:
+        setattr(target, name, original)
+
+
+@contextmanager
+def offline(temp_dir: str, server: FakeTwitter):
+    """Points the bot at the fake twitter server and keeps its state in temp_dir
+
+    The database, transcode cache and rate limit state are replaced with temporary
+    ones. Discord and metrics exports are disabled. A token file with dummy
+    credentials is created, and dummy API keys are used if none are set.
+
+    Args:
+        temp_dir (str): Folder for temporary state
+        server (FakeTwitter): Running fake twitter server
+
+    Yields:
+        str: Token file to post with
+    """
+    token_file = os.path.join(temp_dir, "token_benchmark.json")
+    with open(token_file, "w", encoding="utf-8") as file:
+        json.dump({"oauth_token": "1-benchmark", "oauth_token_secret": "benchmark"}, file)
+    missing_keys = [key for key in API_KEYS if not os.environ.get(key)]
+    for key in missing_keys:
+        os.environ[key] = "benchmark"
+    posting_config = {
+        key: value for key, value in posting.CONFIG.items() if key != "discord-webhook-url"
+    }
+    with ExitStack() as stack:
+        stack.enter_context(replaced(machidb, "DB_FILE", os.path.join(temp_dir, "benchmark.db")))
+        stack.enter_context(
+            replaced(transcode_cache, "CACHE_DIR", Path(temp_dir).joinpath("transcode_cache"))
+        )
+        stack.enter_context(replaced(media_upload, "MEDIA_ENDPOINT_URL", server.media_url))
+        stack.enter_context(replaced(media_upload, "POLLER", None))
+        stack.enter_context(replaced(create_tweet, "TWEETS_ENDPOINT_URL", server.tweets_url))
+        stack.enter_context(
+            replaced(rate_limit, "STATE_FILE", Path(temp_dir).joinpath("rate_limits.json"))
+        )
+        stack.enter_context(replaced(metrics, "CONFIG", {}))
+        stack.enter_context(replaced(posting, "CONFIG", posting_config))
+        try:
+            yield token_file
+        finally:
+            machidb.close_connection()
+            for key in missing_keys:
+                del os.environ[key]
+
+
+def benchmark_post(file_count: int, post_count: int, latency: float = 0.05,
+                   processing_delay: float = 2, profile: str = None) -> dict:
+    """Measures the whole bot end to end against a local fake twitter server
+
+    A synthetic library of file_count empty files and post_count generated clips is
+    scanned, media is selected from it and the clips are posted with create_post.
+    Transcode and upload throughput come from the metrics stored with the posts.
+    Nothing is sent to twitter and the real database isn't touched.
+
+    Args:
+        file_count (int): Number of files in the synthetic library
+        post_count (int): Number of posts to make
+        latency (float): Seconds the fake server delays every request
+        processing_delay (float): Seconds the fake server processes each video
+        profile (str): Encoding profile name
+
+    Returns:
+        dict: Scan, selection, transcode, upload and posting results
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as temp_dir, \
+            FakeTwitter(latency, processing_delay) as server, \
+            offline(temp_dir, server) as token_file:
+        library = os.path.join(temp_dir, "media")
+        logger.info(f"Creating synthetic library with {file_count} files and {post_count} clips")
+        create_library(library, file_count)
+        samples = create_samples(os.path.join(library, "samples"), post_count)
+
+        machidb.create_tables()
+        start = time.perf_counter()
+        machidb.scan(full=True, media_location=library)
+        elapsed = time.perf_counter() - start
+        rows = file_count + post_count
+        results["scan"] = {
+            "rows": rows,
+            "seconds": round(elapsed, 3),
+            "rows_per_second": round(rows / elapsed)
+        }
+
+        timings = []
+        for _ in range(SELECTION_SAMPLES):
+            start = time.perf_counter()
+            machidb.get_media(None)
+            timings.append((time.perf_counter() - start) * 1000)
+        results["selection"] = {
+            "samples": SELECTION_SAMPLES,
+            "mean_ms": round(statistics.mean(timings), 3),
+            "p95_ms": round(statistics.quantiles(timings, n=20)[-1], 3)
+        }
+
+        start = time.perf_counter()
+        for sample in samples:
+            posting.create_post("benchmark", sample, profile, token_file)
+        elapsed = time.perf_counter() - start
+
+        posts = machidb.get_post_metrics()
+        # Streamed posts convert and upload in the same stage
+        convert_seconds = sum(
+            post["durations"].get("convert", 0) + post["durations"].get("stream", 0)
+            for post in posts
+        )
+        video_seconds = sum(post["values"].get("video_seconds", 0) for post in posts)
+        upload_seconds = sum(
+            post["durations"].get("upload_append", 0) + post["durations"].get("stream", 0)
+            for post in posts
+        )
+        uploaded_bytes = sum(post["counters"].get("bytes_uploaded", 0) for post in posts)
+        results["transcode"] = {
+            "files": len(posts),
+            "seconds": round(convert_seconds, 3),
+            # Needs ffprobe to know the video length
+            "realtime_factor": round(video_seconds / convert_seconds, 2)
+                if video_seconds and convert_seconds else None
+        }
+        results["upload"] = {
+            "bytes": uploaded_bytes,
+            "seconds": round(upload_seconds, 3),
+            "megabytes_per_second": round(uploaded_bytes / 1024 / 1024 / upload_seconds, 2)
+                if upload_seconds else None,
+            "requests": server.requests
+        }
+        results["post"] = {
+            "posts": len(posts),
+            "failed": post_count - len(posts),
+            "seconds": round(elapsed, 3),
+            "posts_per_hour": round(len(posts) / elapsed * 3600) if elapsed else None
+        }
+
+    logger.success(
+        f"Scan: {results['scan']['rows']} rows in {results['scan']['seconds']:.2f}s "
+        f"({results['scan']['rows_per_second']} rows/s)"
+    )
+    logger.success(
+        f"Selection: mean {results['selection']['mean_ms']:.2f} ms, "
+        f"p95 {results['selection']['p95_ms']:.2f} ms"
+    )
+    logger.success(
+        f"Transcode: {results['transcode']['files']} files in "
+        f"{results['transcode']['seconds']:.2f}s, realtime factor "
+        f"{results['transcode']['realtime_factor']}"
+    )
+    logger.success(
+        f"Upload: {results['upload']['bytes'] / 1024 / 1024:.1f} MB in "
+        f"{results['upload']['seconds']:.2f}s ({results['upload']['megabytes_per_second']} MB/s), "
+        f"{results['upload']['requests']} requests"
+    )
+    logger.success(
+        f"Post: {results['post']['posts']} posts ({results['post']['failed']} failed) in "
+        f"{results['post']['seconds']:.2f}s ({results['post']['posts_per_hour']} posts/hour)"
+    )
+    return results
+
+
+def benchmark_rebuild(file_count: int, batch_sizes: list[int] = None) -> list[dict]:
+    """Measures rebuild scan throughput for different batch sizes
+
+    A temporary library and database are used so the real database isn't touched.
+
+    Args:
+        file_count (int): Number of files in the synthetic library
+        batch_sizes (list[int]): Batch sizes to measure
+
+    Returns:
+        list[dict]: Result for each batch size with row count, seconds and rows per second
+    """
+    if batch_sizes is None:
+        batch_sizes = SCAN_BATCH_SIZES
+    results = []
+    db_file = machidb.DB_FILE
+    with tempfile.TemporaryDirectory() as temp_dir:
+        library = os.path.join(temp_dir, "media")
+        logger.info(f"Creating synthetic library with {file_count} files")
+        create_library(library, file_count)
+        try:
+            for batch_size in batch_sizes:
+                machidb.DB_FILE = os.path.join(temp_dir, f"benchmark_{batch_size}.db")
+                machidb.create_tables(rebuild=True)
+                start = time.perf_counter()
+                machidb.scan(full=True, media_location=library, batch_size=batch_size)
+                elapsed = time.perf_counter() - start
+                results.append({
+                    "batch_size": batch_size,
+                    "rows": file_count,
+                    "seconds": round(elapsed, 3),
+                    "rows_per_second": round(file_count / elapsed)
+                })
+        finally:
+            machidb.close_connection()
+            machidb.DB_FILE = db_file
+
+    for result in results:
+        logger.success(
+            f"Batch size {result['batch_size']:>5}: {result['rows']} rows in "
+            f"{result['seconds']:.2f}s ({result['rows_per_second']} rows/s)"
+        )
+    return results
+
+
+def benchmark_encode(sample_count: int, media_path: str = None) -> list[dict]:
+    """Encodes sample media with every encoding profile
+
+    Wall time, CPU time used by ffmpeg and output size are measured for each
+    profile. The transcode cache isn't used. CPU time is 0 on Windows, where child
+    process times aren't available.
+
+    Args:
+        sample_count (int): Number of random media from the library to encode
+        media_path (str): Encode this file instead of random media
+
+    Returns:
+        list[dict]: Result for each profile
+    """
+    if media_path:
+        samples = [media_path]
+    else:
+        samples = [media[1] for media in machidb.get_sample_media(sample_count)]
+    if len(samples) == 0:
+        logger.error("No media to benchmark. Try scanning the library first.")
+        return []
+
+    results = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for profile in encoding.get_profiles():
+            args = encoding.encode_args(profile)
+            wall_time = cpu_time = output_bytes = 0
+            for index, sample in enumerate(samples):
+                output_path = os.path.join(temp_dir, f"{profile}_{index}.mp4")
+                times_before = os.times()
+                start = time.perf_counter()
+                encoding.run_ffmpeg(sample, args, output_path)
+                wall_time += time.perf_counter() - start
+                times_after = os.times()
+                cpu_time += (times_after.children_user - times_before.children_user
+                    + times_after.children_system - times_before.children_system)
+                output_bytes += os.path.getsize(output_path)
+                os.remove(output_path)
+            results.append({
+                "profile": profile,
+                "samples": len(samples),
+                "wall_seconds": round(wall_time, 2),
+                "cpu_seconds": round(cpu_time, 2),
+                "output_bytes": output_bytes
+            })
+
+    for result in results:
+        logger.success(
+            f"{result['profile']:>10}: {result['samples']} files, "
+            f"wall {result['wall_seconds']:.2f}s, cpu {result['cpu_seconds']:.2f}s, "
+            f"{result['output_bytes'] / 1024 / 1024:.1f} MB"
+        )
+    return results
@@ -1,28 +1,33 @@
 """Creating and posting a tweet"""
 
+import os
 import json
-import requests
+from pathlib import Path
 from loguru import logger
 
-from .oauth import OAuth1
-from requests_oauthlib import OAuth1 as oauth_helper
+from .oauth import get_oauth1
+from .rate_limit import get_client, RateLimitError
+from . import database as machidb
 
-def post_tweet(text: str, media_id: str) -> dict:
-    """Posts a Tweet"""
+PROJECT_ROOT = Path(__file__).parent.parent
+CONFIG_FILE = os.path.join(PROJECT_ROOT, "config.json")
+with open(CONFIG_FILE, "r", encoding="utf-8") as file:
+    CONFIG = json.load(file)
 
-    manage_tweets_endpoint = "https://api.twitter.com/2/tweets"
+TWEETS_ENDPOINT_URL = CONFIG.get("tweets-endpoint-url", "https://api.twitter.com/2/tweets")
 
-    request_body = {}
+def post_tweet(text: str, media_id: str, token_file: str = "token_v1.json") -> dict:
+    """Posts a Tweet
 
-    oauth = OAuth1()
-    oauth.handle_oauth1()
+    Args:
+        text (str): Tweet text
+        media_id (str): Uploaded media id
+        token_file (str): OAuth1 token file of the account to post as
+    """
 
-    auth_session = oauth_helper(
-        client_key=oauth.twitter_api_key,
-        client_secret=oauth.twitter_api_secret,
-        resource_owner_key=oauth.oauth_token,
-        resource_owner_secret=oauth.oauth_token_secret
-    )
+    request_body = {}
+
+    auth_session = get_oauth1(token_file)
 
     request_body["text"] = text
 
@@ -30,9 +35,9 @@ def post_tweet(text: str, media_id: str) -> dict:
         request_body["media"] = {"media_ids": [media_id]}
 
     # Post Tweet
-    response = requests.request(
+    response = get_client().request(
         "POST",
-        manage_tweets_endpoint,
+        TWEETS_ENDPOINT_URL,
         auth=auth_session,
         json=request_body,
         timeout=10
@@ -47,23 +52,50 @@ def post_tweet(text: str, media_id: str) -> dict:
 
     return response
 
+def post_outbox_tweet(entry: dict):
+    """Posts the tweet of an outbox entry at most once
+
+    The entry is moved to tweeting before the request. If the request fails without
+    an answer from twitter the tweet may still have been posted, so the entry is
+    moved to review instead of being retried. A tweet twitter rejected or that
+    wasn't sent because of the rate limit goes back to uploaded.
+
+    Args:
+        entry (dict): Outbox entry with an uploaded media
+
+    Raises:
+        RuntimeError: Twitter rejected the tweet
+
+    Returns:
+        requests.Response: Response of the created tweet
+    """
+    outbox_id = entry["outbox_id"]
+    machidb.update_outbox(outbox_id, "tweeting")
+    try:
+        response = post_tweet(entry["text"], entry["twitter_media_id"], entry["token_file"])
+    except RateLimitError:
+        machidb.update_outbox(outbox_id, "uploaded")
+        raise
+    except Exception:
+        logger.error(
+            f"Post {outbox_id} may have been tweeted, check it and use --retry-post {outbox_id}"
+        )
+        machidb.update_outbox(outbox_id, "review")
+        raise
+
+    if response.status_code != 201:
+        machidb.update_outbox(outbox_id, "uploaded")
+        raise RuntimeError(f"Posting tweet failed with status {response.status_code}")
+    return response
+
 def get_tweet():
     """Fetches single tweet. Only for auth testing for now.
     """
-    manage_tweets_endpoint = "https://api.twitter.com/2/tweets"
-    oauth = OAuth1()
-    oauth.handle_oauth1()
-
-    auth_session = oauth_helper(
-        client_key=oauth.twitter_api_key,
-        client_secret=oauth.twitter_api_secret,
-        resource_owner_key=oauth.oauth_token,
-        resource_owner_secret=oauth.oauth_token_secret
-    )
+    auth_session = get_oauth1()
     request_body = {"ids": "1635294771139997700", "tweet.fields": "created_at"}
-    response = requests.request(
+    response = get_client().request(
         "GET",
-        manage_tweets_endpoint,
+        TWEETS_ENDPOINT_URL,
         auth=auth_session,
         params=request_body,
         timeout=10
@@ -5,8 +5,16 @@ import glob
 import sqlite3
 import json
 import re
+import queue
+import random
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from loguru import logger
+from . import migrations
+from . import metrics
+from . import fingerprint
 
 PROJECT_ROOT = Path(__file__).parent.parent
 CONFIG_FILE = os.path.join(PROJECT_ROOT, "config.json")
@@ -14,88 +22,541 @@ with open(CONFIG_FILE, "r", encoding="utf-8") as file:
     CONFIG = json.load(file)
 APPDATA = Path(CONFIG.get("appdata"))
 DB_FILE = os.path.join(APPDATA, "database.db")
+# Statements kept compiled per connection
+CACHED_STATEMENTS = 256
+CONNECTIONS = threading.local()
+# Database files whose tables have been set up by this process
+SCHEMA_READY = set()
 
-def setup_tables(rebuild = False):
-    """Create necessary tables if they don't exist"""
+class TimedConnection(sqlite3.Connection):
+    """Connection that adds time spent in queries to the current post's metrics"""
+
+    def execute(self, *args, **kwargs):
+        with metrics.timer("db"):
+            return super().execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        with metrics.timer("db"):
+            return super().executemany(*args, **kwargs)
+
+
+def get_connection() -> sqlite3.Connection:
+    """Returns this thread's database connection, opening it on first use
+
+    Each thread and process keeps one connection open instead of connecting for every
+    query. The database runs in WAL mode so a scan writing in one thread or process
+    doesn't block reads from posting. db-cache-size and db-mmap-size in megabytes set
+    the page cache and memory mapped I/O sizes. Foreign keys are enforced.
+
+    Returns:
+        sqlite3.Connection: Open database connection
+    """
+    key = (os.getpid(), DB_FILE)
+    if getattr(CONNECTIONS, "key", None) != key:
+        # DB_FILE changed, the benchmark uses its own databases
+        close_connection()
+        db_connection = sqlite3.connect(
+            DB_FILE, timeout=30, cached_statements=CACHED_STATEMENTS, factory=TimedConnection
+        )
+        db_connection.execute("PRAGMA journal_mode = WAL")
+        # WAL keeps the database consistent with NORMAL, only the last commits can be lost
+        db_connection.execute("PRAGMA synchronous = NORMAL")
+        db_connection.execute(f"PRAGMA cache_size = {-1024 * CONFIG.get('db-cache-size', 16)}")
+        db_connection.execute(f"PRAGMA mmap_size = {1024 * 1024 * CONFIG.get('db-mmap-size', 64)}")
+        db_connection.execute("PRAGMA temp_store = MEMORY")
+        db_connection.execute("PRAGMA foreign_keys = ON")
+        CONNECTIONS.connection = db_connection
+        CONNECTIONS.key = key
+    return CONNECTIONS.connection
+
+
+def close_connection() -> None:
+    """Closes this thread's database connection"""
+    key = getattr(CONNECTIONS, "key", None)
+    # A connection inherited from the parent process is left for the parent to close
+    if key is not None and key[0] == os.getpid():
+        CONNECTIONS.connection.close()
+    CONNECTIONS.key = None
+
+def setup_tables(rebuild = False, full_scan = False):
+    """Create necessary tables if they don't exist and scan the media library
+
+    Args:
+        rebuild (bool): Re-check every file in the library. Kept for the --rebuild flag,
+            the media table is no longer dropped.
+        full_scan (bool): Re-check every file instead of only changed directories
+    """
+    create_tables(rebuild)
+    # Populate new db
+    scan(full=rebuild or full_scan)
+
+
+def create_tables(rebuild = False):
+    """Brings the database schema up to date with migrations
+
+    Args:
+        rebuild (bool): Only logged. Rebuilding rescans every file instead of dropping
+            the media table, so posts keep pointing to their media.
+    """
+    if DB_FILE in SCHEMA_READY:
+        return
     if rebuild:
         logger.info("Rebuilding media database")
     else:
         logger.info("Setting up database")
-    db_connection = sqlite3.connect(DB_FILE)
+    migrations.migrate(get_connection())
+    SCHEMA_READY.add(DB_FILE)
+
+
+class ScanBatch:
+    """Collects scan results and writes them to the database in batches"""
+
+    def __init__(self, db_connection: sqlite3.Connection, batch_size: int) -> None:
+        self.db_connection = db_connection
+        self.batch_size = max(1, batch_size)
+        self.inserts = []
+        self.updates = []
+        self.deletes = []
+        self.directories = []
+        self.added = 0
+        self.changed = 0
+        self.removed_ids = []
+
+    def __len__(self) -> int:
+        return len(self.inserts) + len(self.updates) + len(self.deletes)
+
+    def insert(self, title: str, file_path: str, directory: str, size: int, mtime: float) -> None:
+        """Queues a new media row"""
+        self.inserts.append((title, file_path, directory, size, mtime))
+        self.flush_if_full()
+
+    def update(self, media_id: int, size: int, mtime: float) -> None:
+        """Queues a size and mtime update for an existing media row. Clears missing.
+        A changed file is fingerprinted again."""
+        self.updates.append((size, mtime, size, mtime, media_id))
+        self.flush_if_full()
+
+    def delete(self, media_id: int) -> None:
+        """Queues removal of a media row
+
+        The row is only marked missing so finish_removals can match it to a moved file.
+        """
+        self.deletes.append((media_id,))
+        self.removed_ids.append(media_id)
+        self.flush_if_full()
+
+    def directory(self, path: str, mtime: float) -> None:
+        """Queues a directory mtime. It's written in the same transaction as its files."""
+        self.directories.append((path, mtime))
+
+    def flush_if_full(self) -> None:
+        """Flushes the batch once it reaches batch_size rows"""
+        if len(self) >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """Writes all queued rows in a single transaction"""
+        with self.db_connection:
+            cursor = self.db_connection.executemany(
+                """
+                INSERT OR IGNORE INTO media(title, file_path, directory, size, mtime, rand_key)
+                VALUES (?, ?, ?, ?, ?, random())
+                """,
+                self.inserts
+            )
+            self.added += max(cursor.rowcount, 0)
+            # The CASE sees the old size and mtime
+            self.db_connection.executemany(
+                """
+                UPDATE media
+                SET fingerprint = CASE WHEN size IS ? AND mtime IS ? THEN fingerprint END,
+                    size = ?, mtime = ?, missing = 0
+                WHERE media_id = ?
+                """,
+                self.updates
+            )
+            self.changed += len(self.updates)
+            self.db_connection.executemany("UPDATE media SET missing = 1 WHERE media_id = ?",
+                                           self.deletes)
+            self.db_connection.executemany(
+                "INSERT OR REPLACE INTO directories(path, mtime) VALUES (?, ?)",
+                self.directories
+            )
+        self.inserts.clear()
+        self.updates.clear()
+        self.deletes.clear()
+        self.directories.clear()
+
+
+def walk_media(media_location: str, excluded_paths: set, known_dirs: dict,
+               full: bool, workers: int, recursive: bool = True):
+    """Walks the media folder with one thread pool task per directory
+
+    Directory listings are latency bound on network mounts, so directories are read
+    concurrently and the results are handed to the caller through a queue. Excluded
+    paths are pruned and symlinked folders aren't followed, same as os.walk.
+
+    Args:
+        media_location (str): Folder to walk
+        excluded_paths (set): Normalized folder paths that are skipped with their subfolders
+        known_dirs (dict): Directory mtimes from the previous scan
+        full (bool): Stat every file even if the directory mtime hasn't changed
+        workers (int): Maximum number of directories read concurrently
+        recursive (bool): Walk subdirectories too
+
+    Yields:
+        tuple[str, float, list]: Directory path, its mtime and a list of
+            (file name, size, mtime) tuples. The list is None if the directory is unchanged
+            and mtime is None if the directory couldn't be read.
+    """
+    results = queue.Queue()
+
+    def read_directory(path: str) -> None:
+        try:
+            try:
+                dir_mtime = os.stat(path).st_mtime
+                entries = list(os.scandir(path))
+            except OSError as err:
+                logger.warning(f"Couldn't read {path}: {err}")
+                results.put((path, None, None, 0))
+                return
+
+            subdirs = []
+            file_entries = []
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if not is_dir:
+                    file_entries.append(entry)
+                elif (recursive and not entry.is_symlink()
+                      and os.path.normpath(entry.path) not in excluded_paths):
+                    subdirs.append(entry.path)
+
+            files = None
+            if full or known_dirs.get(path) != dir_mtime:
+                files = []
+                for entry in file_entries:
+                    try:
+                        file_stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    files.append((entry.name, file_stat.st_size, file_stat.st_mtime))
+
+            # Report this directory before its subdirectories so the pending count stays positive
+            results.put((path, dir_mtime, files, len(subdirs)))
+            for subdir in subdirs:
+                executor.submit(read_directory, subdir)
+        except BaseException as err:
+            results.put(err)
+
+    executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="scan")
     try:
-        media_table = db_connection.execute("SELECT name FROM sqlite_master WHERE name = 'media'")
-        table_exists = media_table.fetchone() is not None
-        if table_exists and rebuild:
-            db_connection.execute("""DROP TABLE media""")
-        if not table_exists or rebuild:
-            db_connection.execute("""
-                CREATE TABLE media(
-                    media_id INTEGER PRIMARY KEY,
-                    title NVARCHAR NOT NULL,
-                    file_path NVARCHAR UNIQUE NOT NULL,
-                    added TEXT DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-
-        posts_table = db_connection.execute("SELECT name FROM sqlite_master WHERE name = 'posts'")
-        if posts_table.fetchone() is None:
-            db_connection.execute("""
-                CREATE TABLE posts(
-                    post_id INTEGER PRIMARY KEY,
-                    post_body TEXT NOT NULL,
-                    media_id INTEGER,
-                    link TEXT NOT NULL,
-                    tweet_id TEXT NOT NULL,
-                    timestamp TEXT DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY(media_id) REFERENCES media(media_id) ON DELETE SET NULL
+        executor.submit(read_directory, str(media_location))
+        pending = 1
+        while pending > 0:
+            result = results.get()
+            if isinstance(result, BaseException):
+                raise result
+            path, dir_mtime, files, subdir_count = result
+            pending += subdir_count - 1
+            yield path, dir_mtime, files
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def get_excluded_paths(media_location: str) -> set:
+    """Creates real paths from exclude-folders
+
+    Args:
+        media_location (str): Media folder the excluded paths are relative to
+
+    Returns:
+        set: Normalized excluded folder paths
+    """
+    return {
+        os.path.normpath(os.path.join(media_location, folder))
+        for folder in CONFIG.get("exclude-folders")
+    }
+
+
+def sync_directory(db_connection: sqlite3.Connection, batch: ScanBatch, root: str,
+                   dir_mtime: float, files: list) -> None:
+    """Compares the files of a directory on disk to the rows stored for it
+
+    Args:
+        db_connection (sqlite3.Connection): Open database connection
+        batch (ScanBatch): Batch the changes are written with
+        root (str): Directory path
+        dir_mtime (float): Directory modification time
+        files (list): (file name, size, mtime) tuples of the files on disk
+    """
+    existing = {
+        file_path: (media_id, size, mtime, missing)
+        for media_id, file_path, size, mtime, missing in db_connection.execute(
+            "SELECT media_id, file_path, size, mtime, missing FROM media WHERE directory = ?",
+            (root,)
+        )
+    }
+    for item, size, mtime in files:
+        file_path = os.path.join(root, item)
+        row = existing.pop(file_path, None)
+        if row is None:
+            title = Path(item).stem
+            batch.insert(title, file_path, root, size, mtime)
+        elif row[1:3] != (size, mtime) or row[3]:
+            batch.update(row[0], size, mtime)
+
+    # Whatever is left wasn't found on disk anymore
+    for row in existing.values():
+        batch.delete(row[0])
+    batch.directory(root, dir_mtime)
+
+
+def remove_directory(db_connection: sqlite3.Connection, path: str,
+                     subdirectories: bool = False) -> list[int]:
+    """Removes a directory from the library and marks its media missing
+
+    The media is removed by finish_removals unless it turns up somewhere else.
+
+    Args:
+        db_connection (sqlite3.Connection): Open database connection
+        path (str): Directory path
+        subdirectories (bool): Remove everything below the directory too
+
+    Returns:
+        list[int]: media_ids marked missing
+    """
+    with db_connection:
+        if subdirectories:
+            prefix = path + os.sep
+            removed_ids = [row[0] for row in db_connection.execute(
+                "SELECT media_id FROM media WHERE directory = ? OR substr(directory, 1, ?) = ?",
+                (path, len(prefix), prefix)
+            )]
+            db_connection.execute(
+                "DELETE FROM directories WHERE path = ? OR substr(path, 1, ?) = ?",
+                (path, len(prefix), prefix)
+            )
+        else:
+            removed_ids = [row[0] for row in db_connection.execute(
+                "SELECT media_id FROM media WHERE directory = ?", (path,)
+            )]
+            db_connection.execute("DELETE FROM directories WHERE path = ?", (path,))
+        mark_missing(db_connection, removed_ids)
+    return removed_ids
+
+
+def next_media_id(db_connection: sqlite3.Connection) -> int:
+    """Returns the media_id the next added media gets"""
+    return db_connection.execute("SELECT COALESCE(MAX(media_id), 0) + 1 FROM media").fetchone()[0]
+
+
+def update_fingerprints(db_connection: sqlite3.Connection, batch_size: int, workers: int,
+                        outdated: bool = False) -> dict[int, str]:
+    """Fingerprints media that doesn't have a fingerprint yet
+
+    Files are read in batches with a thread pool like reconcile does. Files that
+    can't be read are marked unreadable and only tried again with outdated.
+
+    Args:
+        db_connection (sqlite3.Connection): Open database connection
+        batch_size (int): Files fingerprinted per batch
+        workers (int): Files read concurrently
+        outdated (bool): Also redo fingerprints made with the other kind of hash and
+            files that couldn't be read
+
+    Returns:
+        dict[int, str]: New fingerprints by media_id, without unreadable files
+    """
+    condition = "fingerprint IS NULL"
+    if outdated:
+        condition = "(fingerprint IS NULL OR substr(fingerprint, 1, 2) != :prefix)"
+    updated = {}
+    unreadable = 0
+    last_id = 0
+    executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="fingerprint")
+    with executor:
+        while True:
+            rows = db_connection.execute(
+                f"""
+                SELECT media_id, file_path
+                FROM media
+                WHERE media_id > :last_id AND missing = 0 AND {condition}
+                ORDER BY media_id
+                LIMIT :limit
+                """,
+                {"last_id": last_id, "prefix": fingerprint.prefix(), "limit": max(1, batch_size)}
+            ).fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            fingerprints = executor.map(fingerprint.compute, [row[1] for row in rows])
+            results = [
+                (media_fingerprint or fingerprint.UNREADABLE, media_id)
+                for (media_id, _), media_fingerprint in zip(rows, fingerprints)
+            ]
+            with db_connection:
+                db_connection.executemany(
+                    "UPDATE media SET fingerprint = ? WHERE media_id = ?", results
                 )
-            """)
+            for media_fingerprint, media_id in results:
+                if media_fingerprint == fingerprint.UNREADABLE:
+                    unreadable += 1
+                else:
+                    updated[media_id] = media_fingerprint
+    if updated or unreadable:
+        logger.info(f"Fingerprinted {len(updated)} files, {unreadable} couldn't be read")
+    return updated
 
-        # Populate new db
-        scan()
-    except:
-        raise
-    finally:
-        db_connection.close()
 
+def finish_removals(db_connection: sqlite3.Connection, removed_ids: list[int], first_new_id: int,
+                    batch_size: int, workers: int, outdated: bool = False) -> tuple[int, int]:
+    """Fingerprints new files, matches them to missing media and removes the rest
+
+    A new file with the fingerprint of missing media is the same video moved or
+    renamed, so the missing row is moved to the new path and keeps its posts. New
+    copies of posted videos are marked posted. Files smaller than
+    fingerprint.MIN_MATCH_SIZE aren't matched. Media removed by the scan that didn't
+    turn up elsewhere is deleted.
+
+    Args:
+        db_connection (sqlite3.Connection): Open database connection
+        removed_ids (list[int]): media_ids the scan marked missing
+        first_new_id (int): Rows with this media_id or higher were added by the scan
+        batch_size (int): Files fingerprinted per batch
+        workers (int): Files read concurrently
+        outdated (bool): Also redo fingerprints made with the other kind of hash
 
-def scan():
-    """Iterate over media folder and populate database with filepaths"""
-    logger.info("Scanning media files and populating database")
-    db_connection = sqlite3.connect(DB_FILE)
-    media_location = Path(CONFIG.get("media-location"))
+    Returns:
+        tuple[int, int]: Number of media moved and number removed
+    """
+    fingerprinted = update_fingerprints(db_connection, batch_size, workers, outdated)
 
-    # Create real paths from excluded paths
-    excluded_paths = []
-    for folder in CONFIG.get("exclude-folders"):
-        dir_path = os.path.normpath(os.path.join(media_location, folder))
-        excluded_paths.append(dir_path)
+    matches = db_connection.execute(
+        """
+        SELECT n.media_id, o.media_id
+        FROM media n
+        JOIN media o ON o.fingerprint = n.fingerprint AND o.missing = 1
+        WHERE n.media_id >= ? AND n.missing = 0 AND n.size >= ? AND n.fingerprint != ?
+        ORDER BY n.media_id
+        """,
+        (first_new_id, fingerprint.MIN_MATCH_SIZE, fingerprint.UNREADABLE)
+    ).fetchall()
+    moved_new = set()
+    moved_old = set()
+    with db_connection:
+        for new_id, old_id in matches:
+            if new_id in moved_new or old_id in moved_old:
+                continue
+            moved_new.add(new_id)
+            moved_old.add(old_id)
+            new_row = db_connection.execute(
+                "SELECT title, file_path, directory, size, mtime FROM media WHERE media_id = ?",
+                (new_id,)
+            ).fetchone()
+            db_connection.execute("DELETE FROM media WHERE media_id = ?", (new_id,))
+            db_connection.execute(
+                """
+                UPDATE media
+                SET title = ?, file_path = ?, directory = ?, size = ?, mtime = ?, missing = 0
+                WHERE media_id = ?
+                """,
+                (*new_row, old_id)
+            )
+            logger.info(f"Moved media {old_id} to {new_row[1]}")
+
+        # Copies of posted videos count as posted. Looked up once per fingerprint since
+        # many files can share one. The size is part of the fingerprint.
+        last_posted = {}
+        for media_fingerprint in set(fingerprinted.values()):
+            posted_count, posted_at = db_connection.execute(
+                """
+                SELECT COUNT(*), MAX(last_posted)
+                FROM media
+                WHERE fingerprint = ? AND posted = 1 AND size >= ?
+                """,
+                (media_fingerprint, fingerprint.MIN_MATCH_SIZE)
+            ).fetchone()
+            if posted_count > 0:
+                last_posted[media_fingerprint] = posted_at
+        db_connection.executemany(
+            "UPDATE media SET posted = 1, last_posted = ? WHERE media_id = ? AND posted = 0",
+            [
+                (last_posted[media_fingerprint], media_id)
+                for media_id, media_fingerprint in fingerprinted.items()
+                if media_fingerprint in last_posted and media_id not in moved_new
+            ]
+        )
+
+        removed = db_connection.executemany(
+            "DELETE FROM media WHERE media_id = ? AND missing = 1",
+            [(media_id,) for media_id in removed_ids if media_id not in moved_old]
+        ).rowcount
+    return (len(moved_old), max(removed, 0))
+
+
+def scan(full = False, media_location: str = None, batch_size: int = None, workers: int = None):
+    """Iterate over media folder and populate database with filepaths
+
+    Directory modification times are stored in the directories table. A directory
+    whose mtime hasn't changed since the last scan has had no files added, removed
+    or renamed, so its files are skipped unless a full scan is requested.
+
+    Args:
+        full (bool): Check every file for changes, not only files in changed directories
+        media_location (str): Folder to scan. Defaults to media-location from config.
+        batch_size (int): Rows written per transaction. Defaults to scan-batch-size from config.
+        workers (int): Directories read concurrently. Defaults to scan-workers from config.
+    """
+    if full:
+        logger.info("Scanning media files and populating database")
+    else:
+        logger.info("Scanning changed media folders")
+    db_connection = get_connection()
+    if media_location is None:
+        media_location = CONFIG.get("media-location")
+    media_location = Path(media_location)
+    if batch_size is None:
+        batch_size = CONFIG.get("scan-batch-size", 1000)
+    if workers is None:
+        workers = CONFIG.get("scan-workers", 8)
+
+    excluded_paths = get_excluded_paths(media_location)
     try:
+        known_dirs = dict(db_connection.execute("SELECT path, mtime FROM directories"))
+        first_new_id = next_media_id(db_connection)
+        seen_dirs = set()
+        unreadable_dirs = []
+        skipped = 0
+        batch = ScanBatch(db_connection, batch_size)
         # Traverse the media folder
-        for root, dirs, files in os.walk(media_location, topdown=True):
-            # Remove excluded folders/paths from the directory list to traverse
-            new_dirs = []
-            for item in dirs:
-                dir_normpath = os.path.normpath(os.path.join(root, item))
-                if dir_normpath not in excluded_paths:
-                    new_dirs.append(item)
-            dirs[:] = new_dirs
-
-            # Insert media
-            for item in files:
-                file_path = os.path.join(root, item)
-                title = Path(item).stem
-                try:
-                    db_connection.execute(
-                        "INSERT INTO media(title, file_path) VALUES (?, ?)",
-                        (title, file_path)
-                    )
-                    logger.info(f"Added {item}")
-                except sqlite3.IntegrityError as err:
-                    if err.sqlite_errorname == "SQLITE_CONSTRAINT_UNIQUE":
-                        pass
-                    else:
-                        raise
+        for root, dir_mtime, files in walk_media(media_location, excluded_paths, known_dirs,
+                                                 full, workers):
+            seen_dirs.add(root)
+            if files is None:
+                if dir_mtime is None:
+                    unreadable_dirs.append(root + os.sep)
+                else:
+                    skipped += 1
+                continue
+            sync_directory(db_connection, batch, root, dir_mtime, files)
+        batch.flush()
+        removed_ids = batch.removed_ids
+
+        # Drop directories that were deleted or excluded since the last scan
+        for path in set(known_dirs) - seen_dirs:
+            # Keep folders below a folder that couldn't be read this time
+            if path.startswith(tuple(unreadable_dirs)):
+                continue
+            removed_ids.extend(remove_directory(db_connection, path))
+
+        moved, removed = finish_removals(
+            db_connection, removed_ids, first_new_id, batch_size, workers, outdated=full
+        )
+        added, changed = batch.added - moved, batch.changed
+
         # Remove excluded folders from library
         for folder in CONFIG.get("exclude-folders"):
             excluded_path = os.path.normpath(os.path.join(media_location, folder)) + "%"
@@ -105,24 +566,99 @@ def scan():
             )
             db_connection.commit()
             if removed_items.rowcount > 0:
-                logger.info(f"Removed {removed_items.rowcount} library items with excluded path {folder}")
+                logger.info(
+                    f"Removed {removed_items.rowcount} library items with excluded path {folder}"
+                )
+
+        logger.info(
+            f"Scan complete: {added} added, {changed} changed, {moved} moved, {removed} removed, "
+            f"{skipped} unchanged folders skipped"
+        )
     except:
+        # Don't leave the shared connection in a transaction
+        db_connection.rollback()
+        raise
+
+def scan_directories(directories: dict, media_location: str = None, batch_size: int = None,
+                     workers: int = None) -> None:
+    """Applies changes in some directories without walking the whole library
+
+    Every file in the given directories is compared to the database like a full scan
+    does. Directories that don't exist anymore or are excluded are removed together
+    with their subdirectories.
+
+    Args:
+        directories (dict): Directory paths mapped to True if their subdirectories
+            should be walked too
+        media_location (str): Media folder. Defaults to media-location from config.
+        batch_size (int): Rows written per transaction. Defaults to scan-batch-size from config.
+        workers (int): Directories read concurrently. Defaults to scan-workers from config.
+    """
+    db_connection = get_connection()
+    if media_location is None:
+        media_location = CONFIG.get("media-location")
+    if batch_size is None:
+        batch_size = CONFIG.get("scan-batch-size", 1000)
+    if workers is None:
+        workers = CONFIG.get("scan-workers", 8)
+    excluded_paths = get_excluded_paths(Path(media_location))
+    try:
+        known_dirs = dict(db_connection.execute("SELECT path, mtime FROM directories"))
+        first_new_id = next_media_id(db_connection)
+        batch = ScanBatch(db_connection, batch_size)
+        removed_ids = batch.removed_ids
+        for directory, recursive in directories.items():
+            directory = os.path.normpath(directory)
+            excluded = any(
+                directory == path or directory.startswith(path + os.sep) for path in excluded_paths
+            )
+            if excluded or not os.path.isdir(directory):
+                removed_ids.extend(
+                    remove_directory(db_connection, directory, subdirectories=True)
+                )
+                continue
+
+            seen_dirs = set()
+            # A single directory has all its files checked since modified files don't
+            # change the directory mtime. Walked subdirectories are skipped if unchanged.
+            for root, dir_mtime, files in walk_media(directory, excluded_paths, known_dirs,
+                                                     not recursive, workers, recursive):
+                seen_dirs.add(root)
+                if files is not None:
+                    sync_directory(db_connection, batch, root, dir_mtime, files)
+            if recursive:
+                prefix = directory + os.sep
+                for path in set(known_dirs) - seen_dirs:
+                    if path.startswith(prefix):
+                        removed_ids.extend(remove_directory(db_connection, path))
+        batch.flush()
+        moved, removed = finish_removals(
+            db_connection, removed_ids, first_new_id, batch_size, workers
+        )
+        logger.info(
+            f"Updated {len(directories)} folders: {batch.added - moved} added, "
+            f"{batch.changed} changed, {moved} moved, {removed} removed"
+        )
+    except:
+        # Don't leave the shared connection in a transaction
+        db_connection.rollback()
         raise
-    finally:
-        db_connection.close()
 
 def get_media(media_path: str) -> tuple[int, str, str]:
     """Fetches a file from database
 
+    Media marked missing or with an outbox post that wasn't posted isn't picked at
+    random. If the picked file isn't on disk only that media is marked missing and
+    another one is picked, checking the rest of the library is left to reconcile.
+
     Args:
         media_path (str): Media file_path
 
     Returns:
         tuple[int, str, str]: Tuple with database media_id, file path and media title
     """
-    db_connection = sqlite3.connect(DB_FILE)
-    media_found = False
-    while not media_found:
+    db_connection = get_connection()
+    while True:
         if media_path is not None and len(media_path) > 0:
             media_result = db_connection.execute(
                 """
@@ -137,24 +673,17 @@ def get_media(media_path: str) -> tuple[int, str, str]:
                 sys.exit(1)
         else:
             # Fetch random media that hasn't been posted
-            media_result = db_connection.execute(
-                """
-                SELECT m.media_id, m.file_path, m.title
-                FROM media m
-                LEFT JOIN posts p ON p.media_id = m.media_id
-                WHERE p.post_id IS NULL
-                ORDER BY RANDOM()
-                LIMIT 1
-                """
-            ).fetchone()
-            # If all media has been posted, pick the first timestamped post
+            with db_connection:
+                media_result = get_random_unposted(db_connection)
+            # If all media has been posted, pick the one posted longest ago
             if media_result is None:
                 media_result = db_connection.execute(
                     """
-                    SELECT m.media_id, m.file_path, m.title
-                    FROM media m
-                    LEFT JOIN posts p ON p.media_id = m.media_id
-                    ORDER BY p.timestamp ASC
+                    SELECT media_id, file_path, title
+                    FROM media
+                    WHERE missing = 0
+                        AND media_id NOT IN (SELECT media_id FROM outbox WHERE state != 'posted')
+                    ORDER BY last_posted ASC
                     LIMIT 1
                     """
                 ).fetchone()
@@ -163,46 +692,580 @@ def get_media(media_path: str) -> tuple[int, str, str]:
                 logger.error("No media found. Try scanning the library first.")
                 sys.exit(1)
 
-        # If file is not on disk
-        if not os.path.exists(media_result[1]):
-            logger.error(f"Media found in database but not on disk ({media_result[1]}). Removing db entry.")
+        if os.path.exists(media_result[1]):
+            return media_result
+
+        logger.error(f"Media found in database but not on disk ({media_result[1]})")
+        mark_missing(db_connection, [media_result[0]])
+        if media_path:
+            sys.exit(1)
+
+
+def mark_missing(db_connection: sqlite3.Connection, media_ids: list[int],
+                 missing: bool = True) -> None:
+    """Sets or clears the missing flag of media
+
+    Args:
+        db_connection (sqlite3.Connection): Open database connection
+        media_ids (list[int]): database media_ids
+        missing (bool): New value of the flag
+    """
+    with db_connection:
+        db_connection.executemany(
+            "UPDATE media SET missing = ? WHERE media_id = ?",
+            [(int(missing), media_id) for media_id in media_ids]
+        )
+
+
+def reconcile(batch_size: int = None, workers: int = None) -> tuple[int, int]:
+    """Marks media whose file isn't on disk as missing instead of deleting it
+
+    Files are checked in batches with a thread pool, since stat calls on network
+    mounts are latency bound. Missing media that is back on disk is cleared.
+    Missing rows are kept so their posts stay linked, and a scan of their folder
+    removes them for good.
+
+    Args:
+        batch_size (int): Files checked per batch. Defaults to scan-batch-size from config.
+        workers (int): Files checked concurrently. Defaults to scan-workers from config.
+
+    Returns:
+        tuple[int, int]: Number of media marked missing and number found again
+    """
+    if batch_size is None:
+        batch_size = CONFIG.get("scan-batch-size", 1000)
+    if workers is None:
+        workers = CONFIG.get("scan-workers", 8)
+    logger.info("Checking that media files are on disk")
+    db_connection = get_connection()
+    marked = found = 0
+    last_id = 0
+    executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="reconcile")
+    with executor:
+        while True:
+            rows = db_connection.execute(
+                """
+                SELECT media_id, file_path, missing
+                FROM media
+                WHERE media_id > ?
+                ORDER BY media_id
+                LIMIT ?
+                """,
+                (last_id, max(1, batch_size))
+            ).fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            exists = executor.map(os.path.exists, [row[1] for row in rows])
+            now_missing = []
+            now_found = []
+            for (media_id, _, missing), on_disk in zip(rows, exists):
+                if not on_disk and not missing:
+                    now_missing.append(media_id)
+                elif on_disk and missing:
+                    now_found.append(media_id)
+            mark_missing(db_connection, now_missing)
+            mark_missing(db_connection, now_found, missing=False)
+            marked += len(now_missing)
+            found += len(now_found)
+    logger.info(f"Reconcile complete: {marked} marked missing, {found} found again")
+    return (marked, found)
+
+def get_random_unposted(db_connection: sqlite3.Connection) -> tuple[int, str, str]:
+    """Picks a random unposted media by probing a random key
+
+    Every media has a random rand_key. A random value is drawn and the unposted
+    row with the next key at or after it is returned, wrapping around to the lowest
+    key. The lookup uses the media_random index, so the cost doesn't grow with
+    library size. Selection is approximate: a pick is biased towards media whose
+    key follows a wide gap. The picked media gets a new key, so the bias moves
+    around instead of favouring the same media on every pick. Missing media, media
+    reserved by prepare and media with an unfinished, failed or in review post in
+    the outbox is skipped, so a tweet that may already exist isn't posted again.
+
+    Args:
+        db_connection (sqlite3.Connection): Open database connection
+
+    Returns:
+        tuple[int, str, str]: Tuple with database media_id, file path and media title.
+            None if everything has been posted.
+    """
+    # sqlite's random() draws from the whole signed 64-bit range
+    probe = random.randint(-2 ** 63, 2 ** 63 - 1)
+    # Start over from the lowest key if everything after the probe is reserved
+    for lowest_key in (probe, -2 ** 63):
+        media_result = db_connection.execute(
+            """
+            SELECT media_id, file_path, title
+            FROM media
+            WHERE missing = 0 AND posted = 0 AND rand_key >= ?
+                AND media_id NOT IN (SELECT media_id FROM prepared)
+                AND media_id NOT IN (SELECT media_id FROM outbox WHERE state != 'posted')
+            ORDER BY rand_key
+            LIMIT 1
+            """,
+            (lowest_key,)
+        ).fetchone()
+        if media_result is not None:
+            db_connection.execute(
+                "UPDATE media SET rand_key = random() WHERE media_id = ?", (media_result[0],)
+            )
+            return media_result
+    return None
+
+
+def reserve_media(count: int) -> list[tuple[int, str, str]]:
+    """Reserves unposted media for preparing ahead of time
+
+    Tops the reservations up to count and returns every reserved media that
+    hasn't been prepared yet. Reservations are deleted together with their media
+    and reserved media marked missing isn't counted.
+
+    Args:
+        count (int): Number of media to keep reserved
+
+    Returns:
+        list[tuple[int, str, str]]: Tuples with database media_id, file path and media title
+    """
+    db_connection = get_connection()
+    with db_connection:
+        # Reservations of missing media don't count, they can't be posted
+        reserved_count = db_connection.execute(
+            """
+            SELECT COUNT(*)
+            FROM prepared r
+            JOIN media m ON m.media_id = r.media_id
+            WHERE m.missing = 0
+            """
+        ).fetchone()[0]
+        for _ in range(count - reserved_count):
+            media_result = get_random_unposted(db_connection)
+            if media_result is None:
+                break
             db_connection.execute(
-                """DELETE FROM media WHERE media_id = ?""",
+                "INSERT INTO prepared(media_id) VALUES (?)",
                 (media_result[0],)
             )
-            db_connection.commit()
-        else:
-            media_found = True
+    return db_connection.execute(
+        """
+        SELECT m.media_id, m.file_path, m.title
+        FROM prepared r
+        JOIN media m ON m.media_id = r.media_id
+        WHERE r.ready = 0 AND m.missing = 0
+        ORDER BY r.reserved
+        """
+    ).fetchall()
+
+
+def mark_prepared(media_id: int) -> None:
+    """Marks reserved media as prepared
+
+    Args:
+        media_id (int): database media_id
+    """
+    db_connection = get_connection()
+    with db_connection:
+        db_connection.execute("UPDATE prepared SET ready = 1 WHERE media_id = ?", (media_id,))
+
+
+def release_media(media_id: int) -> None:
+    """Removes the reservation of a media
+
+    Args:
+        media_id (int): database media_id
+    """
+    db_connection = get_connection()
+    with db_connection:
+        db_connection.execute("DELETE FROM prepared WHERE media_id = ?", (media_id,))
+
+
+def get_prepared() -> tuple[int, str, str]:
+    """Fetches the oldest prepared media
+
+    Media with a post in the outbox is skipped. An unfinished post is continued by
+    drain_outbox and a failed one shouldn't be tried again with a new entry.
+
+    Returns:
+        tuple[int, str, str]: Tuple with database media_id, file path and media title.
+            None if nothing has been prepared.
+    """
+    db_connection = get_connection()
+    media_result = db_connection.execute(
+        """
+        SELECT m.media_id, m.file_path, m.title
+        FROM prepared r
+        JOIN media m ON m.media_id = r.media_id
+        WHERE r.ready = 1 AND m.missing = 0
+            AND NOT EXISTS (
+                SELECT 1 FROM outbox o WHERE o.media_id = r.media_id AND o.state != 'posted'
+            )
+        ORDER BY r.reserved
+        LIMIT 1
+        """
+    ).fetchone()
+    return media_result
 
-    db_connection.close()
+
+def get_upload(file_path: str, file_size: int, file_mtime: float,
+               chunk_size: int) -> tuple[int, str, float, set[int]]:
+    """Fetches an unfinished upload of the file that can still be resumed
+
+    Uploads of an older version of the file, with a different chunk size or with an
+    expired media_id are removed.
+
+    Args:
+        file_path (str): Uploaded file
+        file_size (int): Current file size
+        file_mtime (float): Current file modification time
+        chunk_size (int): Chunk size used for the upload
+
+    Returns:
+        tuple[int, str, float, set[int]]: Tuple with upload_id, twitter media_id, its
+            expiry time and the indexes of segments already uploaded. None if there's
+            nothing to resume.
+    """
+    db_connection = get_connection()
+    upload = db_connection.execute(
+        """
+        SELECT upload_id, media_id, file_size, file_mtime, chunk_size, expires_at
+        FROM uploads
+        WHERE file_path = ?
+        """,
+        (file_path,)
+    ).fetchone()
+    if upload is None:
+        return None
+    upload_id, media_id = upload[0], upload[1]
+    if upload[2:5] != (file_size, file_mtime, chunk_size) or upload[5] <= time.time():
+        with db_connection:
+            db_connection.execute("DELETE FROM upload_segments WHERE upload_id = ?", (upload_id,))
+            db_connection.execute("DELETE FROM uploads WHERE upload_id = ?", (upload_id,))
+        return None
+    segments = db_connection.execute(
+        "SELECT segment_index FROM upload_segments WHERE upload_id = ?",
+        (upload_id,)
+    )
+    return (upload_id, media_id, upload[5], {row[0] for row in segments})
+
+
+def start_upload(file_path: str, file_size: int, file_mtime: float, chunk_size: int,
+                 media_id: str, expires_at: float) -> int:
+    """Stores a new upload so it can be resumed if it's interrupted
+
+    Args:
+        file_path (str): Uploaded file
+        file_size (int): File size
+        file_mtime (float): File modification time
+        chunk_size (int): Chunk size used for the upload
+        media_id (str): Twitter media_id from INIT
+        expires_at (float): Unix time when twitter discards the media_id
+
+    Returns:
+        int: upload_id
+    """
+    db_connection = get_connection()
+    with db_connection:
+        db_connection.execute(
+            """
+            DELETE FROM upload_segments
+            WHERE upload_id IN (SELECT upload_id FROM uploads WHERE file_path = ?)
+            """,
+            (file_path,)
+        )
+        db_connection.execute("DELETE FROM uploads WHERE file_path = ?", (file_path,))
+        cursor = db_connection.execute(
+            """
+            INSERT INTO uploads(file_path, file_size, file_mtime, chunk_size, media_id, expires_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            (file_path, file_size, file_mtime, chunk_size, media_id, expires_at)
+        )
+    return cursor.lastrowid
+
+
+def add_upload_segment(upload_id: int, segment_index: int) -> None:
+    """Marks a segment of an upload as uploaded
+
+    Args:
+        upload_id (int): upload_id from start_upload
+        segment_index (int): Index of the uploaded segment
+    """
+    db_connection = get_connection()
+    with db_connection:
+        db_connection.execute(
+            "INSERT OR IGNORE INTO upload_segments(upload_id, segment_index) VALUES (?, ?)",
+            (upload_id, segment_index)
+        )
+
+
+def finish_upload(upload_id: int) -> None:
+    """Removes a finalized upload
+
+    Args:
+        upload_id (int): upload_id from start_upload
+    """
+    db_connection = get_connection()
+    with db_connection:
+        db_connection.execute("DELETE FROM upload_segments WHERE upload_id = ?", (upload_id,))
+        db_connection.execute("DELETE FROM uploads WHERE upload_id = ?", (upload_id,))
+
+
+def get_sample_media(count: int) -> list[tuple[int, str, str]]:
+    """Fetches random media for benchmarking
+
+    Args:
+        count (int): Number of media
+
+    Returns:
+        list[tuple[int, str, str]]: Tuples with database media_id, file path and media title
+    """
+    db_connection = get_connection()
+    media_result = db_connection.execute(
+        """
+        SELECT media_id, file_path, title
+        FROM media
+        WHERE missing = 0
+        ORDER BY RANDOM()
+        LIMIT ?
+        """,
+        (count,)
+    ).fetchall()
     return media_result
 
-def insert_post(twitter_response: dict, media_id: str) -> str:
+
+def insert_post(twitter_response: dict, media_id: str, account: str = None,
+                outbox_id: int = None, post_metrics: dict = None) -> str:
     """Inserts tweet into posts table
 
+    Media with the same fingerprint is marked posted too, so copies of the video in
+    other folders aren't picked again. Small files are only marked themselves.
+
     Args:
         twitter_response (dict): Response from twitter
         media_id (str): database media_id
+        account (str): Name of the account that posted
+        outbox_id (int): Outbox entry of the post, marked posted in the same transaction
+        post_metrics (dict): Timings and counters of the post. Added to the metric totals.
 
     Returns:
         str: tweet link
     """
     data = twitter_response["data"]
     link = re.search(r"https://t\.co/.+$", data["text"]).group()
-    data = (data["text"], media_id, link, data["id"])
-    db_connection = sqlite3.connect(DB_FILE)
+    encoded_metrics = json.dumps(post_metrics) if post_metrics is not None else None
+    data = (data["text"], media_id, link, data["id"], account, encoded_metrics)
+    db_connection = get_connection()
     with db_connection:
         db_connection.execute(
-            "INSERT INTO posts(post_body, media_id, link, tweet_id) VALUES (?, ?, ?, ?)",
+            """
+            INSERT INTO posts(post_body, media_id, link, tweet_id, account, metrics)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """,
             data
         )
-    db_connection.close()
+        db_connection.execute(
+            """
+            UPDATE media
+            SET posted = 1, last_posted = strftime('%Y-%m-%d %H:%M:%f', 'now'),
+                rand_key = random()
+            WHERE media_id = ? OR fingerprint = (
+                SELECT fingerprint FROM media
+                WHERE media_id = ? AND size >= ? AND fingerprint != ?
+            )
+            """,
+            (media_id, media_id, fingerprint.MIN_MATCH_SIZE, fingerprint.UNREADABLE)
+        )
+        db_connection.execute("DELETE FROM prepared WHERE media_id = ?", (media_id,))
+        if post_metrics is not None:
+            add_metric_totals(db_connection, post_metrics)
+        if outbox_id is not None:
+            db_connection.execute(
+                """
+                UPDATE outbox SET state = 'posted', last_error = NULL, updated = CURRENT_TIMESTAMP
+                WHERE outbox_id = ?
+                """,
+                (outbox_id,)
+            )
     return link
 
 
+def add_metric_totals(db_connection: sqlite3.Connection, post_metrics: dict) -> None:
+    """Adds a post's metrics to the running totals
+
+    Stage durations and counters are summed and values replace the previous post's.
+
+    Args:
+        db_connection (sqlite3.Connection): Open database connection
+        post_metrics (dict): Timings and counters of the post
+    """
+    db_connection.executemany(
+        """
+        INSERT INTO metric_totals(kind, name, total, count) VALUES (?, ?, ?, 1)
+        ON CONFLICT(kind, name) DO UPDATE SET total = total + excluded.total, count = count + 1
+        """,
+        [("stage", name, value) for name, value in post_metrics["durations"].items()]
+        + [("counter", name, value) for name, value in post_metrics["counters"].items()]
+    )
+    db_connection.execute("DELETE FROM metric_totals WHERE kind = 'value'")
+    db_connection.executemany(
+        "INSERT INTO metric_totals(kind, name, total, count) VALUES ('value', ?, ?, 1)",
+        post_metrics["values"].items()
+    )
+
+
+def get_metric_totals() -> dict:
+    """Fetches the running totals of post metrics
+
+    Returns:
+        dict: Summed stage durations with the number of posts that had the stage,
+            summed counters and the values of the latest post
+    """
+    db_connection = get_connection()
+    totals = {"stages": {}, "counters": {}, "values": {}}
+    for kind, name, total, count in db_connection.execute(
+        "SELECT kind, name, total, count FROM metric_totals"
+    ):
+        if kind == "stage":
+            totals["stages"][name] = (total, count)
+        elif kind == "counter":
+            totals["counters"][name] = total
+        else:
+            totals["values"][name] = total
+    return totals
+
+
+OUTBOX_COLUMNS = (
+    "outbox_id", "media_id", "source_path", "text", "token_file", "state", "file_path",
+    "twitter_media_id", "media_expires_at", "attempts", "last_error"
+)
+
+def add_outbox(media_id: int, source_path: str, text: str,
+               token_file: str = "token_v1.json") -> dict:
+    """Stores a new post in the outbox before any work is done for it
+
+    Args:
+        media_id (int): database media_id
+        source_path (str): Media file path
+        text (str): Tweet text
+        token_file (str): OAuth1 token file of the account to post as
+
+    Returns:
+        dict: Outbox entry
+    """
+    db_connection = get_connection()
+    with db_connection:
+        cursor = db_connection.execute(
+            "INSERT INTO outbox(media_id, source_path, text, token_file) VALUES (?, ?, ?, ?)",
+            (media_id, source_path, text, token_file)
+        )
+    entry = db_connection.execute(
+        f"SELECT {', '.join(OUTBOX_COLUMNS)} FROM outbox WHERE outbox_id = ?",
+        (cursor.lastrowid,)
+    ).fetchone()
+    return dict(zip(OUTBOX_COLUMNS, entry))
+
+
+def get_outbox(max_attempts: int) -> list[dict]:
+    """Fetches unfinished posts from the outbox, oldest first
+
+    Args:
+        max_attempts (int): Entries that have failed this many times are skipped
+
+    Returns:
+        list[dict]: Outbox entries
+    """
+    db_connection = get_connection()
+    entries = db_connection.execute(
+        f"""
+        SELECT {', '.join(OUTBOX_COLUMNS)}
+        FROM outbox
+        WHERE state NOT IN ('posted', 'failed', 'review') AND attempts < ?
+        ORDER BY outbox_id
+        """,
+        (max_attempts,)
+    ).fetchall()
+    return [dict(zip(OUTBOX_COLUMNS, entry)) for entry in entries]
+
+
+def update_outbox(outbox_id: int, state: str, **fields) -> None:
+    """Moves an outbox entry to its next stage
+
+    Args:
+        outbox_id (int): Outbox entry
+        state (str): selected, converted, uploaded, tweeting, posted, review or failed
+        **fields: Other outbox columns to set
+    """
+    fields["state"] = state
+    assignments = ", ".join(f"{column} = ?" for column in fields if column in OUTBOX_COLUMNS)
+    db_connection = get_connection()
+    with db_connection:
+        db_connection.execute(
+            f"UPDATE outbox SET {assignments}, updated = CURRENT_TIMESTAMP WHERE outbox_id = ?",
+            (*[value for column, value in fields.items() if column in OUTBOX_COLUMNS], outbox_id)
+        )
+
+
+def fail_outbox(outbox_id: int, error: str, max_attempts: int) -> None:
+    """Records a failed attempt of an outbox entry
+
+    Once the entry is marked failed its media is released from prepare, so the
+    next post doesn't pick the same prepared media again. Entries in review stay
+    in review.
+
+    Args:
+        outbox_id (int): Outbox entry
+        error (str): Error message
+        max_attempts (int): The entry is marked failed after this many attempts
+    """
+    db_connection = get_connection()
+    with db_connection:
+        db_connection.execute(
+            """
+            UPDATE outbox
+            SET attempts = attempts + 1,
+                last_error = ?,
+                state = CASE
+                    WHEN attempts + 1 >= ? AND state != 'review' THEN 'failed'
+                    ELSE state
+                END,
+                updated = CURRENT_TIMESTAMP
+            WHERE outbox_id = ?
+            """,
+            (error, max_attempts, outbox_id)
+        )
+        db_connection.execute(
+            """
+            DELETE FROM prepared
+            WHERE media_id IN (SELECT media_id FROM outbox WHERE outbox_id = ? AND state = 'failed')
+            """,
+            (outbox_id,)
+        )
+
+
+def retry_outbox(outbox_id: int) -> bool:
+    """Moves an outbox entry in review back to uploaded so its tweet is posted again
+
+    Args:
+        outbox_id (int): Outbox entry
+
+    Returns:
+        bool: False if the entry isn't in review
+    """
+    db_connection = get_connection()
+    with db_connection:
+        cursor = db_connection.execute(
+            """
+            UPDATE outbox SET state = 'uploaded', attempts = 0, updated = CURRENT_TIMESTAMP
+            WHERE outbox_id = ? AND state = 'review'
+            """,
+            (outbox_id,)
+        )
+    return cursor.rowcount > 0
+
+
 def get_posts(max_posts: int):
     """Fetches previous posts from database"""
-    db_connection = sqlite3.connect(DB_FILE)
+    db_connection = get_connection()
     posts_result = db_connection.execute(
         """
         SELECT post_id, post_body, media_id, link, tweet_id, timestamp
@@ -213,5 +1276,34 @@ def get_posts(max_posts: int):
         (max_posts,)
     )
     result = posts_result.fetchall()
-    db_connection.close()
     return result
+
+
+def get_post_metrics(max_posts: int = None) -> list[dict]:
+    """Fetches stored metrics of previous posts, oldest first
+
+    Args:
+        max_posts (int): Only the latest posts. All posts with metrics if None.
+
+    Returns:
+        list[dict]: Post metrics with post_id, tweet_id, account and timestamp added
+    """
+    db_connection = get_connection()
+    rows = db_connection.execute(
+        """
+        SELECT post_id, tweet_id, account, timestamp, metrics
+        FROM posts
+        WHERE metrics IS NOT NULL
+        ORDER BY post_id DESC
+        LIMIT ?
+        """,
+        (-1 if max_posts is None else max_posts,)
+    ).fetchall()
+    posts = []
+    for post_id, tweet_id, account, timestamp, encoded_metrics in reversed(rows):
+        post = {
+            "post_id": post_id, "tweet_id": tweet_id, "account": account, "timestamp": timestamp
+        }
+        post.update(json.loads(encoded_metrics))
+        posts.append(post)
+    return posts
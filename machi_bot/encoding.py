@@ -0,0 +1,385 @@
+"""ffmpeg encoding profiles"""
+
+import os
+import json
+import math
+import time
+import shlex
+import asyncio
+import subprocess
+from pathlib import Path
+from loguru import logger
+from . import probe
+from . import transcode_cache
+from . import metrics
+
+PROJECT_ROOT = Path(__file__).parent.parent
+CONFIG_FILE = os.path.join(PROJECT_ROOT, "config.json")
+with open(CONFIG_FILE, "r", encoding="utf-8") as file:
+    CONFIG = json.load(file)
+
+REMUX_ARGS = "-map 0:v:0 -map 0:a:0? -c copy -movflags faststart"
+# Fragments can be written to a pipe, nothing is rewritten after it's written
+FRAGMENTED_MOVFLAGS = "frag_keyframe+empty_moov+default_base_moof"
+# Room for mp4 boxes on top of the video and audio bitrate when estimating output size
+CONTAINER_OVERHEAD = 0.03
+CONTAINER_OVERHEAD_BYTES = 256 * 1024
+# Twitter rejects videos above 25 Mbps
+MAX_BITRATE = 25000
+# Streamed encodes are capped at this multiple of the source bitrate, so the size
+# announced before encoding is close to the actual size
+STREAM_BITRATE_FACTOR = 2
+DEFAULT_PROFILE = "archival"
+PROFILES = {
+    "fast": {
+        "preset": "veryfast",
+        "crf": 23,
+        "max-height": 720,
+        "max-bitrate": 5000,
+        "audio-bitrate": "128k"
+    },
+    "balanced": {
+        "preset": "medium",
+        "crf": 20,
+        "max-height": 1080,
+        "max-bitrate": 10000,
+        "audio-bitrate": "160k"
+    },
+    "archival": {
+        "preset": "slow",
+        "crf": 17,
+        "audio-bitrate": "160k"
+    }
+}
+
+def get_profiles() -> dict:
+    """Returns the built-in profiles with the ones from config added on top
+
+    Returns:
+        dict: Profile settings by profile name
+    """
+    profiles = {name: dict(settings) for name, settings in PROFILES.items()}
+    for name, settings in CONFIG.get("encoding-profiles", {}).items():
+        profiles.setdefault(name, {}).update(settings)
+    return profiles
+
+
+def get_profile(profile: str = None) -> dict:
+    """Returns the settings of an encoding profile
+
+    Args:
+        profile (str): Profile name. Defaults to encoding-profile from config.
+
+    Returns:
+        dict: Profile settings
+    """
+    if profile is None:
+        profile = CONFIG.get("encoding-profile", DEFAULT_PROFILE)
+    profiles = get_profiles()
+    if profile not in profiles:
+        raise ValueError(f"Unknown encoding profile '{profile}'. Available: {', '.join(profiles)}")
+    return profiles[profile]
+
+
+def encode_args(profile: str = None, fragmented: bool = False, max_bitrate: int = None) -> str:
+    """Builds ffmpeg arguments for an encoding profile
+
+    Profile settings are preset, crf, threads, max-height, max-bitrate (kbps) and
+    audio-bitrate. Missing settings are left to ffmpeg defaults.
+
+    Args:
+        profile (str): Profile name. Defaults to encoding-profile from config.
+        fragmented (bool): Write a fragmented mp4 that can be streamed while encoding
+        max_bitrate (int): Video bitrate limit in kbps used instead of max-bitrate
+
+    Returns:
+        str: ffmpeg output arguments
+    """
+    settings = get_profile(profile)
+
+    filters = ["pad=ceil(iw/2)*2:ceil(ih/2)*2"]
+    if settings.get("max-height"):
+        # Escaped comma keeps min() from splitting the filter chain
+        filters.insert(0, f"scale=-2:min({settings['max-height']}\\,ih)")
+    movflags = FRAGMENTED_MOVFLAGS if fragmented else "faststart"
+    args = f"-movflags {movflags} -c:v libx264 -vf '{','.join(filters)}'"
+    args += f" -preset {settings.get('preset', 'medium')} -crf {settings.get('crf', 23)}"
+    max_bitrate = max_bitrate or settings.get("max-bitrate")
+    if max_bitrate:
+        max_bitrate = min(max_bitrate, MAX_BITRATE)
+        args += f" -maxrate {max_bitrate}k -bufsize {max_bitrate * 2}k"
+    if settings.get("threads"):
+        args += f" -threads {settings['threads']}"
+    args += f" -c:a aac -b:a {settings.get('audio-bitrate', '160k')}"
+    return args
+
+
+def fits_profile(info: dict, profile: str = None) -> bool:
+    """Checks if a video is inside an encoding profile's height and bitrate limits
+
+    Args:
+        info (dict): ffprobe output of the video
+        profile (str): Profile name. Defaults to encoding-profile from config.
+
+    Returns:
+        bool: True if remuxing keeps the video inside the profile's limits. False if
+            the profile has a bitrate limit and the video's bitrate is unknown.
+    """
+    settings = get_profile(profile)
+    video = next(
+        (stream for stream in info.get("streams", []) if stream.get("codec_type") == "video"), {}
+    )
+    if settings.get("max-height") and video.get("height", 0) > settings["max-height"]:
+        return False
+    if settings.get("max-bitrate"):
+        bit_rate = probe.video_bit_rate(info)
+        if bit_rate == 0 or bit_rate > settings["max-bitrate"] * 1000:
+            return False
+    return True
+
+
+def plan_conversion(file_path: str, profile: str = None, fragmented: bool = False,
+                    info: dict = None) -> tuple[str, str, str]:
+    """Decides how a file is converted and where the output goes
+
+    Videos that are already twitter compatible H.264/AAC and inside the profile's
+    max-height and max-bitrate are only remuxed into mp4. A fragmented conversion is
+    limited to stream_bitrate and also uses a cached regular conversion of the file,
+    since it uploads just as well.
+
+    Args:
+        file_path (str): path to file
+        profile (str): Encoding profile name. Defaults to encoding-profile from config.
+        fragmented (bool): Encode to a fragmented mp4 for streaming
+        info (dict): ffprobe output of the file. Probed here if None.
+
+    Returns:
+        tuple[str, str, str]: ffmpeg arguments, output path and transcode cache key.
+            Arguments are None if a cached conversion exists, cache key is None if the
+            cache is disabled.
+    """
+    remux = CONFIG.get("remux-compatible", True)
+    if info is None and (remux or fragmented):
+        info = probe.probe(file_path)
+    args = encode_args(profile, fragmented, stream_bitrate(profile, info) if fragmented else None)
+    if remux:
+        if info is not None and probe.can_remux(info) and fits_profile(info, profile):
+            logger.info("Video is twitter compatible, copying streams without re-encoding")
+            args = REMUX_ARGS
+
+    if not transcode_cache.enabled():
+        new_filename = Path(file_path).stem + ".mp4"
+        temp_dir = PROJECT_ROOT.joinpath("video_tmp")
+        if not os.path.exists(temp_dir):
+            os.makedirs(temp_dir)
+        return (args, temp_dir.joinpath(new_filename).as_posix(), None)
+
+    cache_key = transcode_cache.cache_key(file_path, args)
+    cached_path = transcode_cache.lookup(cache_key)
+    if cached_path is None and fragmented and args != REMUX_ARGS:
+        # For example converted ahead of time by prepare
+        cached_path = transcode_cache.lookup(
+            transcode_cache.cache_key(file_path, encode_args(profile))
+        )
+    if cached_path is not None:
+        logger.success(f"Using cached conversion {cached_path}")
+        return (None, cached_path, cache_key)
+    return (args, transcode_cache.partial_path(cache_key), cache_key)
+
+
+def convert_to_mp4(file_path: str, profile: str = None, info: dict = None) -> str:
+    """Converts file from webm to mp4 using ffmpeg
+
+    If the transcode cache is enabled a previous conversion of the same file with the
+    same arguments is returned without running ffmpeg.
+
+    Args:
+        file_path (str): path to file
+        profile (str): Encoding profile name. Defaults to encoding-profile from config.
+        info (dict): ffprobe output of the file if it has been probed already
+
+    Returns:
+        str: file path of the mp4
+    """
+    if info is None and CONFIG.get("remux-compatible", True):
+        # Shared with the encode metrics
+        info = probe.probe(file_path)
+    args, file_path_new, cache_key = plan_conversion(file_path, profile, info=info)
+    if args is None:
+        metrics.set_value("transcode_cached", 1)
+        return file_path_new
+
+    logger.info("Converting video to mp4")
+    start = time.perf_counter()
+    run_ffmpeg(file_path, args, file_path_new)
+    metrics.record_encode(file_path_new, time.perf_counter() - start, info)
+
+    if cache_key is not None:
+        file_path_new = transcode_cache.store(cache_key)
+    logger.success("Conversion successful!")
+    return file_path_new
+
+
+async def convert_to_mp4_async(file_path: str, profile: str = None) -> str:
+    """Converts file from webm to mp4 without blocking the event loop
+
+    Same as convert_to_mp4 but ffmpeg runs as an asyncio subprocess.
+
+    Args:
+        file_path (str): path to file
+        profile (str): Encoding profile name. Defaults to encoding-profile from config.
+
+    Returns:
+        str: file path of the mp4
+    """
+    info = None
+    if CONFIG.get("remux-compatible", True):
+        # Shared with the encode metrics
+        info = await asyncio.to_thread(probe.probe, file_path)
+    args, file_path_new, cache_key = await asyncio.to_thread(
+        plan_conversion, file_path, profile, info=info
+    )
+    if args is None:
+        metrics.set_value("transcode_cached", 1)
+        return file_path_new
+
+    logger.info(f"Converting {file_path} to mp4")
+    ffmpeg = CONFIG.get("ffmpeg-location")
+    command = f"{ffmpeg} -y -i \"{file_path}\" {args} \"{file_path_new}\""
+    if CONFIG.get("ffmpeg-output"):
+        error_pipe = None
+    else:
+        error_pipe = asyncio.subprocess.DEVNULL
+    start = time.perf_counter()
+    process = await asyncio.create_subprocess_exec(
+        *shlex.split(command),
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=error_pipe
+    )
+    return_code = await process.wait()
+    elapsed = time.perf_counter() - start
+    if return_code != 0:
+        logger.error("Error when running ffmpeg")
+        if os.path.isfile(file_path_new):
+            logger.info(f"Removing {file_path_new}")
+            os.remove(file_path_new)
+        raise subprocess.CalledProcessError(return_code, command)
+    await asyncio.to_thread(metrics.record_encode, file_path_new, elapsed, info)
+
+    if cache_key is not None:
+        file_path_new = await asyncio.to_thread(transcode_cache.store, cache_key)
+    logger.success(f"Converted {file_path}")
+    return file_path_new
+
+
+def stream_bitrate(profile: str = None, info: dict = None) -> int:
+    """Returns the video bitrate limit of a streamed encode
+
+    The profile's max-bitrate, lowered to stream-bitrate-factor times the source's
+    bitrate if it's known. Re-encoding doesn't add detail the source doesn't have,
+    and a limit close to the actual bitrate keeps the padding of streamed uploads
+    small.
+
+    Args:
+        profile (str): Profile name. Defaults to encoding-profile from config.
+        info (dict): ffprobe output of the source
+
+    Returns:
+        int: Bitrate limit in kbps. None if the profile has no max-bitrate.
+    """
+    settings = get_profile(profile)
+    if not settings.get("max-bitrate"):
+        return None
+    max_bitrate = min(settings["max-bitrate"], MAX_BITRATE)
+    source_bitrate = probe.video_bit_rate(info) if info is not None else 0
+    if source_bitrate > 0:
+        factor = CONFIG.get("stream-bitrate-factor", STREAM_BITRATE_FACTOR)
+        max_bitrate = min(max_bitrate, math.ceil(source_bitrate / 1000 * factor))
+    return max_bitrate
+
+
+def stream_size_limit(file_path: str, profile: str = None, info: dict = None) -> int:
+    """Estimates the largest size a fragmented encode of the file can have
+
+    The estimate is stream_bitrate plus the profile's audio bitrate over the length
+    of the video, with room for the mp4 boxes.
+
+    Args:
+        file_path (str): Source video
+        profile (str): Encoding profile name. Defaults to encoding-profile from config.
+        info (dict): ffprobe output of the file. Probed here if None.
+
+    Returns:
+        int: Size limit in bytes. None if the profile has no max-bitrate or the length
+            of the video isn't known.
+    """
+    settings = get_profile(profile)
+    if not settings.get("max-bitrate"):
+        return None
+    if info is None:
+        info = probe.probe(file_path)
+    if info is None:
+        return None
+    duration = float(info.get("format", {}).get("duration", 0) or 0)
+    if duration <= 0:
+        return None
+    audio_bitrate = int(str(settings.get("audio-bitrate", "160k")).rstrip("kK"))
+    kilobits_per_second = stream_bitrate(profile, info) + audio_bitrate
+    size = kilobits_per_second * 1000 / 8 * duration * (1 + CONTAINER_OVERHEAD)
+    return int(size) + CONTAINER_OVERHEAD_BYTES
+
+
+def start_ffmpeg_stream(file_path: str, args: str) -> subprocess.Popen:
+    """Starts ffmpeg writing an mp4 to its stdout
+
+    Args:
+        file_path (str): Input file
+        args (str): ffmpeg output arguments for a fragmented mp4
+
+    Returns:
+        subprocess.Popen: ffmpeg process with the mp4 in stdout
+    """
+    ffmpeg = CONFIG.get("ffmpeg-location")
+    command = f"{ffmpeg} -y -i \"{file_path}\" {args} -f mp4 pipe:1"
+    logger.info("Running ffmpeg...")
+    if CONFIG.get("ffmpeg-output"):
+        error_pipe = None
+    else:
+        error_pipe = subprocess.DEVNULL
+    return subprocess.Popen(shlex.split(command), stdout=subprocess.PIPE, stderr=error_pipe)
+
+
+def run_ffmpeg(file_path: str, args: str, output_path: str) -> None:
+    """Runs ffmpeg and removes the output if it fails
+
+    Args:
+        file_path (str): Input file
+        args (str): ffmpeg output arguments
+        output_path (str): Output file
+
+    Raises:
+        subprocess.CalledProcessError: ffmpeg returned an error
+    """
+    ffmpeg = CONFIG.get("ffmpeg-location")
+    command = f"{ffmpeg} -y -i \"{file_path}\" {args} \"{output_path}\""
+    logger.info("Running ffmpeg...")
+    try:
+        ffmpeg_output = CONFIG.get("ffmpeg-output")
+        if ffmpeg_output:
+            error_pipe = None
+        else:
+            error_pipe = subprocess.DEVNULL
+
+        subprocess.run(
+            shlex.split(command),
+            check=True,
+            stdout=subprocess.DEVNULL,
+            stderr=error_pipe
+        )
+    except subprocess.CalledProcessError:
+        logger.error("Error when running ffmpeg")
+        # Delete the created mp4
+        if os.path.isfile(output_path):
+            logger.info(f"Removing {output_path}")
+            os.remove(output_path)
+        raise
@@ -0,0 +1,234 @@
+"""Local stand-in for the twitter endpoints the bot uses, for offline benchmarks
+
+Implements the chunked media upload (INIT, APPEND, FINALIZE, STATUS) and tweet
+creation closely enough for the bot's own code to run against it unchanged.
+Every request is delayed by a fixed latency and uploaded media reports
+processing until a processing delay has passed. Requests aren't authenticated.
+"""
+
+import json
+import math
+import time
+import itertools
+import threading
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+MEDIA_PATH = "/1.1/media/upload.json"
+TWEETS_PATH = "/2/tweets"
+
+class FakeTwitterHandler(BaseHTTPRequestHandler):
+    """Answers media upload and tweet requests from the server's state"""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args) -> None:
+        # Request logging would dominate the benchmark output
+        pass
+
+    def do_GET(self) -> None:
+        url = urlparse(self.path)
+        self.server.wait_latency()
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        if url.path != MEDIA_PATH or params.get("command") != "STATUS":
+            self.respond(404, {"errors": [{"message": "Not found"}]})
+            return
+        self.respond(*self.server.status(params.get("media_id")))
+
+    def do_POST(self) -> None:
+        url = urlparse(self.path)
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.wait_latency()
+        if url.path == TWEETS_PATH:
+            self.respond(*self.server.create_tweet(json.loads(body)))
+        elif url.path == MEDIA_PATH:
+            fields = self.form_fields(body)
+            command = fields.get("command", b"").decode()
+            if command == "INIT":
+                self.respond(*self.server.init(int(fields["total_bytes"])))
+            elif command == "APPEND":
+                self.respond(*self.server.append(
+                    fields["media_id"].decode(), int(fields["segment_index"]), fields["media"]
+                ))
+            elif command == "FINALIZE":
+                self.respond(*self.server.finalize(fields["media_id"].decode()))
+            else:
+                self.respond(400, {"errors": [{"message": f"Unknown command {command}"}]})
+        else:
+            self.respond(404, {"errors": [{"message": "Not found"}]})
+
+    def form_fields(self, body: bytes) -> dict:
+        """Parses an urlencoded or multipart form
+
+        Args:
+            body (bytes): Request body
+
+        Returns:
+            dict: Field names mapped to raw values
+        """
+        content_type = self.headers.get("Content-Type", "")
+        if not content_type.startswith("multipart/form-data"):
+            return {
+                key: values[0].encode()
+                for key, values in parse_qs(body.decode()).items()
+            }
+        message = BytesParser(policy=HTTP).parsebytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode() + body
+        )
+        return {
+            part.get_param("name", header="content-disposition"): part.get_payload(decode=True)
+            for part in message.iter_parts()
+        }
+
+    def respond(self, status: int, body: dict = None) -> None:
+        """Sends a JSON response
+
+        Args:
+            status (int): HTTP status
+            body (dict): Response body, none if None
+        """
+        data = json.dumps(body).encode() if body is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class FakeTwitter(ThreadingHTTPServer):
+    """Fake twitter API server running in a background thread
+
+    Args:
+        latency (float): Seconds every request is delayed
+        processing_delay (float): Seconds uploaded media reports processing for
+    """
+
+    daemon_threads = True
+
+    def __init__(self, latency: float = 0.05, processing_delay: float = 2) -> None:
+        super().__init__(("127.0.0.1", 0), FakeTwitterHandler)
+        self.latency = latency
+        self.processing_delay = processing_delay
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1_000_000_000)
+        self.media = {}
+        self.tweets = []
+        self.requests = 0
+        self.bytes_received = 0
+        self.thread = None
+
+    @property
+    def base_url(self) -> str:
+        """Address of the server"""
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def media_url(self) -> str:
+        """Media upload endpoint"""
+        return self.base_url + MEDIA_PATH
+
+    @property
+    def tweets_url(self) -> str:
+        """Tweet endpoint"""
+        return self.base_url + TWEETS_PATH
+
+    def start(self) -> None:
+        """Starts serving in a background thread"""
+        self.thread = threading.Thread(target=self.serve_forever, name="fake-twitter", daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        """Stops serving and closes the socket"""
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *_args) -> None:
+        self.stop()
+
+    def wait_latency(self) -> None:
+        """Counts a request and delays it by the configured latency"""
+        with self.lock:
+            self.requests += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def init(self, total_bytes: int) -> tuple[int, dict]:
+        """Starts an upload"""
+        with self.lock:
+            media_id = str(next(self.ids))
+            self.media[media_id] = {"total_bytes": total_bytes, "segments": {}, "ready_at": None}
+        return 202, {"media_id": int(media_id), "media_id_string": media_id,
+                     "expires_after_secs": 86400}
+
+    def append(self, media_id: str, segment_index: int, chunk: bytes) -> tuple[int, dict]:
+        """Stores the size of an uploaded segment"""
+        with self.lock:
+            media = self.media.get(media_id)
+            if media is None:
+                return 400, {"errors": [{"message": "Unknown media_id"}]}
+            media["segments"][segment_index] = len(chunk)
+            self.bytes_received += len(chunk)
+        return 204, None
+
+    def finalize(self, media_id: str) -> tuple[int, dict]:
+        """Checks that the announced size was uploaded and starts processing"""
+        with self.lock:
+            media = self.media.get(media_id)
+            if media is None:
+                return 400, {"errors": [{"message": "Unknown media_id"}]}
+            uploaded = sum(media["segments"].values())
+            if uploaded != media["total_bytes"]:
+                return 400, {"errors": [{
+                    "message": f"Uploaded {uploaded} bytes, expected {media['total_bytes']}"
+                }]}
+            media["ready_at"] = time.monotonic() + self.processing_delay
+        response = {"media_id": int(media_id), "media_id_string": media_id}
+        processing_info = self.processing_info(media)
+        if processing_info is not None:
+            response["processing_info"] = processing_info
+        return 201, response
+
+    def status(self, media_id: str) -> tuple[int, dict]:
+        """Returns the processing state of a finalized media"""
+        with self.lock:
+            media = self.media.get(media_id)
+        if media is None or media["ready_at"] is None:
+            return 400, {"errors": [{"message": "Unknown media_id"}]}
+        return 200, {
+            "media_id": int(media_id),
+            "processing_info": self.processing_info(media) or {"state": "succeeded"}
+        }
+
+    def processing_info(self, media: dict) -> dict:
+        """Builds processing_info like twitter does, None if nothing was processed"""
+        if self.processing_delay <= 0:
+            return None
+        remaining = media["ready_at"] - time.monotonic()
+        if remaining <= 0:
+            return {"state": "succeeded", "progress_percent": 100}
+        progress = 100 - int(100 * remaining / self.processing_delay)
+        return {
+            "state": "in_progress",
+            "check_after_secs": math.ceil(remaining),
+            "progress_percent": progress
+        }
+
+    def create_tweet(self, request_body: dict) -> tuple[int, dict]:
+        """Stores a tweet, checking that its media has been processed"""
+        with self.lock:
+            now = time.monotonic()
+            for media_id in request_body.get("media", {}).get("media_ids", []):
+                media = self.media.get(media_id)
+                if media is None or media["ready_at"] is None or media["ready_at"] > now:
+                    return 400, {"errors": [{"message": f"Media {media_id} isn't ready"}]}
+            tweet_id = str(next(self.ids))
+            self.tweets.append(request_body)
+        text = f"{request_body.get('text', '')} https://t.co/{tweet_id}"
+        return 201, {"data": {"id": tweet_id, "text": text, "edit_history_tweet_ids": [tweet_id]}}
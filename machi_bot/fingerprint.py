@@ -0,0 +1,61 @@
+"""Content fingerprints for recognizing the same video under different paths
+
+The default fingerprint hashes the file size with the first and last blocks of
+the file, which is enough to tell videos apart while reading only a small part of
+each file. With fingerprint-full-hash the whole file is hashed instead.
+Fingerprints start with the kind of hash so the two never match each other.
+"""
+
+import os
+import json
+import hashlib
+from pathlib import Path
+from loguru import logger
+
+PROJECT_ROOT = Path(__file__).parent.parent
+CONFIG_FILE = os.path.join(PROJECT_ROOT, "config.json")
+with open(CONFIG_FILE, "r", encoding="utf-8") as file:
+    CONFIG = json.load(file)
+
+# Bytes hashed from the start and the end of the file
+BLOCK_SIZE = 64 * 1024
+FULL_HASH_BLOCK_SIZE = 1024 * 1024
+PARTIAL_PREFIX = "p:"
+FULL_PREFIX = "f:"
+# Stored for files that couldn't be read, so they're only read again by a full scan
+UNREADABLE = "unreadable"
+# Smaller files aren't matched by fingerprint. Tiny files like empty placeholders
+# are often identical without being the same video.
+MIN_MATCH_SIZE = 2 * BLOCK_SIZE
+
+def prefix() -> str:
+    """Returns the prefix of fingerprints made with the configured hash"""
+    return FULL_PREFIX if CONFIG.get("fingerprint-full-hash", False) else PARTIAL_PREFIX
+
+
+def compute(file_path: str) -> str:
+    """Fingerprints a file
+
+    Args:
+        file_path (str): File path
+
+    Returns:
+        str: Fingerprint, None if the file couldn't be read
+    """
+    try:
+        with open(file_path, "rb") as media_file:
+            size = os.fstat(media_file.fileno()).st_size
+            digest = hashlib.blake2b(size.to_bytes(8, "little"), digest_size=16)
+            if prefix() == FULL_PREFIX:
+                while block := media_file.read(FULL_HASH_BLOCK_SIZE):
+                    digest.update(block)
+            else:
+                digest.update(media_file.read(BLOCK_SIZE))
+                if size > 2 * BLOCK_SIZE:
+                    media_file.seek(-BLOCK_SIZE, os.SEEK_END)
+                # Small files are hashed whole
+                digest.update(media_file.read(BLOCK_SIZE))
+    except OSError as err:
+        logger.warning(f"Couldn't fingerprint {file_path}: {err}")
+        return None
+    return prefix() + digest.hexdigest()
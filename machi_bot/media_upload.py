@@ -2,39 +2,219 @@
 
 import os
 import sys
+import json
+import math
+import mmap
+import uuid
 import time
+import struct
+import subprocess
+import random
+import threading
+import contextvars
+from pathlib import Path
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 import requests
-from requests_oauthlib import OAuth1 as oauth_helper
 from loguru import logger
-from .oauth import OAuth1
+from .oauth import get_oauth1
+from .rate_limit import get_client
+from . import database as machidb
+from . import metrics
+from . import encoding
+from . import probe
+from . import transcode_cache
+from .status_poller import StatusPoller
+
+PROJECT_ROOT = Path(__file__).parent.parent
+CONFIG_FILE = os.path.join(PROJECT_ROOT, "config.json")
+with open(CONFIG_FILE, "r", encoding="utf-8") as file:
+    CONFIG = json.load(file)
+
+MEDIA_ENDPOINT_URL = CONFIG.get(
+    "media-endpoint-url", "https://upload.twitter.com/1.1/media/upload.json"
+)
+# Twitter accepts chunks up to 5 MB
+MAX_CHUNK_SIZE = 5 * 1024 * 1024
+# Uploads aren't resumed this close to twitter expiring the media_id
+EXPIRY_MARGIN = 600
+POLLER = None
+
+class UploadError(Exception):
+    """Twitter rejected an upload request"""
+
+    def __init__(self, message: str, retryable: bool = False) -> None:
+        super().__init__(message)
+        self.retryable = retryable
+
+
+@contextmanager
+def map_segment(file_path: str, offset: int, length: int):
+    """Memory maps a part of a file
+
+    Only the part being uploaded is mapped, so memory use doesn't grow with the file
+    size and the file can still be growing.
+
+    Args:
+        file_path (str): File path
+        offset (int): Start of the part
+        length (int): Length of the part
+
+    Yields:
+        memoryview: Read only view of the part
+    """
+    # Mappings have to start at a multiple of the allocation granularity
+    start = offset - offset % mmap.ALLOCATIONGRANULARITY
+    with open(file_path, "rb") as file:
+        mapped = mmap.mmap(
+            file.fileno(), offset - start + length, offset=start, access=mmap.ACCESS_READ
+        )
+    view = memoryview(mapped)[offset - start:]
+    try:
+        yield view
+    finally:
+        view.release()
+        try:
+            mapped.close()
+        except BufferError:
+            # The http client still holds a slice, it's unmapped once that's freed
+            pass
+
+
+class MultipartBody:
+    """multipart/form-data request body that streams a file from a memoryview
+
+    requests would copy the file into a new body. This reads slices of the view
+    instead, so the data goes from the mapped file to the socket without copies.
+    """
+
+    def __init__(self, fields: dict, file_field: str, data: memoryview) -> None:
+        boundary = uuid.uuid4().hex
+        head = "".join(
+            f"--{boundary}\r\nContent-Disposition: form-data; name=\"{name}\"\r\n\r\n{value}\r\n"
+            for name, value in fields.items()
+        )
+        head += (
+            f"--{boundary}\r\nContent-Disposition: form-data; name=\"{file_field}\"; "
+            f"filename=\"{file_field}\"\r\nContent-Type: application/octet-stream\r\n\r\n"
+        )
+        tail = f"\r\n--{boundary}--\r\n"
+        self.content_type = f"multipart/form-data; boundary={boundary}"
+        self.parts = [memoryview(head.encode()), data[:], memoryview(tail.encode())]
+        self.length = sum(len(part) for part in self.parts)
+        self.position = 0
+
+    def __len__(self) -> int:
+        return self.length
+
+    def tell(self) -> int:
+        """Returns the read position"""
+        return self.position
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        """Moves the read position, used to send the body again"""
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.length
+        self.position = min(max(offset, 0), self.length)
+        return self.position
+
+    def read(self, size: int = -1) -> memoryview:
+        """Returns the next slice of the body, at most size bytes from one part
+
+        Args:
+            size (int): Maximum length, -1 for the rest of the body
+
+        Returns:
+            memoryview: Slice of the body, empty at the end
+        """
+        if size is None or size < 0:
+            # The rest of the body in one piece has to be a copy
+            chunks = []
+            while self.position < self.length:
+                chunks.append(bytes(self.read(self.length)))
+            return memoryview(b"".join(chunks))
+        part_start = 0
+        for part in self.parts:
+            if self.position < part_start + len(part):
+                start = self.position - part_start
+                data = part[start:start + size]
+                self.position += len(data)
+                return data
+            part_start += len(part)
+        return memoryview(b"")
+
+    def close(self) -> None:
+        """Releases the views so the file can be unmapped"""
+        for part in self.parts:
+            part.release()
+
+
+def get_poller() -> StatusPoller:
+    """Returns the poller shared by all uploads"""
+    global POLLER
+    if POLLER is None:
+        POLLER = StatusPoller(get_client(), MEDIA_ENDPOINT_URL)
+    return POLLER
 
-MEDIA_ENDPOINT_URL = "https://upload.twitter.com/1.1/media/upload.json"
 
 class MediaTweet:
     """Media uploading"""
 
-    def __init__(self, file_name):
+    def __init__(self, file_name, token_file: str = "token_v1.json", total_bytes: int = None):
         """Defines video tweet properties"""
         self.video_filename = file_name
-        self.total_bytes = os.path.getsize(self.video_filename)
+        if total_bytes is None:
+            file_stat = os.stat(self.video_filename)
+            self.total_bytes = file_stat.st_size
+            self.file_mtime = file_stat.st_mtime
+        else:
+            # The file is still being written
+            self.total_bytes = total_bytes
+            self.file_mtime = None
+        self.chunk_size = min(int(CONFIG.get("upload-chunk-size", 4) * 1024 * 1024), MAX_CHUNK_SIZE)
+        self.workers = max(1, CONFIG.get("upload-workers", 1))
+        self.retries = CONFIG.get("upload-retries", 5)
         self.media_id = None
+        self.expires_at = None
+        self.upload_id = None
+        self.uploaded_segments = set()
         self.processing_info = None
+        self.processing = None
+        self.client = get_client()
+        # Captured here since segment upload threads don't share the caller's context
+        self.metrics = metrics.current()
 
-        oauth = OAuth1()
-        oauth.handle_oauth1()
-
-        self.auth_session = oauth_helper(
-            client_key=oauth.twitter_api_key,
-            client_secret=oauth.twitter_api_secret,
-            resource_owner_key=oauth.oauth_token,
-            resource_owner_secret=oauth.oauth_token_secret
-        )
+        self.auth_session = get_oauth1(token_file)
 
 
     def upload_init(self):
-        """Initializes Upload"""
+        """Initializes Upload
+
+        If an earlier upload of the same file was interrupted and its media_id hasn't
+        expired, the upload continues from the segments that were already sent.
+        """
+        resumable = machidb.get_upload(
+            self.video_filename, self.total_bytes, self.file_mtime, self.chunk_size
+        )
+        if resumable is not None:
+            self.upload_id, self.media_id, self.expires_at, self.uploaded_segments = resumable
+            logger.info(
+                f"Resuming upload of {self.video_filename} with media ID {self.media_id}, "
+                f"{len(self.uploaded_segments)} segments already uploaded"
+            )
+            return
+
         logger.info(f"Starting upload of {self.video_filename}")
+        self.send_init()
+        self.upload_id = machidb.start_upload(
+            self.video_filename, self.total_bytes, self.file_mtime, self.chunk_size,
+            self.media_id, self.expires_at
+        )
 
+    def send_init(self):
+        """Sends the INIT command and stores the media_id"""
         request_data = {
         "command": "INIT",
         "media_type": "video/mp4",
@@ -42,7 +222,7 @@ class MediaTweet:
         "media_category": "tweet_video"
         }
 
-        req = requests.post(
+        req = self.client.post(
             url=MEDIA_ENDPOINT_URL,
             data=request_data,
             auth=self.auth_session,
@@ -56,142 +236,366 @@ class MediaTweet:
             raise
 
         self.media_id = str(media_id)
+        self.expires_at = time.time() + req.json().get("expires_after_secs", 86400) - EXPIRY_MARGIN
 
         logger.info(f"Media ID: {str(media_id)}")
 
     def upload_append(self):
-        """Uploads media in chunks and appends to chunks uploaded"""
-        segment_id = 0
-        bytes_sent = 0
-        # progress = 0
-        with open(self.video_filename, "rb") as file:
-            while bytes_sent < self.total_bytes:
-                # Chunk must be < 5MB
-                chunk = file.read(4*1024*1024)
-
-                request_data = {
-                "command": "APPEND",
-                "media_id": self.media_id,
-                "segment_index": segment_id
-                }
-
-                files = {
-                "media": chunk
-                }
-
-                req = requests.post(
+        """Uploads media in chunks and appends to chunks uploaded
+
+        Segments are independent of each other, so with upload-workers above 1 they're
+        sent concurrently.
+        """
+        segment_count = math.ceil(self.total_bytes / self.chunk_size)
+        segments = [
+            segment_id for segment_id in range(segment_count)
+            if segment_id not in self.uploaded_segments
+        ]
+        if self.workers == 1:
+            for segment_id in segments:
+                self.upload_segment_with_retry(segment_id)
+        else:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                # Each segment runs in a copy of this context so rate limit metrics are kept
+                futures = [
+                    executor.submit(contextvars.copy_context().run,
+                                    self.upload_segment_with_retry, segment_id)
+                    for segment_id in segments
+                ]
+                # result() re-raises the first failed segment
+                for future in futures:
+                    future.result()
+
+        logger.success("Upload chunks complete!")
+
+    def with_retry(self, description: str, function, *args):
+        """Runs an upload request, retrying network errors and server errors with
+        exponential backoff
+
+        Args:
+            description (str): Request name for logging
+            function: Function doing the request
+            *args: Arguments for function
+
+        Returns:
+            Return value of function
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                return function(*args)
+            except (requests.RequestException, UploadError) as err:
+                retryable = not isinstance(err, UploadError) or err.retryable
+                if not retryable or attempt == self.retries:
+                    raise
+                delay = 2 ** attempt + random.random()
+                self.metrics.add("upload_retries")
+                logger.warning(f"{description} failed ({err}), retrying in {delay:.1f} seconds")
+                time.sleep(delay)
+
+    def upload_segment_with_retry(self, segment_id: int):
+        """Uploads a chunk with retries and stores it as uploaded
+
+        Args:
+            segment_id (int): Index of the chunk
+        """
+        self.with_retry(f"Segment {segment_id}", self.upload_segment, segment_id)
+        machidb.add_upload_segment(self.upload_id, segment_id)
+
+    def upload_segment(self, segment_id: int):
+        """Uploads a single chunk
+
+        Args:
+            segment_id (int): Index of the chunk
+        """
+        offset = segment_id * self.chunk_size
+        length = min(self.chunk_size, self.total_bytes - offset)
+
+        request_data = {
+        "command": "APPEND",
+        "media_id": self.media_id,
+        "segment_index": segment_id
+        }
+
+        with map_segment(self.video_filename, offset, length) as chunk:
+            body = MultipartBody(request_data, "media", chunk)
+            try:
+                # Explicit content type so OAuth1 doesn't try to sign the body
+                req = self.client.post(
                     url=MEDIA_ENDPOINT_URL,
-                    data=request_data,
-                    files=files,
+                    data=body,
+                    headers={"Content-Type": body.content_type},
                     auth=self.auth_session,
                     timeout=10
                 )
+            finally:
+                body.close()
 
-                if req.status_code < 200 or req.status_code > 299:
-                    logger.error("Twitter returned an error while uploading")
-                    logger.error(f"Status: {req.status_code}, message: {req.text}")
-                    raise Exception
-
-                segment_id = segment_id + 1
-                bytes_sent = file.tell()
+        if req.status_code < 200 or req.status_code > 299:
+            logger.error("Twitter returned an error while uploading")
+            logger.error(f"Status: {req.status_code}, message: {req.text}")
+            raise UploadError(
+                f"Uploading segment {segment_id} failed with status {req.status_code}",
+                retryable=req.status_code == 429 or req.status_code >= 500
+            )
+        self.count_uploaded(length)
 
-                # Print progress
-                # progress = round((bytes_sent / self.total_bytes) * 100, 2)
-                # sys.stdout.write(f"\rUploading {progress}..")
-                # sys.stdout.flush()
+    def count_uploaded(self, length: int):
+        """Adds an uploaded chunk to the post's metrics
 
-        # sys.stdout.write("\n")
-        logger.success("Upload chunks complete!")
+        Args:
+            length (int): Bytes in the chunk
+        """
+        self.metrics.add("bytes_uploaded", length)
 
 
     def upload_finalize(self):
-        """Finalizes uploads and starts video processing"""
+        """Finalizes uploads and starts tracking video processing
+
+        Network and server errors are retried. Processing is tracked by the shared
+        status poller, use wait_for_processing to block until it's done.
+        """
+        self.with_retry("Finalize", self.send_finalize)
+        self.processing = get_poller().watch(
+            self.media_id,
+            self.processing_info,
+            self.auth_session,
+            CONFIG.get("processing-timeout", 600)
+        )
+
+    def send_finalize(self):
+        """Sends the FINALIZE command"""
         request_data = {
         "command": "FINALIZE",
         "media_id": self.media_id
         }
 
-        req = requests.post(
+        req = self.client.post(
             url=MEDIA_ENDPOINT_URL,
             data=request_data,
             auth=self.auth_session,
             timeout=10
         )
 
-        self.processing_info = req.json().get("processing_info", None)
-        if self.processing_info is None:
+        if req.status_code < 200 or req.status_code > 299:
             logger.warning("Unexpected finalize response")
-            logger.warning(req.json())
-            raise Exception("Unexpected finalize response")
-        self.check_status()
+            logger.warning(req.text)
+            raise UploadError(
+                f"Finalize failed with status {req.status_code}",
+                retryable=req.status_code == 429 or req.status_code >= 500
+            )
+        # Without processing_info the media is ready to use
+        self.processing_info = req.json().get("processing_info", None)
 
 
-    def check_status(self):
-        """Checks video processing status"""
-        state = self.processing_info["state"]
+    def wait_for_processing(self):
+        """Blocks until twitter has processed the media
 
-        logger.info(f"Media processing state: {state}")
+        Raises:
+            ProcessingError: Processing failed or didn't finish before processing-timeout
+        """
+        self.processing_info = self.processing.result()
 
-        if state == "succeeded":
-            return
+def upload_media(file_path, remove_file: bool = True,
+                 token_file: str = "token_v1.json") -> tuple[str, float]:
+    """Uploads file found in the path argument
 
-        if state == "failed":
-            logger.error("Media processing failed")
-            logger.info(f"Processing info: {self.processing_info}")
-            raise Exception("Media processing failed")
+    Upload progress is stored in the database. If the upload fails the file is kept so
+    the next upload of it can resume where this one stopped.
 
-        if "error" in self.processing_info:
-            logger.error("Error uploading media")
-            logger.info(f"Processing info: {self.processing_info}")
-            raise Exception("Upload error")
+    Args:
+        file_path (str): Path to file
+        remove_file (bool): Delete the file after the upload has been finalized
+        token_file (str): OAuth1 token file of the account to upload as
 
-        check_after_secs = self.processing_info["check_after_secs"]
+    Returns:
+        tuple[str, float]: Uploaded file media id and the time it expires at
+    """
+    tweet = MediaTweet(file_path, token_file)
+    with metrics.timer("upload_init"):
+        tweet.upload_init()
+    with metrics.timer("upload_append"):
+        tweet.upload_append()
+    with metrics.timer("upload_finalize"):
+        tweet.upload_finalize()
+    with metrics.timer("processing"):
+        tweet.wait_for_processing()
+    machidb.finish_upload(tweet.upload_id)
+
+    # Delete the created mp4
+    if remove_file:
+        logger.info(f"Removing {file_path}")
+        os.remove(file_path)
 
-        logger.info(f"Checking after {str(check_after_secs)} seconds")
-        time.sleep(check_after_secs + 1)
+    logger.success("Upload successful!")
+    logger.success(f"Media id: {tweet.media_id}")
 
-        request_params = {
-            "command": "STATUS",
-            "media_id": self.media_id
-        }
+    return (tweet.media_id, tweet.expires_at)
 
-        req = requests.get(
-            url=MEDIA_ENDPOINT_URL,
-            params=request_params,
-            auth=self.auth_session,
-            timeout=10
-        )
 
-        self.processing_info = req.json().get("processing_info", None)
-        self.check_status()
+class StreamingMediaTweet(MediaTweet):
+    """Uploads a video while ffmpeg is still encoding it
 
-def upload_media(file_path) -> str:
-    """Uploads file found in the path argument
+    total_bytes is an estimated size limit that INIT announces. ffmpeg writes a
+    fragmented mp4 to a pipe that is copied to the spool file, and every chunk is
+    uploaded as soon as it's complete. The finished file is padded to the announced
+    size with an mp4 free box, which players skip. Streamed uploads aren't resumed.
+    Sent bytes count as bytes_uploaded only if the whole video is uploaded, a stream
+    given up for a normal upload counts them as bytes_wasted.
+    """
+
+    def __init__(self, file_name, token_file: str = "token_v1.json", total_bytes: int = None):
+        super().__init__(file_name, token_file, total_bytes)
+        self.sent_bytes = 0
+        self.sent_lock = threading.Lock()
+
+    def upload_init(self):
+        """Initializes the upload with the size limit"""
+        logger.info(f"Starting streamed upload of {self.video_filename}")
+        self.send_init()
+
+    def upload_segment_with_retry(self, segment_id: int):
+        """Uploads a chunk with retries"""
+        self.with_retry(f"Segment {segment_id}", self.upload_segment, segment_id)
+
+    def count_uploaded(self, length: int):
+        """Counts a sent chunk until it's known if the stream is used"""
+        with self.sent_lock:
+            self.sent_bytes += length
+
+    def upload_stream(self, process: subprocess.Popen) -> bool:
+        """Copies ffmpeg output to the spool file and uploads chunks as they complete
+
+        Args:
+            process (subprocess.Popen): ffmpeg writing the mp4 to stdout
+
+        Returns:
+            bool: True if the whole video was uploaded. False if the video didn't fit
+                the size limit, the spool file then has the whole video.
+
+        Raises:
+            subprocess.CalledProcessError: ffmpeg returned an error
+        """
+        written = 0
+        fits = True
+        uploaded = False
+        futures = []
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                def submit(segment_id: int) -> None:
+                    futures.append(executor.submit(
+                        contextvars.copy_context().run, self.upload_segment_with_retry, segment_id
+                    ))
+
+                with open(self.video_filename, "wb") as spool:
+                    while True:
+                        # Read up to the next chunk boundary so full chunks are sent right away
+                        data = process.stdout.read(self.chunk_size - written % self.chunk_size)
+                        if not data:
+                            break
+                        spool.write(data)
+                        written += len(data)
+                        if written > self.total_bytes:
+                            # Keep copying so the file can be uploaded normally
+                            fits = False
+                        if fits and written % self.chunk_size == 0:
+                            spool.flush()
+                            submit(written // self.chunk_size - 1)
+
+                    return_code = process.wait()
+                    padding = self.total_bytes - written
+                    if return_code == 0 and fits and 0 < padding < 8:
+                        # Too small for a free box
+                        fits = False
+                    if return_code == 0 and fits and padding > 0:
+                        spool.write(struct.pack(">I4s", padding, b"free"))
+                        spool.write(bytes(padding - 8))
+
+                if return_code != 0 or not fits:
+                    for future in futures:
+                        future.cancel()
+                    if return_code != 0:
+                        logger.error("Error when running ffmpeg")
+                        os.remove(self.video_filename)
+                        raise subprocess.CalledProcessError(return_code, process.args)
+                    logger.warning(
+                        f"Encoded video is larger than the estimated {self.total_bytes} bytes"
+                    )
+                    return False
+
+                segment_count = math.ceil(self.total_bytes / self.chunk_size)
+                for segment_id in range(written // self.chunk_size, segment_count):
+                    submit(segment_id)
+                # result() re-raises the first failed segment
+                for future in futures:
+                    future.result()
+                uploaded = True
+        finally:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            # Leaving the executor waited for chunks still being sent
+            self.metrics.add("bytes_uploaded" if uploaded else "bytes_wasted", self.sent_bytes)
+
+        self.metrics.add("stream_padding_bytes", padding)
+        logger.success(f"Streamed {written} bytes with {padding} bytes of padding")
+        return True
+
+
+def stream_media(file_path: str, profile: str = None,
+                 token_file: str = "token_v1.json") -> tuple[str, str, float]:
+    """Converts a video and uploads it at the same time
+
+    Streaming needs a size limit known before encoding, so the encoding profile must
+    have max-bitrate, otherwise a warning is logged. A cached conversion is returned
+    for a normal upload, and videos that are only remuxed or whose size can't be
+    estimated are converted normally. If the encoded video turns out larger than the
+    estimate it's left for a normal upload. The source is probed once for all of these.
 
     Args:
-        file_path (str): Path to file
+        file_path (str): Source video
+        profile (str): Encoding profile name
+        token_file (str): OAuth1 token file of the account to upload as
 
     Returns:
-        str: Uploaded file media id
+        tuple[str, str, float]: Converted file, uploaded media id and the time it
+            expires at. Media id and expiry are None if the file still needs uploading.
     """
-    tweet = MediaTweet(file_path)
-    try:
+    info = probe.probe(file_path)
+    args, output_path, cache_key = encoding.plan_conversion(
+        file_path, profile, fragmented=True, info=info
+    )
+    if args is None:
+        metrics.set_value("transcode_cached", 1)
+        return (output_path, None, None)
+    size_limit = None
+    if args != encoding.REMUX_ARGS:
+        if encoding.stream_bitrate(profile) is None:
+            logger.warning(
+                "stream-upload needs an encoding profile with max-bitrate, "
+                "converting and uploading normally"
+            )
+        size_limit = encoding.stream_size_limit(file_path, profile, info)
+    if size_limit is None:
+        with metrics.timer("convert"):
+            return (encoding.convert_to_mp4(file_path, profile, info), None, None)
+
+    tweet = StreamingMediaTweet(output_path, token_file, total_bytes=size_limit)
+    with metrics.timer("upload_init"):
         tweet.upload_init()
-        tweet.upload_append()
-        try:
-            tweet.upload_finalize()
-        except Exception:
-            logger.info("Retrying finalize in 5 seconds")
-            time.sleep(5)
-            tweet.upload_finalize()
-    except Exception:
-        raise
-    finally:
-        # Delete the created mp4
-        logger.info(f"Removing {file_path}")
-        os.remove(file_path)
-
+    logger.info("Converting video to mp4 while uploading")
+    start = time.perf_counter()
+    with metrics.timer("stream"):
+        uploaded = tweet.upload_stream(encoding.start_ffmpeg_stream(file_path, args))
+    metrics.record_encode(output_path, time.perf_counter() - start, info)
+    if cache_key is not None:
+        output_path = transcode_cache.store(cache_key)
+    if not uploaded:
+        return (output_path, None, None)
+
+    with metrics.timer("upload_finalize"):
+        tweet.upload_finalize()
+    with metrics.timer("processing"):
+        tweet.wait_for_processing()
     logger.success("Upload successful!")
     logger.success(f"Media id: {tweet.media_id}")
-
-    return tweet.media_id
+    return (output_path, tweet.media_id, tweet.expires_at)
@@ -0,0 +1,202 @@
+"""Timings and counters collected while making a post
+
+A post's metrics are collected in a PostMetrics object that is active for the
+current thread or asyncio task through a context variable, so the modules doing the
+work only call the functions here. Outside a post the metrics go nowhere.
+Finished metrics are stored with the post and can be exported as Prometheus text
+or JSON lines.
+"""
+
+import os
+import time
+import json
+import threading
+import contextvars
+from contextlib import contextmanager
+from pathlib import Path
+from . import probe
+
+PROJECT_ROOT = Path(__file__).parent.parent
+CONFIG_FILE = os.path.join(PROJECT_ROOT, "config.json")
+with open(CONFIG_FILE, "r", encoding="utf-8") as file:
+    CONFIG = json.load(file)
+
+CURRENT = contextvars.ContextVar("post_metrics", default=None)
+
+class PostMetrics:
+    """Stage durations, counters and values of one post"""
+
+    def __init__(self) -> None:
+        self.started = time.perf_counter()
+        self.durations = {}
+        self.counters = {}
+        self.values = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def timer(self, name: str):
+        """Adds the time spent in the block to a duration"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.durations[name] = self.durations.get(name, 0) + elapsed
+
+    def add(self, name: str, amount: float = 1) -> None:
+        """Increments a counter"""
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def set(self, name: str, value: float) -> None:
+        """Sets a value"""
+        with self.lock:
+            self.values[name] = value
+
+    def to_dict(self) -> dict:
+        """Returns the metrics with total time since the post started
+
+        Returns:
+            dict: Durations in seconds, counters and values
+        """
+        with self.lock:
+            durations = {name: round(value, 4) for name, value in self.durations.items()}
+            durations["total"] = round(time.perf_counter() - self.started, 4)
+            return {
+                "durations": durations,
+                "counters": dict(self.counters),
+                "values": dict(self.values)
+            }
+
+
+@contextmanager
+def collect(post_metrics: PostMetrics = None):
+    """Makes metrics current for the block
+
+    Args:
+        post_metrics (PostMetrics): Metrics of a post already in progress. New metrics
+            are created if None.
+
+    Yields:
+        PostMetrics: The current metrics
+    """
+    if post_metrics is None:
+        post_metrics = PostMetrics()
+    token = CURRENT.set(post_metrics)
+    try:
+        yield post_metrics
+    finally:
+        CURRENT.reset(token)
+
+
+def current() -> PostMetrics:
+    """Returns the current post's metrics, or throwaway metrics outside a post"""
+    return CURRENT.get() or PostMetrics()
+
+
+def timer(name: str):
+    """Times a block into the current post's metrics"""
+    return current().timer(name)
+
+
+def add(name: str, amount: float = 1) -> None:
+    """Increments a counter of the current post"""
+    current().add(name, amount)
+
+
+def set_value(name: str, value: float) -> None:
+    """Sets a value of the current post"""
+    current().set(name, value)
+
+
+def record_encode(output_path: str, elapsed: float, info: dict = None) -> None:
+    """Records encode speed from the converted video
+
+    Args:
+        output_path (str): Converted video
+        elapsed (float): Seconds ffmpeg ran
+        info (dict): ffprobe output of the source video. The converted video is
+            probed if None, both have the same length and frame rate.
+    """
+    if CURRENT.get() is None:
+        # Not part of a post, don't spend an ffprobe run on it
+        return
+    if info is None:
+        info = probe.probe(output_path)
+    if info is None or elapsed <= 0:
+        return
+    duration = float(info.get("format", {}).get("duration", 0) or 0)
+    video = next((s for s in info.get("streams", []) if s.get("codec_type") == "video"), {})
+    frames = duration * probe.frame_rate(video)
+    set_value("encode_fps", round(frames / elapsed, 2))
+    set_value("encode_realtime_factor", round(duration / elapsed, 3))
+    set_value("video_seconds", round(duration, 3))
+
+
+def prometheus_text(totals: dict) -> str:
+    """Formats post metric totals in the Prometheus text format
+
+    Durations and counters are sums over all posts. Values are gauges from the
+    latest post.
+
+    Args:
+        totals (dict): Totals from get_metric_totals
+
+    Returns:
+        str: Metrics in the Prometheus exposition format
+    """
+    stages = totals["stages"]
+    # Every post has a total duration
+    post_count = stages.get("total", (0, 0))[1]
+    lines = [
+        "# HELP machi_bot_posts_total Posts with stored metrics",
+        "# TYPE machi_bot_posts_total counter",
+        f"machi_bot_posts_total {post_count}",
+        "# HELP machi_bot_stage_seconds Time spent in each stage of a post",
+        "# TYPE machi_bot_stage_seconds summary"
+    ]
+    for stage in sorted(stages):
+        seconds, count = stages[stage]
+        lines.append(f'machi_bot_stage_seconds_sum{{stage="{stage}"}} {seconds:.4f}')
+        lines.append(f'machi_bot_stage_seconds_count{{stage="{stage}"}} {count}')
+    for name, value in sorted(totals["counters"].items()):
+        lines.append(f"# TYPE machi_bot_{name}_total counter")
+        lines.append(f"machi_bot_{name}_total {value}")
+    for name, value in sorted(totals["values"].items()):
+        lines.append(f"# TYPE machi_bot_last_post_{name} gauge")
+        lines.append(f"machi_bot_last_post_{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def json_lines(posts: list[dict]) -> str:
+    """Formats stored post metrics as one JSON object per line
+
+    Args:
+        posts (list[dict]): Post metrics
+
+    Returns:
+        str: JSON lines
+    """
+    return "".join(json.dumps(post) + "\n" for post in posts)
+
+
+def write_exports(post: dict, totals: dict) -> None:
+    """Writes metrics files for dashboards after a post
+
+    The post is appended to metrics-jsonl and metrics-prometheus is rewritten with
+    the totals over all posts, for example for node_exporter's textfile collector.
+
+    Args:
+        post (dict): Metrics of the new post
+        totals (dict): Totals over all posts from get_metric_totals
+    """
+    if CONFIG.get("metrics-jsonl"):
+        with open(CONFIG["metrics-jsonl"], "a", encoding="utf-8") as jsonl_file:
+            jsonl_file.write(json_lines([post]))
+    if CONFIG.get("metrics-prometheus"):
+        # Replaced in one step so the collector never reads a half written file
+        temp_path = CONFIG["metrics-prometheus"] + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as prometheus_file:
+            prometheus_file.write(prometheus_text(totals))
+        os.replace(temp_path, CONFIG["metrics-prometheus"])
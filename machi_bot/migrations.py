@@ -0,0 +1,296 @@
+"""Versioned database schema migrations
+
+The schema version is stored in PRAGMA user_version. Each migration brings the
+database from the previous version to the next one in place, so schema changes
+never need the media table to be dropped and the library scanned again.
+Databases created before versioning start at version 0 and may already have
+some of the changes, so the early migrations check before adding columns.
+"""
+
+import os
+import json
+import sqlite3
+from loguru import logger
+
+def column_exists(db_connection: sqlite3.Connection, table: str, column: str) -> bool:
+    """Checks if a table has a column
+
+    Args:
+        db_connection (sqlite3.Connection): Open database connection
+        table (str): Table name
+        column (str): Column name
+
+    Returns:
+        bool: True if the column exists
+    """
+    return any(row[1] == column for row in db_connection.execute(f"PRAGMA table_info({table})"))
+
+
+def add_column(db_connection: sqlite3.Connection, table: str, column: str, definition: str) -> bool:
+    """Adds a column unless an unversioned database already has it
+
+    Args:
+        db_connection (sqlite3.Connection): Open database connection
+        table (str): Table name
+        column (str): Column name
+        definition (str): Column type and constraints
+
+    Returns:
+        bool: True if the column was added
+    """
+    if column_exists(db_connection, table, column):
+        return False
+    db_connection.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+    return True
+
+
+def create_base_tables(db_connection: sqlite3.Connection) -> None:
+    """Creates the original media and posts tables"""
+    db_connection.execute("""
+        CREATE TABLE IF NOT EXISTS media(
+            media_id INTEGER PRIMARY KEY,
+            title NVARCHAR NOT NULL,
+            file_path NVARCHAR UNIQUE NOT NULL,
+            added TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    db_connection.execute("""
+        CREATE TABLE IF NOT EXISTS posts(
+            post_id INTEGER PRIMARY KEY,
+            post_body TEXT NOT NULL,
+            media_id INTEGER,
+            link TEXT NOT NULL,
+            tweet_id TEXT NOT NULL,
+            timestamp TEXT DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY(media_id) REFERENCES media(media_id) ON DELETE SET NULL
+        )
+    """)
+
+
+def add_scan_columns(db_connection: sqlite3.Connection) -> None:
+    """Adds the change detection columns and the directories table used by scan"""
+    if add_column(db_connection, "media", "directory", "NVARCHAR"):
+        # Directory can't be derived in SQL so fill it for existing rows here
+        rows = db_connection.execute("SELECT media_id, file_path FROM media").fetchall()
+        db_connection.executemany(
+            "UPDATE media SET directory = ? WHERE media_id = ?",
+            [(os.path.dirname(file_path), media_id) for media_id, file_path in rows]
+        )
+    add_column(db_connection, "media", "size", "INTEGER")
+    add_column(db_connection, "media", "mtime", "REAL")
+    db_connection.execute("CREATE INDEX IF NOT EXISTS media_directory ON media(directory)")
+    db_connection.execute("""
+        CREATE TABLE IF NOT EXISTS directories(
+            path NVARCHAR PRIMARY KEY,
+            mtime REAL NOT NULL
+        )
+    """)
+
+
+def add_posted_columns(db_connection: sqlite3.Connection) -> None:
+    """Adds the posted flag so selection doesn't have to look at posts"""
+    add_column(db_connection, "media", "posted", "INTEGER NOT NULL DEFAULT 0")
+    add_column(db_connection, "media", "last_posted", "TEXT")
+    # Mark media that already has posts
+    db_connection.execute("""
+        UPDATE media
+        SET posted = 1,
+            last_posted = (SELECT MAX(timestamp) FROM posts p WHERE p.media_id = media.media_id)
+        WHERE media_id IN (SELECT media_id FROM posts)
+    """)
+    db_connection.execute("CREATE INDEX IF NOT EXISTS media_unposted ON media(posted, media_id)")
+    db_connection.execute("CREATE INDEX IF NOT EXISTS media_last_posted ON media(last_posted)")
+    db_connection.execute("CREATE INDEX IF NOT EXISTS posts_media_id ON posts(media_id)")
+    db_connection.execute("CREATE INDEX IF NOT EXISTS posts_timestamp ON posts(timestamp)")
+
+
+def create_prepare_tables(db_connection: sqlite3.Connection) -> None:
+    """Creates the tables for media prepared ahead of time and resumable uploads"""
+    db_connection.execute("""
+        CREATE TABLE IF NOT EXISTS prepared(
+            media_id INTEGER PRIMARY KEY,
+            reserved TEXT DEFAULT CURRENT_TIMESTAMP,
+            ready INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    db_connection.execute("""
+        CREATE TABLE IF NOT EXISTS uploads(
+            upload_id INTEGER PRIMARY KEY,
+            file_path NVARCHAR UNIQUE NOT NULL,
+            file_size INTEGER NOT NULL,
+            file_mtime REAL NOT NULL,
+            chunk_size INTEGER NOT NULL,
+            media_id TEXT NOT NULL,
+            expires_at REAL NOT NULL,
+            created TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    db_connection.execute("""
+        CREATE TABLE IF NOT EXISTS upload_segments(
+            upload_id INTEGER NOT NULL,
+            segment_index INTEGER NOT NULL,
+            PRIMARY KEY(upload_id, segment_index),
+            FOREIGN KEY(upload_id) REFERENCES uploads(upload_id) ON DELETE CASCADE
+        )
+    """)
+
+
+def add_post_accounts(db_connection: sqlite3.Connection) -> None:
+    """Adds the account that made each post"""
+    add_column(db_connection, "posts", "account", "TEXT")
+
+
+def create_outbox(db_connection: sqlite3.Connection) -> None:
+    """Creates the outbox for resuming failed posts"""
+    db_connection.execute("""
+        CREATE TABLE IF NOT EXISTS outbox(
+            outbox_id INTEGER PRIMARY KEY,
+            media_id INTEGER NOT NULL,
+            source_path NVARCHAR NOT NULL,
+            text TEXT NOT NULL,
+            token_file TEXT NOT NULL,
+            state TEXT NOT NULL DEFAULT 'selected',
+            file_path NVARCHAR,
+            twitter_media_id TEXT,
+            media_expires_at REAL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            created TEXT DEFAULT CURRENT_TIMESTAMP,
+            updated TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    db_connection.execute("CREATE INDEX IF NOT EXISTS outbox_state ON outbox(state)")
+
+
+def add_missing_column(db_connection: sqlite3.Connection) -> None:
+    """Adds the missing flag set by reconcile for files that aren't on disk"""
+    db_connection.execute("ALTER TABLE media ADD COLUMN missing INTEGER NOT NULL DEFAULT 0")
+    # Selection only looks at media that isn't missing
+    db_connection.execute("DROP INDEX IF EXISTS media_unposted")
+    db_connection.execute("DROP INDEX IF EXISTS media_last_posted")
+    db_connection.execute("CREATE INDEX media_unposted ON media(missing, posted, media_id)")
+    db_connection.execute("CREATE INDEX media_last_posted ON media(missing, last_posted)")
+
+
+def add_post_metrics(db_connection: sqlite3.Connection) -> None:
+    """Adds stage timings and counters of each post as JSON"""
+    db_connection.execute("ALTER TABLE posts ADD COLUMN metrics TEXT")
+
+
+def add_fingerprints(db_connection: sqlite3.Connection) -> None:
+    """Adds content fingerprints for finding moved and duplicate files"""
+    db_connection.execute("ALTER TABLE media ADD COLUMN fingerprint TEXT")
+    # Moved files are matched to missing media
+    db_connection.execute("CREATE INDEX media_fingerprint ON media(fingerprint, missing)")
+
+
+def add_random_keys(db_connection: sqlite3.Connection) -> None:
+    """Adds a random key to each media for picking random unposted media"""
+    db_connection.execute("ALTER TABLE media ADD COLUMN rand_key INTEGER NOT NULL DEFAULT 0")
+    db_connection.execute("UPDATE media SET rand_key = random()")
+    # Replaces probing media_ids, which favoured media right after posted ones
+    db_connection.execute("DROP INDEX IF EXISTS media_unposted")
+    db_connection.execute("CREATE INDEX media_random ON media(missing, posted, rand_key)")
+
+
+def create_metric_totals(db_connection: sqlite3.Connection) -> None:
+    """Creates running totals of post metrics for the Prometheus export"""
+    # kind is stage, counter or value. Untyped so summed integers stay integers.
+    db_connection.execute("""
+        CREATE TABLE metric_totals(
+            kind TEXT NOT NULL,
+            name TEXT NOT NULL,
+            total NOT NULL DEFAULT 0,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY(kind, name)
+        )
+    """)
+    totals = {}
+    latest_values = {}
+    rows = db_connection.execute(
+        "SELECT metrics FROM posts WHERE metrics IS NOT NULL ORDER BY post_id"
+    )
+    for (encoded_metrics,) in rows:
+        post_metrics = json.loads(encoded_metrics)
+        for kind, section in (("stage", "durations"), ("counter", "counters")):
+            for name, value in post_metrics[section].items():
+                total, count = totals.get((kind, name), (0, 0))
+                totals[(kind, name)] = (total + value, count + 1)
+        latest_values = post_metrics["values"]
+    for name, value in latest_values.items():
+        totals[("value", name)] = (value, 1)
+    db_connection.executemany(
+        "INSERT INTO metric_totals(kind, name, total, count) VALUES (?, ?, ?, ?)",
+        [(kind, name, total, count) for (kind, name), (total, count) in totals.items()]
+    )
+
+
+def add_prepared_foreign_key(db_connection: sqlite3.Connection) -> None:
+    """Deletes reservations together with their media"""
+    # sqlite can't add a foreign key to a table, so it's created again
+    db_connection.execute("""
+        CREATE TABLE prepared_new(
+            media_id INTEGER PRIMARY KEY,
+            reserved TEXT DEFAULT CURRENT_TIMESTAMP,
+            ready INTEGER NOT NULL DEFAULT 0,
+            FOREIGN KEY(media_id) REFERENCES media(media_id) ON DELETE CASCADE
+        )
+    """)
+    # Reservations of media that was already deleted are dropped
+    db_connection.execute("""
+        INSERT INTO prepared_new(media_id, reserved, ready)
+        SELECT media_id, reserved, ready FROM prepared
+        WHERE media_id IN (SELECT media_id FROM media)
+    """)
+    db_connection.execute("DROP TABLE prepared")
+    db_connection.execute("ALTER TABLE prepared_new RENAME TO prepared")
+
+
+# Migration n brings the database to version n. Only append to this list.
+MIGRATIONS = [
+    create_base_tables,
+    add_scan_columns,
+    add_posted_columns,
+    create_prepare_tables,
+    add_post_accounts,
+    create_outbox,
+    add_missing_column,
+    add_post_metrics,
+    add_fingerprints,
+    add_random_keys,
+    create_metric_totals,
+    add_prepared_foreign_key
+]
+
+def schema_version(db_connection: sqlite3.Connection) -> int:
+    """Returns the database schema version"""
+    return db_connection.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(db_connection: sqlite3.Connection) -> None:
+    """Runs the migrations the database hasn't had yet
+
+    Each migration runs in its own transaction together with the version bump, so
+    an interrupted migration is run again from the start next time.
+
+    Args:
+        db_connection (sqlite3.Connection): Open database connection
+
+    Raises:
+        RuntimeError: The database was created by a newer version of the bot
+    """
+    version = schema_version(db_connection)
+    if version > len(MIGRATIONS):
+        raise RuntimeError(
+            f"Database schema version {version} is newer than this bot supports ({len(MIGRATIONS)})"
+        )
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        logger.info(f"Migrating database to version {number}: {migration.__doc__}")
+        db_connection.execute("BEGIN")
+        try:
+            migration(db_connection)
+            db_connection.execute(f"PRAGMA user_version = {number}")
+            db_connection.commit()
+        except:
+            db_connection.rollback()
+            raise
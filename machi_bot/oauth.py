@@ -6,9 +6,13 @@ import hashlib
 import re
 import json
 import time
+import threading
 from urllib.parse import urlparse, parse_qs
+import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 from requests_oauthlib import OAuth2Session, OAuth1Session
+from requests_oauthlib import OAuth1 as oauth_helper
 from dotenv import load_dotenv
 from loguru import logger
 from pathlib import Path
@@ -16,12 +20,22 @@ from pathlib import Path
 project_root = Path(__file__).parent.parent
 dotenv_path = os.path.join(project_root, ".env")
 load_dotenv(dotenv_path)
+config_file = os.path.join(project_root, "config.json")
+with open(config_file, "r", encoding="utf-8") as file:
+    CONFIG = json.load(file)
+
+# Refresh OAuth2 tokens this many seconds before they expire
+REFRESH_MARGIN = 300
+OAUTH2_REDIRECT_URI = "https://localhost"
+OAUTH2_SCOPES = ["tweet.read", "tweet.write", "users.read", "offline.access"]
+OAUTH2_TOKEN_URL = "https://api.twitter.com/2/oauth2/token"
 
 class OAuth1:
     """Class for twitter OAuth1 handling"""
-    def __init__(self) -> None:
+    def __init__(self, token_file: str = "token_v1.json") -> None:
         self.twitter_api_key = os.environ.get("TWITTER_API_KEY")
         self.twitter_api_secret = os.environ.get("TWITTER_API_SECRET")
+        self.token_file = token_file
         self.oauth_token = None
         self.oauth_token_secret = None
 
@@ -31,7 +45,7 @@ class OAuth1:
 
         try:
             # Try to open the token file
-            with open("token_v1.json", "r", encoding="utf-8") as file:
+            with open(self.token_file, "r", encoding="utf-8") as file:
                 token_file = json.load(file)
 
             access_token = token_file
@@ -80,7 +94,7 @@ class OAuth1:
             access_token = oauth_token_session.fetch_access_token(access_token_url)
 
             # Write the token to file
-            with open("token_v1.json", "w+", encoding="utf-8") as file:
+            with open(self.token_file, "w+", encoding="utf-8") as file:
                 file.write(json.dumps(access_token, indent=4))
 
             logger.success("Authorization complete!")
@@ -96,14 +110,43 @@ class OAuth2:
         self.twitter_client_id = os.environ.get("TWITTER_CLIENT_ID")
         self.twitter_client_secret = os.environ.get("TWITTER_CLIENT_SECRET")
 
+    def refresh(self, previous_token: dict) -> dict:
+        """Refreshes an OAuth2 token and writes it to the token file
+
+        Args:
+            previous_token (dict): Token with refresh_token
+
+        Returns:
+            dict: New token
+        """
+        logger.info("Refreshing token")
+        oauth = OAuth2Session(
+            client_id=self.twitter_client_id,
+            token=previous_token,
+            redirect_uri=OAUTH2_REDIRECT_URI,
+            scope=OAUTH2_SCOPES,
+            state=hashlib.sha256(os.urandom(1024)).hexdigest()
+        )
+        auth = HTTPBasicAuth(self.twitter_client_id, self.twitter_client_secret)
+        response = oauth.refresh_token(
+            client_id=self.twitter_client_id,
+            client_secret=self.twitter_client_secret,
+            token_url=OAUTH2_TOKEN_URL,
+            auth=auth,
+            refresh_token=previous_token["refresh_token"]
+        )
+        with open("token_v2.json", "w+", encoding="utf-8") as file:
+            file.write(json.dumps(response, indent=4))
+        return response
+
     def handle_oauth2(self) -> dict:
         """Fetch and return the access token for user authenticated requests using OAuth2"""
 
         # This must match *exactly* the redirect URL specified in the Developer Portal.
-        redirect_uri = "https://localhost"
+        redirect_uri = OAUTH2_REDIRECT_URI
 
         # Set the scopes needed to be granted by the authenticating user.
-        scopes = ["tweet.read", "tweet.write", "users.read", "offline.access"]
+        scopes = OAUTH2_SCOPES
 
         # Create a code verifier
         code_verifier = base64.urlsafe_b64encode(os.urandom(30)).decode("utf-8")
@@ -117,7 +160,7 @@ class OAuth2:
         # State should be stored somewhere so it can be later validated
         state = hashlib.sha256(os.urandom(1024)).hexdigest()
 
-        token_url = "https://api.twitter.com/2/oauth2/token"
+        token_url = OAUTH2_TOKEN_URL
 
         try:
             # Try to open the token file
@@ -128,28 +171,10 @@ class OAuth2:
             # If token has expired refresh it
             # Subtract 5 minutes from expiration to account for clock skew
             now = time.time()
-            expire_time = previous_token["expires_at"] - 300
+            expire_time = previous_token["expires_at"] - REFRESH_MARGIN
             if now >= expire_time:
-                logger.info("Refreshing token")
-                oauth = OAuth2Session(
-                    client_id=self.twitter_client_id,
-                    token=previous_token,
-                    redirect_uri=redirect_uri,
-                    scope=scopes,
-                    state=state
-                )
-                auth = HTTPBasicAuth(self.twitter_client_id, self.twitter_client_secret)
-                response = oauth.refresh_token(
-                    client_id=self.twitter_client_id,
-                    client_secret=self.twitter_client_secret,
-                    token_url=token_url,
-                    auth=auth,
-                    refresh_token=previous_token["refresh_token"]
-                )
-
+                response = self.refresh(previous_token)
                 access_token = response["access_token"]
-                with open("token_v2.json", "w+", encoding="utf-8") as file:
-                    file.write(json.dumps(response, indent=4))
             else:
                 access_token = previous_token["access_token"]
 
@@ -190,3 +215,112 @@ class OAuth2:
             access_token = response["access_token"]
 
         return access_token
+
+
+class CredentialProvider:
+    """Shares credentials and connections for the lifetime of the process
+
+    OAuth1 token files are read once and the signing helper is reused until the
+    file changes. All requests go through one pooled requests.Session.
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.oauth1_auth = {}
+        self.oauth2_token = None
+        self.oauth2_timer = None
+        pool_size = max(10, CONFIG.get("upload-workers", 1))
+        self.session = requests.Session()
+        self.session.mount(
+            "https://", HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        )
+
+    def get_oauth1(self, token_file: str = "token_v1.json") -> oauth_helper:
+        """Returns the OAuth1 signing helper for a token file
+
+        Args:
+            token_file (str): OAuth1 token file
+
+        Returns:
+            requests_oauthlib.OAuth1: Auth for requests
+        """
+        with self.lock:
+            mtime = token_mtime(token_file)
+            cached = self.oauth1_auth.get(token_file)
+            if cached is not None and cached[0] == mtime:
+                return cached[1]
+
+            oauth = OAuth1(token_file)
+            oauth.handle_oauth1()
+            auth = oauth_helper(
+                client_key=oauth.twitter_api_key,
+                client_secret=oauth.twitter_api_secret,
+                resource_owner_key=oauth.oauth_token,
+                resource_owner_secret=oauth.oauth_token_secret
+            )
+            # Authorization may have just created the file
+            self.oauth1_auth[token_file] = (token_mtime(token_file), auth)
+            return auth
+
+    def get_oauth2(self) -> str:
+        """Returns the OAuth2 access token
+
+        The first call loads or authorizes the token. After that the token is
+        refreshed in the background before it expires.
+
+        Returns:
+            str: Access token
+        """
+        with self.lock:
+            if self.oauth2_token is None:
+                OAuth2().handle_oauth2()
+                with open("token_v2.json", "r", encoding="utf-8") as file:
+                    self.oauth2_token = json.load(file)
+                self.schedule_refresh()
+            return self.oauth2_token["access_token"]
+
+    def schedule_refresh(self) -> None:
+        """Starts a timer that refreshes the OAuth2 token before it expires"""
+        delay = max(0, self.oauth2_token["expires_at"] - REFRESH_MARGIN - time.time())
+        self.oauth2_timer = threading.Timer(delay, self.refresh_oauth2)
+        self.oauth2_timer.daemon = True
+        self.oauth2_timer.start()
+
+    def refresh_oauth2(self) -> None:
+        """Refreshes the OAuth2 token. Retried after a minute if it fails."""
+        try:
+            token = OAuth2().refresh(self.oauth2_token)
+        except Exception:
+            logger.exception("Refreshing OAuth2 token failed, retrying in 60 seconds")
+            self.oauth2_timer = threading.Timer(60, self.refresh_oauth2)
+            self.oauth2_timer.daemon = True
+            self.oauth2_timer.start()
+            return
+        with self.lock:
+            self.oauth2_token = token
+            self.schedule_refresh()
+
+
+def token_mtime(token_file: str) -> int:
+    """Returns token file modification time or None if it doesn't exist"""
+    try:
+        return os.stat(token_file).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+CREDENTIALS = CredentialProvider()
+
+def get_oauth1(token_file: str = "token_v1.json") -> oauth_helper:
+    """Returns the cached OAuth1 signing helper for a token file"""
+    return CREDENTIALS.get_oauth1(token_file)
+
+
+def get_oauth2() -> str:
+    """Returns the OAuth2 access token, refreshed in the background"""
+    return CREDENTIALS.get_oauth2()
+
+
+def get_session() -> requests.Session:
+    """Returns the pooled session shared by all twitter requests"""
+    return CREDENTIALS.session
@@ -0,0 +1,237 @@
+"""Asyncio posting pipeline for posting from several accounts in one process
+
+Posting is split into stages connected by queues: select, convert, upload and tweet.
+Each stage has its own number of workers, so one account's upload or twitter's
+processing doesn't hold back the others. ffmpeg runs as an asyncio subprocess and
+the blocking requests and sqlite calls run in the default thread pool. Every post
+goes through the outbox like a single post, so a failed one is continued by
+drain_outbox.
+"""
+
+import os
+import json
+import asyncio
+from pathlib import Path
+import requests
+from loguru import logger
+from . import create_tweet
+from . import media_upload
+from . import database as machidb
+from . import encoding
+from . import transcode_cache
+from . import metrics
+from .rate_limit import RateLimitError
+
+PROJECT_ROOT = Path(__file__).parent.parent
+CONFIG_FILE = os.path.join(PROJECT_ROOT, "config.json")
+with open(CONFIG_FILE, "r", encoding="utf-8") as file:
+    CONFIG = json.load(file)
+
+# Selection retries when another account already picked the same media
+SELECT_ATTEMPTS = 5
+
+def get_accounts() -> list[dict]:
+    """Returns accounts from config
+
+    Without an accounts section the default token_v1.json account is used.
+
+    Returns:
+        list[dict]: Accounts with name, token-file and optional text
+    """
+    accounts = CONFIG.get("accounts")
+    if not accounts:
+        return [{"name": "default", "token-file": "token_v1.json"}]
+    for account in accounts:
+        account.setdefault("token-file", "token_v1.json")
+    return accounts
+
+
+class PostPipeline:
+    """Moves posts through select, convert, upload and tweet stages"""
+
+    def __init__(self, profile: str = None) -> None:
+        self.profile = profile
+        self.claimed = set()
+        self.select_queue = asyncio.Queue()
+        self.convert_queue = asyncio.Queue()
+        self.upload_queue = asyncio.Queue()
+        self.tweet_queue = asyncio.Queue()
+        self.results = []
+
+    async def select(self, job: dict) -> bool:
+        """Picks media for a post. Runs in a single worker so picks don't overlap."""
+        with metrics.timer("select"):
+            return await self.select_media(job)
+
+    async def select_media(self, job: dict) -> bool:
+        """Picks prepared media first, then unposted media no other account has claimed"""
+        media = None
+        prepared = await asyncio.to_thread(machidb.get_prepared)
+        if prepared is not None and prepared[0] not in self.claimed:
+            media = prepared
+        for _ in range(SELECT_ATTEMPTS):
+            if media is not None:
+                break
+            try:
+                candidate = await asyncio.to_thread(machidb.get_media, None)
+            except SystemExit:
+                # get_media exits when the library is empty
+                break
+            if candidate[0] not in self.claimed:
+                media = candidate
+        if media is None:
+            logger.error(f"{job['account']['name']}: no unclaimed media found")
+            return False
+        self.claimed.add(media[0])
+        account = job["account"]
+        logger.info(f"{account['name']}: media fetched {media[1]}")
+        text = job["text"] or account.get("text") or media[2]
+        job["entry"] = await asyncio.to_thread(
+            machidb.add_outbox, media[0], media[1], text, account["token-file"]
+        )
+        return True
+
+    async def convert(self, job: dict) -> bool:
+        """Converts the media to mp4"""
+        entry = job["entry"]
+        with metrics.timer("convert"):
+            entry["file_path"] = await encoding.convert_to_mp4_async(
+                entry["source_path"], self.profile
+            )
+        await asyncio.to_thread(
+            machidb.update_outbox, entry["outbox_id"], "converted", file_path=entry["file_path"]
+        )
+        return True
+
+    async def upload(self, job: dict) -> bool:
+        """Uploads the mp4 and waits for twitter to process it without blocking other posts"""
+        entry = job["entry"]
+        tweet = await asyncio.to_thread(
+            media_upload.MediaTweet, entry["file_path"], entry["token_file"]
+        )
+        with metrics.timer("upload_init"):
+            await asyncio.to_thread(tweet.upload_init)
+        with metrics.timer("upload_append"):
+            await asyncio.to_thread(tweet.upload_append)
+        with metrics.timer("upload_finalize"):
+            await asyncio.to_thread(tweet.upload_finalize)
+        with metrics.timer("processing"):
+            tweet.processing_info = await asyncio.wrap_future(tweet.processing)
+        await asyncio.to_thread(machidb.finish_upload, tweet.upload_id)
+        entry["twitter_media_id"], entry["media_expires_at"] = tweet.media_id, tweet.expires_at
+        await asyncio.to_thread(
+            machidb.update_outbox, entry["outbox_id"], "uploaded",
+            twitter_media_id=entry["twitter_media_id"],
+            media_expires_at=entry["media_expires_at"]
+        )
+        return True
+
+    async def tweet(self, job: dict) -> bool:
+        """Posts the tweet and stores it"""
+        account = job["account"]
+        entry = job["entry"]
+        with metrics.timer("tweet"):
+            response = await asyncio.to_thread(create_tweet.post_outbox_tweet, entry)
+        post_metrics = metrics.current().to_dict()
+        link = await asyncio.to_thread(
+            machidb.insert_post, response.json(), entry["media_id"], account["name"],
+            outbox_id=entry["outbox_id"], post_metrics=post_metrics
+        )
+        # The file is kept until the tweet is posted so drain_outbox can upload it again
+        if not transcode_cache.contains(entry["file_path"]):
+            os.remove(entry["file_path"])
+        totals = await asyncio.to_thread(machidb.get_metric_totals)
+        metrics.write_exports(
+            {"tweet_id": response.json()["data"]["id"], "account": account["name"], **post_metrics},
+            totals
+        )
+        webhook_url = account.get("discord-webhook-url", CONFIG.get("discord-webhook-url"))
+        if webhook_url:
+            await asyncio.to_thread(
+                requests.post, webhook_url, data={"content": link}, timeout=10
+            )
+        job["link"] = link
+        return True
+
+    async def stage(self, name: str, handler, inbox: asyncio.Queue, outbox: asyncio.Queue) -> None:
+        """Worker loop passing jobs from inbox through handler to outbox"""
+        while True:
+            job = await inbox.get()
+            try:
+                with metrics.collect(job["metrics"]):
+                    success = await handler(job)
+                if success:
+                    if outbox is None:
+                        self.results.append(job)
+                    else:
+                        await outbox.put(job)
+            except RateLimitError as err:
+                # Not an attempt of the post, drain_outbox continues it after the reset
+                logger.warning(f"{job['account']['name']}: {name} postponed: {err}")
+            except Exception as err:
+                logger.exception(f"{job['account']['name']}: {name} failed")
+                if "entry" in job:
+                    await self.fail(job, str(err))
+            finally:
+                inbox.task_done()
+
+    async def fail(self, job: dict, error: str) -> None:
+        """Records a failed attempt in the outbox so drain_outbox can continue the post"""
+        try:
+            await asyncio.to_thread(
+                machidb.fail_outbox, job["entry"]["outbox_id"], error,
+                CONFIG.get("outbox-max-attempts", 5)
+            )
+        except Exception:
+            # A dead worker would leave its queue waiting forever
+            logger.exception(f"{job['account']['name']}: couldn't record failure in outbox")
+
+    async def run(self, accounts: list[dict], text: str = "") -> list[dict]:
+        """Makes one post from each account
+
+        Args:
+            accounts (list[dict]): Accounts to post from
+            text (str): Text for every tweet. Account text or media title is used if empty.
+
+        Returns:
+            list[dict]: Finished posts
+        """
+        convert_workers = CONFIG.get("pipeline-convert-workers", 1)
+        stages = [
+            ("select", self.select, self.select_queue, self.convert_queue, 1),
+            ("convert", self.convert, self.convert_queue, self.upload_queue, convert_workers),
+            ("upload", self.upload, self.upload_queue, self.tweet_queue, len(accounts)),
+            ("tweet", self.tweet, self.tweet_queue, None, len(accounts))
+        ]
+        workers = [
+            asyncio.create_task(self.stage(name, handler, inbox, outbox))
+            for name, handler, inbox, outbox, count in stages
+            for _ in range(count)
+        ]
+
+        for account in accounts:
+            await self.select_queue.put(
+                {"account": account, "text": text, "metrics": metrics.PostMetrics()}
+            )
+
+        for queue in (self.select_queue, self.convert_queue, self.upload_queue, self.tweet_queue):
+            await queue.join()
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+        logger.info(f"Posted {len(self.results)}/{len(accounts)} accounts")
+        return self.results
+
+
+def post_all(text: str = "", profile: str = None) -> list[dict]:
+    """Makes one post from every configured account concurrently
+
+    Args:
+        text (str): Text for every tweet. Account text or media title is used if empty.
+        profile (str): Encoding profile name
+
+    Returns:
+        list[dict]: Finished posts
+    """
+    return asyncio.run(PostPipeline(profile).run(get_accounts(), text))
@@ -0,0 +1,209 @@
+"""Posting tweets through the outbox"""
+import os
+import json
+import time
+import requests
+from pathlib import Path
+from loguru import logger
+from . import create_tweet
+from . import media_upload
+from . import database as machidb
+from . import transcode_cache
+from . import metrics
+from .encoding import convert_to_mp4
+from .rate_limit import RateLimitError
+
+PROJECT_ROOT = Path(__file__).parent.parent
+CONFIG_FILE = os.path.join(PROJECT_ROOT, "config.json")
+with open(CONFIG_FILE, "r", encoding="utf-8") as file:
+    CONFIG = json.load(file)
+
+def create_post(text: str, media_path: str, profile: str = None,
+                token_file: str = "token_v1.json") -> None:
+    """Main function for posting tweets
+
+    The post is stored in the outbox before any work is done and each finished stage
+    is recorded, so a failed post can be continued later with drain_outbox. Without
+    media_path an unfinished post in the outbox is completed first instead of
+    starting a new one.
+
+    Args:
+        text (str): Text to tweet
+        media_path (str): Media filepath
+        profile (str): Encoding profile name
+        token_file (str): OAuth1 token file of the account to post as
+
+    Raises:
+        RateLimitError: A rate limit doesn't reset in time. The post stays in the outbox.
+    """
+    if not media_path and drain_outbox(profile, limit=1) > 0:
+        return
+
+    with metrics.collect():
+        # Select file
+        with metrics.timer("select"):
+            media_id, source_path, title = get_file(media_path)
+        if len(text) == 0: text = title
+        entry = machidb.add_outbox(media_id, source_path, text, token_file)
+        process_outbox(entry, profile)
+
+def process_outbox(entry: dict, profile: str = None) -> bool:
+    """Continues an outbox post from its last finished stage
+
+    Stages are selected, converted, uploaded and posted. A converted file that's gone
+    is converted again and an uploaded media_id that has expired is uploaded again.
+    A post interrupted while tweeting isn't tweeted again but moved to review.
+    Timings go to the current metrics and are stored with the post. A rate limit that
+    doesn't reset in time doesn't count as a failed attempt, the entry stays at its
+    last finished stage.
+
+    Args:
+        entry (dict): Outbox entry
+        profile (str): Encoding profile name
+
+    Raises:
+        RateLimitError: A rate limit doesn't reset in time
+
+    Returns:
+        bool: True if the tweet was posted
+    """
+    outbox_id = entry["outbox_id"]
+    state = entry["state"]
+    if state == "tweeting":
+        # The last attempt stopped after sending the tweet, so it may have been posted
+        logger.error(
+            f"Post {outbox_id} may have been tweeted, check it and use --retry-post {outbox_id}"
+        )
+        machidb.update_outbox(outbox_id, "review")
+        return False
+    try:
+        if state == "uploaded" and entry["media_expires_at"] <= time.time():
+            logger.info(f"Uploaded media {entry['twitter_media_id']} has expired")
+            state = "converted"
+        if state == "converted" and not os.path.exists(entry["file_path"]):
+            logger.info(f"Converted file is gone ({entry['file_path']})")
+            state = "selected"
+
+        if state == "selected" and CONFIG.get("stream-upload", False):
+            # Falls back to only converting if the video can't be streamed
+            entry["file_path"], entry["twitter_media_id"], entry["media_expires_at"] = (
+                media_upload.stream_media(entry["source_path"], profile, entry["token_file"])
+            )
+            state = "converted" if entry["twitter_media_id"] is None else "uploaded"
+            machidb.update_outbox(
+                outbox_id, state,
+                file_path=entry["file_path"],
+                twitter_media_id=entry["twitter_media_id"],
+                media_expires_at=entry["media_expires_at"]
+            )
+
+        if state == "selected":
+            with metrics.timer("convert"):
+                entry["file_path"] = convert_to_mp4(entry["source_path"], profile)
+            state = "converted"
+            machidb.update_outbox(outbox_id, state, file_path=entry["file_path"])
+
+        if state == "converted":
+            # The file is kept until the tweet is posted so a failed post can upload it again
+            entry["twitter_media_id"], entry["media_expires_at"] = media_upload.upload_media(
+                entry["file_path"], remove_file=False, token_file=entry["token_file"]
+            )
+            state = "uploaded"
+            machidb.update_outbox(
+                outbox_id, state,
+                twitter_media_id=entry["twitter_media_id"],
+                media_expires_at=entry["media_expires_at"]
+            )
+
+        # Create the tweet
+        with metrics.timer("tweet"):
+            response = create_tweet.post_outbox_tweet(entry)
+    except RateLimitError as err:
+        logger.warning(f"Post {outbox_id} postponed at stage {state}: {err}")
+        raise
+    except (Exception, SystemExit) as err:
+        logger.error(f"Post {outbox_id} failed at stage {state}: {err}")
+        machidb.fail_outbox(outbox_id, str(err), CONFIG.get("outbox-max-attempts", 5))
+        return False
+
+    # Insert post to db
+    post_metrics = metrics.current().to_dict()
+    link = machidb.insert_post(
+        response.json(), entry["media_id"], outbox_id=outbox_id, post_metrics=post_metrics
+    )
+    metrics.write_exports(
+        {"tweet_id": response.json()["data"]["id"], **post_metrics},
+        machidb.get_metric_totals()
+    )
+
+    # Cached conversions are kept for reposts
+    if entry["file_path"] and not transcode_cache.contains(entry["file_path"]):
+        logger.info(f"Removing {entry['file_path']}")
+        os.remove(entry["file_path"])
+
+    if CONFIG.get("discord-webhook-url"):
+        post_to_discord(link)
+    return True
+
+def drain_outbox(profile: str = None, limit: int = None) -> int:
+    """Retries unfinished posts in the outbox
+
+    Args:
+        profile (str): Encoding profile name
+        limit (int): Stop after this many posts have been made
+
+    Raises:
+        RateLimitError: A rate limit doesn't reset in time. The rest of the posts are
+            left for the next drain.
+
+    Returns:
+        int: Number of posts made
+    """
+    entries = machidb.get_outbox(CONFIG.get("outbox-max-attempts", 5))
+    posted = 0
+    for entry in entries:
+        if limit is not None and posted >= limit:
+            break
+        logger.info(f"Continuing post {entry['outbox_id']} from stage {entry['state']}")
+        with metrics.collect():
+            success = process_outbox(entry, profile)
+        if success:
+            posted += 1
+    return posted
+
+def post_to_discord(content: str) -> None:
+    """Post message to discord webhook
+
+    Args:
+        content (str): message content
+    """
+    payload = {"content": content}
+    requests.request(
+        method="POST",
+        url=CONFIG.get("discord-webhook-url"),
+        data=payload,
+        timeout=10
+    )
+
+
+def get_file(media_path: str) -> tuple[int, str, str]:
+    """Fetches media file from database
+
+    Args:
+        media_path (str): File path
+
+    Returns:
+        tuple[int, str, str]: Tuple with database media_id, file path and media title
+    """
+    media = None
+    if not media_path:
+        # Use media converted ahead of time by prepare if there is any
+        media = machidb.get_prepared()
+        if media is not None and not os.path.exists(media[1]):
+            logger.error(f"Prepared media not on disk anymore ({media[1]})")
+            machidb.release_media(media[0])
+            media = None
+    if media is None:
+        media = machidb.get_media(media_path)
+    logger.info(f"Media fetched: {media[1]}")
+    return media
@@ -0,0 +1,136 @@
+"""Reads video properties with ffprobe"""
+
+import os
+import json
+import subprocess
+from pathlib import Path
+from loguru import logger
+
+PROJECT_ROOT = Path(__file__).parent.parent
+CONFIG_FILE = os.path.join(PROJECT_ROOT, "config.json")
+with open(CONFIG_FILE, "r", encoding="utf-8") as file:
+    CONFIG = json.load(file)
+
+# Twitter video requirements
+MAX_WIDTH = 1920
+MAX_HEIGHT = 1200
+MAX_FRAME_RATE = 60
+MAX_DURATION = 140
+MAX_BIT_RATE = 25_000_000
+VIDEO_PROFILES = ["Baseline", "Constrained Baseline", "Main", "High"]
+REMUX_CONTAINERS = ["mp4", "mov", "matroska"]
+
+def ffprobe_location() -> str:
+    """Returns ffprobe path from config or guesses it from the ffmpeg path"""
+    if CONFIG.get("ffprobe-location"):
+        return CONFIG.get("ffprobe-location")
+    ffmpeg = Path(CONFIG.get("ffmpeg-location"))
+    return ffmpeg.with_name(ffmpeg.name.replace("ffmpeg", "ffprobe")).as_posix()
+
+
+def probe(file_path: str) -> dict:
+    """Reads container and stream information of a video
+
+    Args:
+        file_path (str): Path to video
+
+    Returns:
+        dict: ffprobe output with format and streams. None if probing failed.
+    """
+    command = [
+        ffprobe_location(), "-v", "error",
+        "-show_format", "-show_streams",
+        "-of", "json",
+        file_path
+    ]
+    try:
+        result = subprocess.run(command, check=True, capture_output=True)
+        return json.loads(result.stdout)
+    except (OSError, subprocess.CalledProcessError, json.JSONDecodeError) as err:
+        logger.warning(f"Probing {file_path} failed: {err}")
+        return None
+
+
+def frame_rate(stream: dict) -> float:
+    """Parses a stream's average frame rate
+
+    Args:
+        stream (dict): ffprobe stream
+
+    Returns:
+        float: Frames per second, 0 if unknown
+    """
+    numerator, _, denominator = stream.get("avg_frame_rate", "0/0").partition("/")
+    try:
+        return float(numerator) / float(denominator or 1)
+    except (ValueError, ZeroDivisionError):
+        return 0
+
+
+def video_bit_rate(info: dict) -> int:
+    """Reads a video's bitrate
+
+    The video stream's bitrate is used if the container has it, otherwise the
+    overall bitrate, which includes audio.
+
+    Args:
+        info (dict): ffprobe output from probe()
+
+    Returns:
+        int: Bits per second, 0 if unknown
+    """
+    for stream in info.get("streams", []):
+        if stream.get("codec_type") == "video" and stream.get("bit_rate"):
+            return int(stream["bit_rate"])
+    return int(info.get("format", {}).get("bit_rate", 0))
+
+
+def can_remux(info: dict) -> bool:
+    """Checks if a video can be posted to twitter without re-encoding
+
+    The video has to be H.264 yuv420p with even dimensions inside twitter's limits and
+    the audio AAC-LC mono or stereo, or missing.
+
+    Args:
+        info (dict): ffprobe output from probe()
+
+    Returns:
+        bool: True if copying the streams into an mp4 is enough
+    """
+    media_format = info.get("format", {})
+    containers = media_format.get("format_name", "").split(",")
+    if not any(container in REMUX_CONTAINERS for container in containers):
+        return False
+    if float(media_format.get("duration", 0)) > MAX_DURATION:
+        return False
+    if int(media_format.get("bit_rate", 0)) > MAX_BIT_RATE:
+        return False
+
+    streams = info.get("streams", [])
+    video = [stream for stream in streams if stream.get("codec_type") == "video"]
+    audio = [stream for stream in streams if stream.get("codec_type") == "audio"]
+    if len(video) != 1 or len(audio) > 1:
+        return False
+
+    video = video[0]
+    if video.get("codec_name") != "h264" or video.get("pix_fmt") != "yuv420p":
+        return False
+    if video.get("profile") not in VIDEO_PROFILES:
+        return False
+    width = video.get("width", 0)
+    height = video.get("height", 0)
+    if width % 2 or height % 2:
+        return False
+    if max(width, height) > MAX_WIDTH or min(width, height) > MAX_HEIGHT:
+        return False
+    if not 0 < frame_rate(video) <= MAX_FRAME_RATE:
+        return False
+
+    if audio:
+        audio = audio[0]
+        if audio.get("codec_name") != "aac" or audio.get("profile") != "LC":
+            return False
+        if audio.get("channels", 0) > 2:
+            return False
+
+    return True
@@ -0,0 +1,241 @@
+"""Request layer that keeps twitter requests inside their rate limits"""
+
+import os
+import json
+import time
+import threading
+from pathlib import Path
+from urllib.parse import urlparse
+import requests
+from loguru import logger
+from .oauth import get_session
+from . import metrics
+
+PROJECT_ROOT = Path(__file__).parent.parent
+CONFIG_FILE = os.path.join(PROJECT_ROOT, "config.json")
+with open(CONFIG_FILE, "r", encoding="utf-8") as file:
+    CONFIG = json.load(file)
+STATE_FILE = Path(CONFIG.get("appdata")).joinpath("rate_limits.json")
+
+# Requests are spread out evenly once less than this share of the budget is left
+PACING_THRESHOLD = 0.1
+# Wait used for a 429 without a reset header
+DEFAULT_RESET_WAIT = 60
+
+class RateLimitError(Exception):
+    """Rate limit won't reset within the allowed wait time
+
+    Args:
+        message (str): Error message
+        wait (float): Seconds until the limit resets
+    """
+
+    def __init__(self, message: str, wait: float) -> None:
+        super().__init__(message)
+        self.wait = wait
+
+
+class RateLimitedClient:
+    """Sends requests through a shared session while tracking rate limit budgets
+
+    Budgets are read from the x-rate-limit-limit, x-rate-limit-remaining and
+    x-rate-limit-reset headers and tracked per account and endpoint. A request
+    to an exhausted endpoint waits for the reset instead of failing, and requests
+    are paced when the budget runs low. A 429 waits for the reset and retries.
+    """
+
+    def __init__(self, session: requests.Session) -> None:
+        self.session = session
+        self.lock = threading.RLock()
+        self.budgets = {}
+        self.last_request = {}
+        self.max_wait = CONFIG.get("rate-limit-max-wait", 900)
+        self.retries = CONFIG.get("rate-limit-retries", 3)
+
+    def request(self, method: str, url: str, block: bool = True, **kwargs) -> requests.Response:
+        """Sends a request once the endpoint has budget left
+
+        Args:
+            method (str): HTTP method
+            url (str): Request URL
+            block (bool): Wait for the budget. If False RateLimitError is raised instead,
+                for callers that can do something else until the reset.
+            **kwargs: Arguments for requests.Session.request
+
+        Raises:
+            RateLimitError: The limit doesn't reset within rate-limit-max-wait seconds,
+                or the request would have to wait and block is False
+
+        Returns:
+            requests.Response: Response
+        """
+        key = budget_key(method, url, kwargs.get("auth"))
+        for attempt in range(self.retries + 1):
+            if attempt > 0 and hasattr(kwargs.get("data"), "seek"):
+                # A streamed body was read by the previous attempt
+                kwargs["data"].seek(0)
+            self.wait_for_budget(key, block)
+            response = self.session.request(method, url, **kwargs)
+            self.update(key, response)
+            if response.status_code != 429:
+                return response
+            metrics.add("rate_limited")
+            logger.warning(f"Rate limited on {key[1]} {key[2]}")
+        return response
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        """Sends a GET request"""
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        """Sends a POST request"""
+        return self.request("POST", url, **kwargs)
+
+    def wait_time(self, key: tuple) -> float:
+        """Returns seconds until a request to the endpoint fits in its budget
+
+        Args:
+            key (tuple): Budget key from budget_key
+
+        Returns:
+            float: Seconds to wait, 0 if the request can be sent now
+        """
+        with self.lock:
+            budget = self.budgets.get(key)
+            if budget is None:
+                return 0
+            now = time.time()
+            until_reset = budget["reset"] - now
+            if until_reset <= 0:
+                return 0
+            if budget["remaining"] <= 0:
+                return until_reset
+            if budget["remaining"] < budget["limit"] * PACING_THRESHOLD:
+                interval = until_reset / budget["remaining"]
+                return max(0, self.last_request.get(key, 0) + interval - now)
+            return 0
+
+    def endpoint_wait(self, method: str, url: str, auth=None) -> float:
+        """Returns seconds until a request to the endpoint fits in its budget
+
+        Args:
+            method (str): HTTP method
+            url (str): Request URL
+            auth: requests auth of the account
+
+        Returns:
+            float: Seconds to wait, 0 if the request can be sent now
+        """
+        return self.wait_time(budget_key(method, url, auth))
+
+    def wait_for_budget(self, key: tuple, block: bool = True) -> None:
+        """Blocks until the endpoint has budget left
+
+        Args:
+            key (tuple): Budget key from budget_key
+            block (bool): Raise RateLimitError instead of waiting
+        """
+        delay = self.wait_time(key)
+        if delay > self.max_wait or (delay > 0 and not block):
+            raise RateLimitError(
+                f"{key[1]} {key[2]} rate limit resets in {delay:.0f} seconds", delay
+            )
+        if delay > 0:
+            logger.info(f"Waiting {delay:.0f} seconds for {key[1]} {key[2]} rate limit")
+            with metrics.timer("rate_limit_wait"):
+                time.sleep(delay)
+        with self.lock:
+            self.last_request[key] = time.time()
+
+    def update(self, key: tuple, response: requests.Response) -> None:
+        """Reads rate limit headers from a response
+
+        Args:
+            key (tuple): Budget key from budget_key
+            response (requests.Response): Response
+        """
+        headers = response.headers
+        with self.lock:
+            if "x-rate-limit-remaining" in headers:
+                default_reset = time.time() + DEFAULT_RESET_WAIT
+                budget = {
+                    "limit": int(headers.get("x-rate-limit-limit", 0)),
+                    "remaining": int(headers["x-rate-limit-remaining"]),
+                    "reset": int(headers.get("x-rate-limit-reset", default_reset))
+                }
+            elif response.status_code == 429:
+                budget = dict(self.budgets.get(key, {"limit": 0, "remaining": 0, "reset": 0}))
+                budget["reset"] = time.time() + DEFAULT_RESET_WAIT
+            else:
+                return
+            if response.status_code == 429:
+                budget["remaining"] = 0
+            if budget == self.budgets.get(key):
+                return
+            self.budgets[key] = budget
+            self.save_state()
+
+    def budget_state(self) -> dict:
+        """Returns the current budgets
+
+        Returns:
+            dict: Budgets by account and endpoint with limit, remaining and reset time
+        """
+        with self.lock:
+            state = {}
+            for (account, method, path), budget in self.budgets.items():
+                state.setdefault(account, {})[f"{method} {path}"] = dict(budget)
+            return state
+
+    def save_state(self) -> None:
+        """Writes the budgets to rate_limits.json in appdata for other processes
+
+        The state is written to a temporary file that replaces the old one, so a
+        reader never sees a half written file.
+        """
+        temp_path = STATE_FILE.with_name(f"{STATE_FILE.name}.{os.getpid()}.tmp")
+        with self.lock:
+            try:
+                with open(temp_path, "w", encoding="utf-8") as state_file:
+                    json.dump(self.budget_state(), state_file, indent=4)
+                os.replace(temp_path, STATE_FILE)
+            except OSError as err:
+                logger.warning(f"Couldn't write rate limit state: {err}")
+
+
+def budget_key(method: str, url: str, auth) -> tuple:
+    """Creates the key a request's budget is tracked under
+
+    Args:
+        method (str): HTTP method
+        url (str): Request URL
+        auth: requests auth. OAuth1 user tokens separate accounts.
+
+    Returns:
+        tuple: Account, method and URL path
+    """
+    account = "app"
+    client = getattr(auth, "client", None)
+    if client is not None and getattr(client, "resource_owner_key", None):
+        account = client.resource_owner_key.split("-")[0]
+    return (account, method.upper(), urlparse(url).path)
+
+
+def load_state() -> dict:
+    """Reads budgets saved by a running bot
+
+    Returns:
+        dict: Budgets by account and endpoint, empty if nothing has been saved
+    """
+    try:
+        with open(STATE_FILE, "r", encoding="utf-8") as state_file:
+            return json.load(state_file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+CLIENT = RateLimitedClient(get_session())
+
+def get_client() -> RateLimitedClient:
+    """Returns the client shared by all twitter requests"""
+    return CLIENT
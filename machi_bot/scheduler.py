@@ -0,0 +1,97 @@
+"""Simple scheduler for running the bot as a long running process"""
+
+import time
+import random
+import threading
+from datetime import datetime, timedelta
+from loguru import logger
+
+class Scheduler:
+    """Runs tasks on fixed intervals or at daily times until stopped"""
+
+    def __init__(self) -> None:
+        self.tasks = []
+        self.stop_event = threading.Event()
+
+    def every(self, name: str, interval: float, task, jitter: float = 0,
+              run_now: bool = False) -> None:
+        """Schedules a task to run repeatedly
+
+        Args:
+            name (str): Task name for logging
+            interval (float): Seconds between runs
+            task: Function to run. Returning a number of seconds postpones the run, other
+                return values are ignored.
+            jitter (float): Each run is moved randomly by up to this many seconds
+            run_now (bool): Run the task immediately when the scheduler starts
+        """
+        def next_run(now: float) -> float:
+            return now + max(0, interval + random.uniform(-jitter, jitter))
+
+        first_run = time.time() if run_now else next_run(time.time())
+        self.tasks.append({"name": name, "task": task, "next_run": next_run, "due": first_run})
+
+    def daily(self, name: str, times: list[str], task, jitter: float = 0) -> None:
+        """Schedules a task to run every day at the given local times
+
+        Args:
+            name (str): Task name for logging
+            times (list[str]): Times of day as HH:MM
+            task: Function to run. Returning a number of seconds postpones the run, other
+                return values are ignored.
+            jitter (float): Each run is moved randomly by up to this many seconds
+        """
+        parsed_times = sorted(datetime.strptime(value, "%H:%M").time() for value in times)
+
+        def next_run(now: float) -> float:
+            current = datetime.fromtimestamp(now)
+            for day in range(2):
+                date = current.date() + timedelta(days=day)
+                for time_of_day in parsed_times:
+                    candidate = datetime.combine(date, time_of_day)
+                    if candidate > current:
+                        return candidate.timestamp() + random.uniform(0, jitter)
+            return now + 86400
+
+        self.tasks.append(
+            {"name": name, "task": task, "next_run": next_run, "due": next_run(time.time())}
+        )
+
+    def stop(self, *_args) -> None:
+        """Stops the scheduler after the running task finishes. Works as a signal handler."""
+        logger.info("Stopping scheduler")
+        self.stop_event.set()
+
+    def run(self) -> None:
+        """Runs due tasks until stop is called"""
+        for task in self.tasks:
+            log_next_run(task)
+
+        while not self.stop_event.is_set():
+            task = min(self.tasks, key=lambda task: task["due"])
+            delay = task["due"] - time.time()
+            if delay > 0:
+                # Wakes up early if stopped
+                self.stop_event.wait(delay)
+                continue
+
+            logger.info(f"Running {task['name']}")
+            postpone = None
+            try:
+                postpone = task["task"]()
+            except (Exception, SystemExit):
+                logger.exception(f"Task {task['name']} failed")
+            # Only a number asks for a retry, tasks like reconcile return their results
+            if not isinstance(postpone, (int, float)) or isinstance(postpone, bool):
+                postpone = None
+            if postpone is not None and postpone > 0:
+                # Task couldn't run yet and asked to be retried after this many seconds
+                task["due"] = time.time() + postpone
+            else:
+                task["due"] = task["next_run"](time.time())
+            log_next_run(task)
+
+
+def log_next_run(task: dict) -> None:
+    """Logs when a scheduled task runs next"""
+    logger.info(f"Next {task['name']} at {datetime.fromtimestamp(task['due']):%Y-%m-%d %H:%M:%S}")
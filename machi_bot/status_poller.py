@@ -0,0 +1,188 @@
+"""Polls twitter media processing status in the background"""
+
+import time
+import heapq
+import itertools
+import threading
+from concurrent.futures import Future
+import requests
+from loguru import logger
+from .rate_limit import RateLimitError
+
+# Used when twitter doesn't say when to check again
+MIN_BACKOFF = 1
+MAX_BACKOFF = 60
+
+class ProcessingError(Exception):
+    """Twitter failed to process the media or it didn't finish in time"""
+
+
+class StatusPoller:
+    """Tracks processing of many media_ids from one background thread
+
+    Each media is checked again after the check_after_secs twitter returned, or with
+    exponential backoff if it didn't return one. A rate limited check is moved to
+    the limit's reset instead of waiting in the thread, so other media keep being
+    checked. Checks are never scheduled past the media's deadline. Callers get a
+    Future instead of sleeping themselves, and it's resolved even if a check fails
+    unexpectedly.
+    """
+
+    def __init__(self, client, endpoint_url: str) -> None:
+        self.client = client
+        self.endpoint_url = endpoint_url
+        self.pending = []
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def watch(self, media_id: str, processing_info: dict, auth, timeout: float) -> Future:
+        """Starts tracking a media
+
+        Args:
+            media_id (str): Twitter media_id
+            processing_info (dict): processing_info from the FINALIZE response
+            auth: requests auth used for STATUS requests
+            timeout (float): Seconds to wait for processing to finish
+
+        Returns:
+            Future: Resolves to the final processing_info or raises ProcessingError
+        """
+        job = {
+            "media_id": media_id,
+            "auth": auth,
+            "deadline": time.monotonic() + timeout,
+            "attempt": 0,
+            "future": Future()
+        }
+        if self.evaluate(job, processing_info):
+            self.schedule(job, processing_info)
+        return job["future"]
+
+    def evaluate(self, job: dict, processing_info: dict) -> bool:
+        """Resolves the job's future if processing has finished
+
+        Args:
+            job (dict): Tracked media
+            processing_info (dict): Latest processing_info
+
+        Returns:
+            bool: True if the media is still processing
+        """
+        if processing_info is None:
+            # No processing_info means there's nothing left to process
+            job["future"].set_result(None)
+            return False
+
+        state = processing_info.get("state")
+        logger.info(f"Media {job['media_id']} processing state: {state}")
+        if state == "succeeded":
+            job["future"].set_result(processing_info)
+            return False
+        if state == "failed" or "error" in processing_info:
+            logger.error(f"Media {job['media_id']} processing failed")
+            logger.info(f"Processing info: {processing_info}")
+            job["future"].set_exception(
+                ProcessingError(f"Media processing failed: {processing_info}")
+            )
+            return False
+        return True
+
+    def schedule(self, job: dict, processing_info: dict, check_after: float = None) -> None:
+        """Queues the next status check of a job
+
+        Args:
+            job (dict): Tracked media
+            processing_info (dict): Latest processing_info, None after a failed request
+            check_after (float): Seconds until the next check. Taken from processing_info
+                or the backoff if None.
+        """
+        now = time.monotonic()
+        if now >= job["deadline"]:
+            job["future"].set_exception(
+                ProcessingError(f"Media {job['media_id']} wasn't processed in time")
+            )
+            return
+
+        if check_after is None and processing_info is not None:
+            check_after = processing_info.get("check_after_secs")
+        if check_after is None:
+            check_after = min(MIN_BACKOFF * 2 ** job["attempt"], MAX_BACKOFF)
+        job["attempt"] += 1
+        next_check = min(now + check_after, job["deadline"])
+        logger.info(f"Checking media {job['media_id']} after {next_check - now:.0f} seconds")
+
+        with self.condition:
+            heapq.heappush(self.pending, (next_check, next(self.counter), job))
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name="status-poller", daemon=True)
+                self.thread.start()
+            self.condition.notify()
+
+    def run(self) -> None:
+        """Checks due jobs until there's nothing left to track"""
+        while True:
+            with self.condition:
+                while True:
+                    if not self.pending:
+                        self.thread = None
+                        return
+                    delay = self.pending[0][0] - time.monotonic()
+                    if delay <= 0:
+                        break
+                    self.condition.wait(delay)
+                _, _, job = heapq.heappop(self.pending)
+
+            try:
+                self.poll(job)
+            except Exception as err:
+                logger.exception(f"Checking media {job['media_id']} failed")
+                if not job["future"].done():
+                    job["future"].set_exception(err)
+
+    def poll(self, job: dict) -> None:
+        """Checks a job once and resolves or reschedules it
+
+        Args:
+            job (dict): Tracked media
+        """
+        try:
+            processing_info = self.check(job)
+        except RateLimitError as err:
+            logger.warning(f"Checking media {job['media_id']} is rate limited: {err}")
+            self.schedule(job, None, err.wait)
+            return
+        except (requests.RequestException, ValueError) as err:
+            logger.warning(f"Checking media {job['media_id']} failed: {err}")
+            self.schedule(job, None)
+            return
+        if self.evaluate(job, processing_info):
+            self.schedule(job, processing_info)
+
+    def check(self, job: dict) -> dict:
+        """Fetches the processing status of a job
+
+        Args:
+            job (dict): Tracked media
+
+        Raises:
+            RateLimitError: The STATUS budget is used up
+
+        Returns:
+            dict: processing_info from the STATUS response
+        """
+        request_params = {
+            "command": "STATUS",
+            "media_id": job["media_id"]
+        }
+
+        # Waiting for the rate limit here would hold back every other media
+        req = self.client.get(
+            url=self.endpoint_url,
+            block=False,
+            params=request_params,
+            auth=job["auth"],
+            timeout=10
+        )
+        req.raise_for_status()
+        return req.json().get("processing_info", None)
@@ -0,0 +1,125 @@
+"""On-disk cache for videos converted with ffmpeg"""
+
+import os
+import json
+import hashlib
+import contextlib
+from pathlib import Path
+from loguru import logger
+
+PROJECT_ROOT = Path(__file__).parent.parent
+CONFIG_FILE = os.path.join(PROJECT_ROOT, "config.json")
+with open(CONFIG_FILE, "r", encoding="utf-8") as file:
+    CONFIG = json.load(file)
+CACHE_DIR = Path(CONFIG.get("appdata")).joinpath("transcode_cache")
+
+def enabled() -> bool:
+    """Returns True if the transcode cache is enabled in config"""
+    return CONFIG.get("transcode-cache", True)
+
+
+def cache_key(file_path: str, ffmpeg_args: str) -> str:
+    """Creates the cache key for a source file and ffmpeg argument set
+
+    Args:
+        file_path (str): Source file path
+        ffmpeg_args (str): Arguments used for the conversion
+
+    Returns:
+        str: Hex digest identifying the conversion
+    """
+    file_stat = os.stat(file_path)
+    key_data = json.dumps([
+        os.path.abspath(file_path),
+        file_stat.st_size,
+        file_stat.st_mtime_ns,
+        ffmpeg_args
+    ])
+    return hashlib.sha256(key_data.encode("utf-8")).hexdigest()
+
+
+def lookup(key: str) -> str:
+    """Returns the cached file for key and marks it as recently used
+
+    Args:
+        key (str): Cache key
+
+    Returns:
+        str: Cached file path or None if not cached
+    """
+    cached_path = CACHE_DIR.joinpath(f"{key}.mp4")
+    if not cached_path.is_file():
+        return None
+    # mtime is used as the last access time for eviction
+    os.utime(cached_path)
+    return cached_path.as_posix()
+
+
+def partial_path(key: str) -> str:
+    """Returns the path ffmpeg should write to before the result is stored
+
+    Args:
+        key (str): Cache key
+
+    Returns:
+        str: Temporary file path inside the cache folder
+    """
+    if not os.path.exists(CACHE_DIR):
+        os.makedirs(CACHE_DIR)
+    return CACHE_DIR.joinpath(f"{key}.part.mp4").as_posix()
+
+
+def store(key: str) -> str:
+    """Moves a finished conversion from its partial path into the cache
+
+    Args:
+        key (str): Cache key
+
+    Returns:
+        str: Cached file path
+    """
+    cached_path = CACHE_DIR.joinpath(f"{key}.mp4")
+    os.replace(partial_path(key), cached_path)
+    evict()
+    return cached_path.as_posix()
+
+
+def contains(file_path: str) -> bool:
+    """Returns True if the file is stored in the cache folder
+
+    Args:
+        file_path (str): File path
+    """
+    return Path(file_path).resolve().parent == CACHE_DIR.resolve()
+
+
+def evict(max_bytes: int = None) -> None:
+    """Removes least recently used files until the cache fits its size limit
+
+    The most recently used file is always kept. Other processes storing conversions
+    evict at the same time, so files removed by them are skipped.
+
+    Args:
+        max_bytes (int): Size limit. Defaults to transcode-cache-size (MB) from config.
+    """
+    if max_bytes is None:
+        max_bytes = CONFIG.get("transcode-cache-size", 2048) * 1024 * 1024
+
+    entries = []
+    for entry in os.scandir(CACHE_DIR):
+        if entry.name.endswith(".part.mp4") or not entry.name.endswith(".mp4"):
+            continue
+        try:
+            entry_stat = entry.stat()
+        except FileNotFoundError:
+            continue
+        entries.append((entry_stat.st_mtime, entry_stat.st_size, entry.path))
+    entries.sort()
+
+    total_bytes = sum(size for _, size, _ in entries)
+    while total_bytes > max_bytes and len(entries) > 1:
+        _, size, path = entries.pop(0)
+        logger.info(f"Evicting {path} from transcode cache")
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+        total_bytes -= size
@@ -0,0 +1,188 @@
+"""Watches the media folder and keeps the library up to date as files change
+
+File system events come from watchdog (inotify, FSEvents or ReadDirectoryChangesW)
+when it's installed. Changed folders are collected and applied to the database
+once events stop for a moment, so copying a large batch of files results in one
+update instead of one per file. Without watchdog, or with watch-polling enabled
+for network mounts where events don't arrive, the library is scanned
+incrementally on an interval instead.
+"""
+
+import os
+import json
+import time
+import threading
+from pathlib import Path
+from loguru import logger
+from . import database as machidb
+
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
+
+PROJECT_ROOT = Path(__file__).parent.parent
+CONFIG_FILE = os.path.join(PROJECT_ROOT, "config.json")
+with open(CONFIG_FILE, "r", encoding="utf-8") as file:
+    CONFIG = json.load(file)
+
+class ChangeHandler(FileSystemEventHandler):
+    """Passes watchdog events to the watcher"""
+
+    def __init__(self, watcher) -> None:
+        super().__init__()
+        self.watcher = watcher
+
+    def on_any_event(self, event) -> None:
+        if event.event_type in ("opened", "closed", "closed_no_write"):
+            return
+        if event.is_directory:
+            if event.event_type == "modified":
+                # Changes inside the folder have their own events
+                return
+            self.watcher.mark(event.src_path, recursive=True)
+            if event.event_type == "moved":
+                self.watcher.mark(event.dest_path, recursive=True)
+        else:
+            self.watcher.mark(os.path.dirname(event.src_path))
+            if event.event_type == "moved":
+                self.watcher.mark(os.path.dirname(event.dest_path))
+
+
+class MediaWatcher:
+    """Applies changes in the media folder to the database
+
+    Changed folders are applied after no events have arrived for watch-debounce
+    seconds, or at the latest watch-max-delay seconds after the first change.
+    """
+
+    def __init__(self, media_location: str = None) -> None:
+        if media_location is None:
+            media_location = CONFIG.get("media-location")
+        self.media_location = os.path.normpath(media_location)
+        self.excluded_paths = machidb.get_excluded_paths(self.media_location)
+        self.debounce = CONFIG.get("watch-debounce", 5)
+        self.max_delay = CONFIG.get("watch-max-delay", 60)
+        self.poll_interval = CONFIG.get("watch-poll-interval", 300)
+        self.polling = CONFIG.get("watch-polling", False) or Observer is None
+        self.changed = {}
+        self.first_change = None
+        self.last_change = None
+        self.condition = threading.Condition()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.observer = None
+
+    def mark(self, path: str, recursive: bool = False) -> None:
+        """Queues a changed folder
+
+        Args:
+            path (str): Folder path
+            recursive (bool): The folder itself was added, removed or moved, so its
+                subfolders need to be walked too
+        """
+        path = os.path.normpath(path)
+        if path != self.media_location and not path.startswith(self.media_location + os.sep):
+            return
+        for excluded_path in self.excluded_paths:
+            if path == excluded_path or path.startswith(excluded_path + os.sep):
+                return
+        with self.condition:
+            self.changed[path] = self.changed.get(path, False) or recursive
+            now = time.monotonic()
+            if self.first_change is None:
+                self.first_change = now
+            self.last_change = now
+            self.condition.notify()
+
+    def take_changes(self) -> dict:
+        """Waits until changes have settled and takes them
+
+        Returns:
+            dict: Changed folders mapped to True if they need a recursive walk. None if
+                the watcher was stopped.
+        """
+        with self.condition:
+            while not self.stop_event.is_set():
+                if not self.changed:
+                    self.condition.wait()
+                    continue
+                now = time.monotonic()
+                due = min(self.last_change + self.debounce, self.first_change + self.max_delay)
+                if now >= due:
+                    changed = self.changed
+                    self.changed = {}
+                    self.first_change = self.last_change = None
+                    return collapse(changed)
+                self.condition.wait(due - now)
+            return None
+
+    def run(self) -> None:
+        """Applies changes until stopped"""
+        if self.polling:
+            while not self.stop_event.wait(self.poll_interval):
+                self.apply(machidb.scan)
+            return
+
+        while True:
+            changed = self.take_changes()
+            if changed is None:
+                return
+            self.apply(machidb.scan_directories, changed)
+
+    def apply(self, function, *args) -> None:
+        """Runs a database update, logging failures so watching continues"""
+        try:
+            function(*args)
+        except Exception:
+            logger.exception("Updating library failed")
+
+    def start(self) -> None:
+        """Starts watching in background threads"""
+        if self.polling:
+            if Observer is None:
+                logger.info("watchdog isn't installed, polling for changes instead")
+            logger.info(
+                f"Scanning {self.media_location} for changes every {self.poll_interval} seconds"
+            )
+        else:
+            self.observer = Observer()
+            self.observer.schedule(ChangeHandler(self), self.media_location, recursive=True)
+            self.observer.start()
+            logger.info(f"Watching {self.media_location} for changes")
+        self.thread = threading.Thread(target=self.run, name="media-watcher", daemon=True)
+        self.thread.start()
+
+    def stop(self, *_args) -> None:
+        """Stops watching after the running update finishes. Works as a signal handler."""
+        self.stop_event.set()
+        with self.condition:
+            self.condition.notify_all()
+        if self.observer is not None:
+            self.observer.stop()
+
+    def join(self) -> None:
+        """Blocks until the watcher has stopped"""
+        # Wait in short steps so signals are handled on Windows too
+        while self.thread.is_alive():
+            self.thread.join(1)
+        if self.observer is not None:
+            self.observer.join()
+
+
+def collapse(changed: dict) -> dict:
+    """Drops folders that are walked anyway as part of a changed parent
+
+    Args:
+        changed (dict): Changed folders mapped to True if they need a recursive walk
+
+    Returns:
+        dict: Changed folders
+    """
+    walked = sorted(path for path, recursive in changed.items() if recursive)
+    return {
+        path: recursive for path, recursive in changed.items()
+        if not any(path.startswith(parent + os.sep) for parent in walked)
+    }
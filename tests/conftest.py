@@ -0,0 +1,53 @@
+"""Shared test fixtures
+
+The bot's modules read config.json when they're imported, so a minimal config
+is written for the test run if the project doesn't have one.
+"""
+import os
+import json
+import atexit
+import tempfile
+from pathlib import Path
+import pytest
+
+PROJECT_ROOT = Path(__file__).parent.parent
+CONFIG_FILE = PROJECT_ROOT.joinpath("config.json")
+if not CONFIG_FILE.exists():
+    with open(CONFIG_FILE, "w", encoding="utf-8") as file:
+        json.dump({"appdata": tempfile.mkdtemp(prefix="machi_bot_test_")}, file)
+    atexit.register(os.remove, CONFIG_FILE)
+
+# pylint: disable=wrong-import-position
+from machi_bot import database as machidb
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    """Empty database in tmp_path with an up to date schema"""
+    monkeypatch.setattr(machidb, "DB_FILE", tmp_path.joinpath("test.db").as_posix())
+    monkeypatch.setattr(machidb, "CONFIG", {"exclude-folders": []})
+    machidb.create_tables()
+    yield machidb.get_connection()
+    machidb.close_connection()
+
+
+@pytest.fixture
+def library(tmp_path, database):
+    """Scans a media folder in tmp_path with the given number of distinct files
+
+    Returns:
+        Function taking a file count and returning the file paths
+    """
+    location = tmp_path.joinpath("media")
+
+    def create(count: int, size: int = 1024) -> list[str]:
+        location.mkdir(exist_ok=True)
+        paths = []
+        for index in range(count):
+            path = location.joinpath(f"video_{index:04d}.webm")
+            path.write_bytes(os.urandom(size))
+            paths.append(path.as_posix())
+        machidb.scan(full=True, media_location=location.as_posix())
+        return paths
+
+    return create
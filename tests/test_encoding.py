@@ -0,0 +1,58 @@
+"""Tests for choosing how videos are converted"""
+import pytest
+from machi_bot import encoding
+from machi_bot import transcode_cache
+
+
+def video_info(height: int, stream_bit_rate: int = None, format_bit_rate: int = None) -> dict:
+    """ffprobe output of a twitter compatible H.264/AAC mp4"""
+    video = {
+        "codec_type": "video", "codec_name": "h264", "pix_fmt": "yuv420p", "profile": "High",
+        "width": height * 16 // 9 // 2 * 2, "height": height, "avg_frame_rate": "30/1"
+    }
+    if stream_bit_rate is not None:
+        video["bit_rate"] = str(stream_bit_rate)
+    media_format = {"format_name": "mov,mp4,m4a,3gp,3g2,mj2", "duration": "30.0"}
+    if format_bit_rate is not None:
+        media_format["bit_rate"] = str(format_bit_rate)
+    audio = {"codec_type": "audio", "codec_name": "aac", "profile": "LC", "channels": 2}
+    return {"format": media_format, "streams": [video, audio]}
+
+
+@pytest.fixture
+def source(tmp_path, monkeypatch):
+    """Video file with the transcode cache in tmp_path"""
+    monkeypatch.setattr(encoding, "CONFIG", {})
+    monkeypatch.setattr(transcode_cache, "CACHE_DIR", tmp_path.joinpath("transcode_cache"))
+    path = tmp_path.joinpath("video.mp4")
+    path.write_bytes(b"video")
+    return path.as_posix()
+
+
+@pytest.mark.parametrize("profile, info, remux", [
+    ("archival", video_info(1080, stream_bit_rate=20_000_000), True),
+    ("balanced", video_info(1080, stream_bit_rate=8_000_000), True),
+    ("balanced", video_info(1080, format_bit_rate=8_000_000), True),
+    ("balanced", video_info(1080, stream_bit_rate=12_000_000, format_bit_rate=8_000_000), False),
+    ("balanced", video_info(1080, format_bit_rate=12_000_000), False),
+    ("balanced", video_info(1080), False),
+    ("fast", video_info(1080, stream_bit_rate=2_000_000), False),
+    ("fast", video_info(720, stream_bit_rate=2_000_000), True),
+])
+def test_remux_only_inside_profile_limits(source, profile, info, remux):
+    args, _, _ = encoding.plan_conversion(source, profile, info=info)
+    assert (args == encoding.REMUX_ARGS) == remux
+
+
+def test_streamed_encode_is_capped_near_source_bitrate(source):
+    info = video_info(1080, format_bit_rate=2_000_000)
+    info["streams"][0]["codec_name"] = "vp8"
+    assert encoding.stream_bitrate("balanced", info) == 4000
+    assert encoding.stream_bitrate("balanced", video_info(1080)) == 10000
+    assert encoding.stream_bitrate("archival", info) is None
+
+    args, _, _ = encoding.plan_conversion(source, "balanced", fragmented=True, info=info)
+    assert "-maxrate 4000k" in args
+    # 4000 kbps video and 160 kbps audio for 30 seconds with room for mp4 boxes
+    size_limit = encoding.stream_size_limit(source, "balanced", info)
+    assert 4160 * 1000 / 8 * 30 < size_limit < 4160 * 1000 / 8 * 30 * 1.1
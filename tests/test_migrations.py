@@ -0,0 +1,28 @@
+"""Tests for database schema migrations"""
+import sqlite3
+from machi_bot import migrations
+
+
+def test_unversioned_database_is_migrated_in_place(tmp_path):
+    db_connection = sqlite3.connect(tmp_path.joinpath("old.db"))
+    migrations.create_base_tables(db_connection)
+    db_connection.execute(
+        "INSERT INTO media(media_id, title, file_path) VALUES (1, 'video', '/media/a/video.webm')"
+    )
+    db_connection.execute(
+        """
+        INSERT INTO posts(post_body, media_id, link, tweet_id, timestamp)
+        VALUES ('video', 1, 'https://t.co/1', '1', '2023-03-01 12:00:00')
+        """
+    )
+    db_connection.commit()
+
+    migrations.migrate(db_connection)
+    assert migrations.schema_version(db_connection) == len(migrations.MIGRATIONS)
+    row = db_connection.execute(
+        "SELECT directory, posted, last_posted, missing FROM media WHERE media_id = 1"
+    ).fetchone()
+    assert row == ("/media/a", 1, "2023-03-01 12:00:00", 0)
+    # Running again does nothing
+    migrations.migrate(db_connection)
+    db_connection.close()
@@ -0,0 +1,151 @@
+"""Tests for posting through the outbox"""
+import time
+import shutil
+import pytest
+from machi_bot import database as machidb
+from machi_bot import posting
+from machi_bot import create_tweet
+from machi_bot import media_upload
+from machi_bot import metrics
+from machi_bot.rate_limit import RateLimitError
+
+
+class TweetResponse:
+    """Response of a created tweet"""
+    status_code = 201
+
+    def __init__(self, tweet_id: str, text: str) -> None:
+        self.tweet_id = tweet_id
+        self.text = text
+
+    def json(self) -> dict:
+        return {"data": {"id": self.tweet_id, "text": f"{self.text} https://t.co/{self.tweet_id}"}}
+
+
+@pytest.fixture
+def twitter(tmp_path, monkeypatch):
+    """Replaces conversion, upload and tweeting with local fakes
+
+    Returns:
+        list[str]: Texts of the tweets sent, in order
+    """
+    tweets = []
+
+    def convert(source_path: str, profile: str = None) -> str:
+        output_path = tmp_path.joinpath(f"converted_{len(tweets)}.mp4").as_posix()
+        shutil.copyfile(source_path, output_path)
+        return output_path
+
+    def upload(file_path: str, remove_file: bool = False, token_file: str = None):
+        return (f"media_{len(tweets)}", time.time() + 3600)
+
+    def post_tweet(text: str, media_id: str, token_file: str = None):
+        tweets.append(text)
+        return TweetResponse(str(len(tweets)), text)
+
+    monkeypatch.setattr(posting, "CONFIG", {})
+    monkeypatch.setattr(metrics, "CONFIG", {})
+    monkeypatch.setattr(posting, "convert_to_mp4", convert)
+    monkeypatch.setattr(media_upload, "upload_media", upload)
+    monkeypatch.setattr(create_tweet, "post_tweet", post_tweet)
+    return tweets
+
+
+def test_interrupted_tweet_is_not_posted_again(library, twitter, monkeypatch):
+    library(1)
+
+    def lost_connection(text: str, media_id: str, token_file: str = None):
+        twitter.append(text)
+        raise ConnectionError("Connection reset by peer")
+
+    # No answer from twitter, so the tweet may exist
+    with monkeypatch.context() as patch:
+        patch.setattr(create_tweet, "post_tweet", lost_connection)
+        posting.create_post("", None)
+    states = machidb.get_connection().execute("SELECT state FROM outbox").fetchall()
+    assert states == [("review",)]
+
+    # The only media is in review, so there's nothing left to post
+    with pytest.raises(SystemExit):
+        posting.create_post("", None)
+    assert len(twitter) == 1
+
+
+def test_post_after_interrupted_tweet_uses_other_media(library, twitter, monkeypatch):
+    library(2)
+
+    def timed_out(text: str, media_id: str, token_file: str = None):
+        raise TimeoutError("Read timed out")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(create_tweet, "post_tweet", timed_out)
+        posting.create_post("", None)
+
+    posting.create_post("", None)
+    db_connection = machidb.get_connection()
+    in_review = db_connection.execute("SELECT media_id FROM outbox WHERE state = 'review'")
+    posted = db_connection.execute("SELECT media_id FROM posts")
+    assert in_review.fetchall() != posted.fetchall()
+    assert len(twitter) == 1
+
+
+def test_media_in_review_is_never_picked(library, database):
+    library(2)
+    review_id = database.execute("SELECT MIN(media_id) FROM media").fetchone()[0]
+    source_path = database.execute(
+        "SELECT file_path FROM media WHERE media_id = ?", (review_id,)
+    ).fetchone()[0]
+    entry = machidb.add_outbox(review_id, source_path, "text", "token.json")
+    machidb.update_outbox(entry["outbox_id"], "review")
+
+    for _ in range(50):
+        assert machidb.get_media(None)[0] != review_id
+
+    # Also when everything else has been posted
+    database.execute("UPDATE media SET posted = 1 WHERE media_id != ?", (review_id,))
+    database.commit()
+    for _ in range(10):
+        assert machidb.get_media(None)[0] != review_id
+
+
+def test_rate_limit_doesnt_use_up_attempts(library, twitter, monkeypatch):
+    library(1)
+
+    def rate_limited(text: str, media_id: str, token_file: str = None):
+        raise RateLimitError("POST /2/tweets rate limit resets in 600 seconds", 600)
+
+    with monkeypatch.context() as patch:
+        patch.setattr(create_tweet, "post_tweet", rate_limited)
+        with pytest.raises(RateLimitError):
+            posting.create_post("", None)
+    entry = machidb.get_connection().execute("SELECT state, attempts FROM outbox").fetchone()
+    assert entry == ("uploaded", 0)
+
+    # The next post continues the same entry
+    posting.create_post("", None)
+    assert machidb.get_connection().execute("SELECT state FROM outbox").fetchall() == [("posted",)]
+    assert len(twitter) == 1
+
+
+def test_failed_upload_continues_from_conversion(library, twitter, monkeypatch):
+    library(1)
+    conversions = []
+    convert = posting.convert_to_mp4
+
+    def counted_convert(source_path: str, profile: str = None) -> str:
+        conversions.append(source_path)
+        return convert(source_path, profile)
+
+    def failed_upload(file_path: str, remove_file: bool = False, token_file: str = None):
+        raise ConnectionError("Connection reset by peer")
+
+    monkeypatch.setattr(posting, "convert_to_mp4", counted_convert)
+    with monkeypatch.context() as patch:
+        patch.setattr(media_upload, "upload_media", failed_upload)
+        posting.create_post("", None)
+    entry = machidb.get_connection().execute("SELECT state, attempts FROM outbox").fetchone()
+    assert entry == ("converted", 1)
+
+    assert posting.drain_outbox() == 1
+    assert len(conversions) == 1
+    assert len(twitter) == 1
@@ -0,0 +1,55 @@
+"""Tests for reserving media to prepare ahead of time"""
+import os
+import sqlite3
+from machi_bot import database as machidb
+from machi_bot import migrations
+
+
+def reserved_ids(db_connection: sqlite3.Connection) -> set[int]:
+    """Returns the media_ids with a reservation"""
+    return {row[0] for row in db_connection.execute("SELECT media_id FROM prepared")}
+
+
+def test_deleted_media_frees_its_reservation(library, database, tmp_path):
+    paths = library(4)
+    reserved = machidb.reserve_media(2)
+    assert len(reserved) == 2
+
+    # A scan deletes media whose files are gone
+    for _, file_path, _ in reserved:
+        os.remove(file_path)
+    machidb.scan(full=True, media_location=tmp_path.joinpath("media").as_posix())
+    remaining = {row[0] for row in database.execute("SELECT media_id FROM media")}
+    assert len(remaining) == len(paths) - 2
+
+    # Prepare ahead keeps working with the media that is left
+    reserved = machidb.reserve_media(2)
+    assert {media[0] for media in reserved} == remaining
+    assert reserved_ids(database) == remaining
+
+
+def test_missing_media_doesnt_count_as_reserved(library, database):
+    library(3)
+    (media_id, _, _), = machidb.reserve_media(1)
+    machidb.mark_missing(database, [media_id])
+
+    reserved = machidb.reserve_media(1)
+    assert len(reserved) == 1
+    assert reserved[0][0] != media_id
+
+
+def test_migration_drops_orphaned_reservations(tmp_path):
+    db_connection = sqlite3.connect(tmp_path.joinpath("old.db"))
+    db_connection.execute("PRAGMA foreign_keys = ON")
+    for migration in migrations.MIGRATIONS[:-1]:
+        migration(db_connection)
+    db_connection.execute(f"PRAGMA user_version = {len(migrations.MIGRATIONS) - 1}")
+    db_connection.execute("INSERT INTO media(media_id, title, file_path) VALUES (1, 'a', '/a')")
+    db_connection.executemany("INSERT INTO prepared(media_id) VALUES (?)", [(1,), (2,)])
+    db_connection.commit()
+
+    migrations.migrate(db_connection)
+    assert reserved_ids(db_connection) == {1}
+    db_connection.execute("DELETE FROM media WHERE media_id = 1")
+    assert reserved_ids(db_connection) == set()
+    db_connection.close()
@@ -0,0 +1,49 @@
+"""Tests for the rate limited request client"""
+import json
+import time
+import requests
+import pytest
+from machi_bot import rate_limit
+
+
+def response(status_code: int, remaining: int, reset: float) -> requests.Response:
+    """Creates a response with rate limit headers"""
+    result = requests.Response()
+    result.status_code = status_code
+    result.headers.update({
+        "x-rate-limit-limit": "50",
+        "x-rate-limit-remaining": str(remaining),
+        "x-rate-limit-reset": str(int(reset))
+    })
+    return result
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    """Client saving its state in tmp_path"""
+    monkeypatch.setattr(rate_limit, "STATE_FILE", tmp_path.joinpath("rate_limits.json"))
+    return rate_limit.RateLimitedClient(requests.Session())
+
+
+def test_state_is_saved_when_budget_changes(client, monkeypatch):
+    key = ("app", "POST", "/2/tweets")
+    reset = time.time() + 600
+    client.update(key, response(201, 10, reset))
+    state = json.loads(rate_limit.STATE_FILE.read_text(encoding="utf-8"))
+    assert state["app"]["POST /2/tweets"]["remaining"] == 10
+    assert list(rate_limit.STATE_FILE.parent.iterdir()) == [rate_limit.STATE_FILE]
+
+    saves = []
+    monkeypatch.setattr(client, "save_state", lambda: saves.append(True))
+    client.update(key, response(201, 10, reset))
+    assert not saves
+    client.update(key, response(201, 9, reset))
+    assert saves
+
+
+def test_exhausted_budget_raises_when_not_blocking(client):
+    key = ("app", "POST", "/2/tweets")
+    client.update(key, response(429, 0, time.time() + 600))
+    with pytest.raises(rate_limit.RateLimitError) as error:
+        client.wait_for_budget(key, block=False)
+    assert error.value.wait > 0
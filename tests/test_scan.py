@@ -0,0 +1,63 @@
+"""Tests for scanning the media library"""
+import os
+import shutil
+from machi_bot import database as machidb
+from machi_bot import fingerprint
+
+
+def scan(tmp_path, full: bool = False) -> None:
+    """Scans the media folder in tmp_path"""
+    machidb.scan(full=full, media_location=tmp_path.joinpath("media").as_posix())
+
+
+def test_moved_file_keeps_its_media(library, database, tmp_path):
+    old_path, = library(1, size=fingerprint.MIN_MATCH_SIZE)
+    database.execute("UPDATE media SET posted = 1")
+    database.commit()
+    new_path = tmp_path.joinpath("media", "renamed.webm").as_posix()
+    os.rename(old_path, new_path)
+
+    scan(tmp_path)
+    rows = database.execute("SELECT media_id, file_path, posted FROM media").fetchall()
+    assert rows == [(1, new_path, 1)]
+
+
+def test_small_files_arent_matched(library, database, tmp_path):
+    first, second = library(2, size=0)
+    database.execute("UPDATE media SET posted = 1 WHERE file_path = ?", (first,))
+    database.commit()
+    # An identical copy of a small posted file isn't a copy of the same video
+    shutil.copyfile(first, tmp_path.joinpath("media", "copy.webm"))
+    os.remove(second)
+    shutil.copyfile(first, tmp_path.joinpath("media", "renamed.webm"))
+
+    scan(tmp_path)
+    rows = database.execute("SELECT media_id, posted FROM media ORDER BY media_id").fetchall()
+    assert rows == [(1, 1), (3, 0), (4, 0)]
+
+    machidb.insert_post(
+        {"data": {"id": "1", "text": "text https://t.co/1"}}, 3
+    )
+    rows = database.execute("SELECT media_id, posted FROM media ORDER BY media_id").fetchall()
+    assert rows == [(1, 1), (3, 1), (4, 0)]
+
+
+def test_unreadable_files_are_only_retried_by_full_scan(library, database, tmp_path, monkeypatch):
+    reads = []
+
+    def unreadable(file_path: str) -> str:
+        reads.append(file_path)
+        return None
+
+    monkeypatch.setattr(fingerprint, "compute", unreadable)
+    library(1)
+    assert len(reads) == 1
+    tmp_path.joinpath("media", "new.webm").write_bytes(b"new")
+
+    scan(tmp_path)
+    assert len(reads) == 2
+    scan(tmp_path, full=True)
+    assert len(reads) == 4
+    assert database.execute("SELECT DISTINCT fingerprint FROM media").fetchall() == [
+        (fingerprint.UNREADABLE,)
+    ]
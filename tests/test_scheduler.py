@@ -0,0 +1,42 @@
+"""Tests for the daemon scheduler"""
+import time
+import pytest
+from machi_bot.scheduler import Scheduler
+
+
+def run_once(result) -> dict:
+    """Runs a task returning result once and returns the scheduled task"""
+    scheduler = Scheduler()
+
+    def task():
+        scheduler.stop()
+        return result
+
+    scheduler.every("task", 3600, task, run_now=True)
+    scheduler.run()
+    return scheduler.tasks[0]
+
+
+def test_number_postpones_task():
+    before = time.time()
+    task = run_once(30)
+    assert before + 30 <= task["due"] < before + 60
+
+
+@pytest.mark.parametrize("result", [None, (1, 2), True, 0, -5])
+def test_other_results_wait_for_next_run(result):
+    before = time.time()
+    task = run_once(result)
+    assert task["due"] >= before + 3600
+
+
+def test_failed_task_is_scheduled_again():
+    scheduler = Scheduler()
+
+    def task():
+        scheduler.stop()
+        raise RuntimeError("failed")
+
+    scheduler.every("task", 3600, task, run_now=True)
+    scheduler.run()
+    assert scheduler.tasks[0]["due"] > time.time() + 3000
@@ -0,0 +1,22 @@
+"""Tests for picking media to post"""
+import collections
+from machi_bot import database as machidb
+
+
+def test_keys_are_redrawn_so_picks_even_out(library, database):
+    library(5)
+    # Every media but the first is packed right after the lowest key, so the first
+    # one is behind almost the whole key range
+    database.execute("UPDATE media SET rand_key = -9000000000000000000 + media_id")
+    database.commit()
+
+    picks = collections.Counter(machidb.get_media(None)[0] for _ in range(5000))
+    assert len(picks) == 5
+    assert all(750 < count < 1250 for count in picks.values())
+
+
+def test_posted_media_is_picked_when_everything_is_posted(library, database):
+    library(3)
+    database.execute("UPDATE media SET posted = 1, last_posted = media_id")
+    database.commit()
+    assert machidb.get_media(None)[0] == 1